@@ -1,20 +1,279 @@
-import configparser
+from collections import OrderedDict, deque
+import asyncio
 import io
-import uuid
-import os
+import statistics
+import string
+import time
 
-import openai
+import metrics
+from metrics import stage, add_collector, openai_seconds, openai_tokens, openai_bytes
+from metrics import openai_queue_seconds
+from retry import retry, breakers
+from utils import get_config
 
-import soundfile as sf
 
-
-config = configparser.ConfigParser()
-config.read('config.ini')
+config = get_config()
 
 CHAT_MODEL = config["MAIN"]["CHAT_MODEL"]
-AUDIO_CACHE = ".audio"
+EMBEDDING_MODEL = config.get("OPENAI", "EMBEDDING_MODEL",
+                             fallback="text-embedding-ada-002")
+# auto: upload Telegram's OGG/Opus as is and convert anything else,
+# ogg: same as auto, wav: always convert to 16 kHz mono PCM. The segments
+# of long recordings are encoded as 16 kHz OGG/Opus unless this is wav
+AUDIO_UPLOAD_FORMAT = config.get("OPENAI", "AUDIO_UPLOAD_FORMAT",
+                                 fallback="auto").lower()
+# Whisper resamples everything to 16 kHz mono, anything above that is
+# wasted upload
+WHISPER_SAMPLERATE = 16000
+
+OPENAI_TOKEN = config["MAIN"]["OPENAI_TOKEN"]
+
+# limits for the async client layer, the sync functions below are not
+# affected by these
+REQUEST_TIMEOUT = config.getfloat("OPENAI", "REQUEST_TIMEOUT", fallback=60)
+TRANSCRIBE_TIMEOUT = config.getfloat("OPENAI", "TRANSCRIBE_TIMEOUT", fallback=120)
+# recordings longer than this many seconds are transcribed in segments
+# of at most CHUNK_SECONDS, cut at pauses and sent concurrently
+CHUNK_THRESHOLD = config.getfloat("OPENAI", "CHUNK_THRESHOLD", fallback=120)
+CHUNK_SECONDS = config.getfloat("OPENAI", "CHUNK_SECONDS", fallback=60)
+# how far back from a segment's end to look for a pause
+SILENCE_WINDOW = config.getfloat("OPENAI", "SILENCE_WINDOW", fallback=10)
+# seconds of audio the segments share at each boundary
+CHUNK_OVERLAP = config.getfloat("OPENAI", "CHUNK_OVERLAP", fallback=1)
+
+# seconds a call may take in all, retries included
+DEADLINE = config.getfloat("OPENAI", "DEADLINE", fallback=120)
+TRANSCRIBE_DEADLINE = config.getfloat("OPENAI", "TRANSCRIBE_DEADLINE", fallback=300)
+CONCURRENCY = {
+    "chat": config.getint("OPENAI", "CHAT_CONCURRENCY", fallback=8),
+    "audio": config.getint("OPENAI", "AUDIO_CONCURRENCY", fallback=4),
+    "embedding": config.getint("OPENAI", "EMBEDDING_CONCURRENCY", fallback=8),
+}
+
+# the account's rate limits, per minute; 0 means no limit
+RATE_LIMITS = {
+    "chat": (config.getint("OPENAI", "CHAT_RPM", fallback=3500),
+             config.getint("OPENAI", "CHAT_TPM", fallback=90_000)),
+    "audio": (config.getint("OPENAI", "AUDIO_RPM", fallback=50), 0),
+    "embedding": (config.getint("OPENAI", "EMBEDDING_RPM", fallback=3000),
+                  config.getint("OPENAI", "EMBEDDING_TPM", fallback=1_000_000)),
+}
+# assumed length of a reply when the request doesn't set max_tokens
+REPLY_TOKENS = config.getint("OPENAI", "REPLY_TOKENS", fallback=500)
+
+# request priorities, lower goes first
+INTERACTIVE, BACKGROUND = 0, 1
+
+_semaphores = {}
+_limiters = {}
+_encodings = {}
+_client = None
+
+
+# openai, numpy, soundfile and tiktoken take a while to import, they are
+# imported on first use so the bot starts without waiting for them
+def _api():
+    global _client
+    if _client is None:
+        import openai
+        openai.api_key = OPENAI_TOKEN
+        _client = openai
+    return _client
+
+
+def _limit(kind):
+    # semaphores are created lazily so they end up bound to the
+    # running event loop rather than the one at import time
+    if kind not in _semaphores:
+        _semaphores[kind] = asyncio.Semaphore(CONCURRENCY[kind])
+    return _semaphores[kind]
+
+
+def _encoding(model):
+    if model not in _encodings:
+        try:
+            import tiktoken
+        except ImportError:
+            _encodings[model] = None
+            return None
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except KeyError:
+            _encodings[model] = tiktoken.get_encoding("cl100k_base")
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str = CHAT_MODEL) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        # about four characters per token for English text
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
+
+def prompt_tokens(messages, model=CHAT_MODEL):
+    return sum(count_tokens(msg["content"], model) + 4 for msg in messages)
+
+
+def estimate_tokens(kind, **request):
+    """
+    What a request counts against the tokens-per-minute limit: the
+    prompt, plus the longest reply it allows for chat completions.
+    """
+    if kind == "chat":
+        prompt = prompt_tokens(request["messages"], request["model"])
+        return prompt + request.get("max_tokens", REPLY_TOKENS)
+    if kind == "embedding":
+        inputs = request["input"]
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return sum(count_tokens(text, request["model"]) for text in inputs)
+    return 0
+
+
+class TokenBucket:
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount):
+        # a request larger than the whole bucket waits for a full one
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0., missing / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.level -= min(amount, self.capacity)
 
-openai.api_key = config["MAIN"]["OPENAI_TOKEN"]
+    def drain(self):
+        self._refill()
+        self.level = min(self.level, 0.)
+
+
+class RateLimiter:
+    """
+    Lets requests to one endpoint through no faster than its requests and
+    tokens per minute buckets allow. Waiting requests are served by
+    priority, and within a priority round-robin across users, so a user
+    with many requests queued delays everybody else's by one request at
+    most.
+    """
+
+    def __init__(self, name, rpm=0, tpm=0):
+        self.name = name
+        self.buckets = [(TokenBucket(rpm), lambda tokens: 1)] if rpm else []
+        if tpm:
+            self.buckets.append((TokenBucket(tpm), lambda tokens: tokens))
+        # priority -> user -> deque of (tokens, future, time queued)
+        self._queues = {}
+        self._wake = asyncio.Event()
+        self._dispatcher = None
+        self.loop = asyncio.get_running_loop()
+        # seconds requests waited for their turn, the most recent ones
+        self.waits = deque(maxlen=1000)
+
+    def depth(self, priority=None):
+        queues = self._queues.values() if priority is None \
+            else [self._queues.get(priority, {})]
+        return sum(len(waiting) for users in queues for waiting in users.values())
+
+    async def acquire(self, tokens=0, user_id=None, priority=INTERACTIVE):
+        if not self.buckets:
+            return
+        future = self.loop.create_future()
+        users = self._queues.setdefault(priority, OrderedDict())
+        users.setdefault(user_id, deque()).append((tokens, future, time.monotonic()))
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wake.set()
+        await future
+
+    def drain(self):
+        # the endpoint answered 429, stop sending until the buckets refill
+        for bucket, _ in self.buckets:
+            bucket.drain()
+
+    def _next(self):
+        for priority in sorted(self._queues):
+            users = self._queues[priority]
+            while users:
+                user_id, waiting = next(iter(users.items()))
+                # skip requests whose callers have given up
+                while waiting and waiting[0][1].done():
+                    waiting.popleft()
+                if waiting:
+                    return users, user_id, waiting
+                del users[user_id]
+        return None
+
+    async def _dispatch(self):
+        while True:
+            head = self._next()
+            if head is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            users, user_id, waiting = head
+            tokens, future, queued = waiting[0]
+            delay = max(bucket.delay(cost(tokens)) for bucket, cost in self.buckets)
+            if delay > 0:
+                # look again afterwards, a more urgent request may have come in
+                await asyncio.sleep(delay)
+                continue
+            waiting.popleft()
+            # the user goes to the back of the line
+            users.move_to_end(user_id)
+            for bucket, cost in self.buckets:
+                bucket.take(cost(tokens))
+            self.waits.append(time.monotonic() - queued)
+            openai_queue_seconds.observe(self.waits[-1], self.name)
+            future.set_result(None)
+
+
+def get_limiter(kind):
+    limiter = _limiters.get(kind)
+    if limiter is None or limiter.loop is not asyncio.get_running_loop():
+        limiter = _limiters[kind] = RateLimiter(kind, *RATE_LIMITS[kind])
+    return limiter
+
+
+def scheduler_stats():
+    """
+    Queue depth per priority and percentiles of the time requests waited
+    for their turn, per endpoint.
+    """
+    stats = {}
+    for kind, limiter in _limiters.items():
+        waits = list(limiter.waits) or [0.]
+        if len(waits) > 1:
+            cuts = statistics.quantiles(waits, n=20, method="inclusive")
+            p50, p95 = cuts[9], cuts[18]
+        else:
+            p50 = p95 = waits[0]
+        stats[kind] = {"queued_interactive": limiter.depth(INTERACTIVE),
+                       "queued_background": limiter.depth(BACKGROUND),
+                       "wait_p50_s": float(p50),
+                       "wait_p95_s": float(p95)}
+    return stats
+
+
+def _queue_depth():
+    for kind, limiter in _limiters.items():
+        for priority, name in ((INTERACTIVE, "interactive"), (BACKGROUND, "background")):
+            yield {"kind": kind, "priority": name}, limiter.depth(priority)
+
+
+add_collector("openai_queue_depth", "gauge",
+              "Requests waiting for the rate limiter", _queue_depth)
 
 
 def make_completion(prompt, asst=None, context=None, chat_model=CHAT_MODEL):
@@ -36,7 +295,7 @@ def make_completion(prompt, asst=None, context=None, chat_model=CHAT_MODEL):
 
 
 def get_response(completion):
-    resp = openai.ChatCompletion.create(**completion)
+    resp = _api().ChatCompletion.create(**completion)
     return resp['choices'][0]['message']['content']
 
 
@@ -44,8 +303,168 @@ def chatgpt_get_response(completion):
     return get_response(completion)
 
 
-def convert_to_wav(audio):
-    data, samplerate = sf.read(audio)
+def _request(fn, timeout, **kwargs):
+    return asyncio.wait_for(fn(**kwargs, request_timeout=timeout), timeout)
+
+
+def _count_input(kind, **request):
+    # the audio upload is counted where it is sent
+    if kind == "chat":
+        texts = [msg["content"] for msg in request["messages"]]
+    elif kind == "embedding":
+        texts = request["input"]
+        texts = [texts] if isinstance(texts, str) else texts
+    else:
+        return
+    openai_bytes.inc(sum(len(text.encode("utf-8")) for text in texts), kind)
+
+
+def _count_usage(kind, resp):
+    usage = resp.get("usage") or {}
+    openai_tokens.inc(usage.get("prompt_tokens", 0), kind, "prompt")
+    openai_tokens.inc(usage.get("completion_tokens", 0), kind, "completion")
+
+
+def _queue(kind, tokens, user_id, priority):
+    # waited for by `retry` outside the attempt, a backlog here is ours,
+    # it mustn't count against the openai breaker
+    def acquire():
+        return get_limiter(kind).acquire(tokens, user_id, priority)
+    return acquire
+
+
+async def _limited_request(kind, fn, timeout, **kwargs):
+    limiter = get_limiter(kind)
+    # the slot is only held while a request is in flight, not while
+    # waiting to retry it
+    async with _limit(kind):
+        start = time.perf_counter()
+        try:
+            resp = await _request(fn, timeout, **kwargs)
+        except _api().error.RateLimitError:
+            limiter.drain()
+            raise
+        finally:
+            openai_seconds.observe(time.perf_counter() - start, kind)
+    if metrics.ENABLED:
+        _count_input(kind, **kwargs)
+        _count_usage(kind, resp)
+    return resp
+
+
+async def _limited_retry(kind, fn, timeout, deadline, user_id=None, priority=INTERACTIVE,
+                         **kwargs):
+    return await retry(_limited_request, kind, fn, timeout, **kwargs,
+                       acquire=_queue(kind, estimate_tokens(kind, **kwargs), user_id, priority),
+                       deadline=deadline, breaker=breakers["openai"])
+
+
+async def aget_response(completion, timeout=REQUEST_TIMEOUT, deadline=DEADLINE,
+                        user_id=None, priority=INTERACTIVE):
+    resp = await _limited_retry("chat", _api().ChatCompletion.acreate, timeout, deadline,
+                                user_id=user_id, priority=priority, **completion)
+    return resp['choices'][0]['message']['content']
+
+
+async def _open_stream(completion, timeout):
+    """
+    Opens the stream holding a "chat" slot, which the caller releases once
+    it has read the stream. On failure the slot is released here, so it
+    isn't held while waiting to retry.
+    """
+    limiter = get_limiter("chat")
+    await _limit("chat").acquire()
+    start = time.perf_counter()
+    try:
+        stream = await _request(_api().ChatCompletion.acreate, timeout,
+                                **completion, stream=True)
+    except BaseException as e:
+        _limit("chat").release()
+        if isinstance(e, _api().error.RateLimitError):
+            limiter.drain()
+        raise
+    finally:
+        openai_seconds.observe(time.perf_counter() - start, "chat")
+    if metrics.ENABLED:
+        # streamed replies come without usage
+        _count_input("chat", **completion)
+        openai_tokens.inc(prompt_tokens(completion["messages"], completion["model"]),
+                          "chat", "prompt")
+    return stream
+
+
+async def astream_response(completion, timeout=REQUEST_TIMEOUT, deadline=DEADLINE,
+                           user_id=None, priority=INTERACTIVE):
+    """
+    Yields the text of the reply piece by piece as the model generates it.
+    Only opening the stream is retried, not a stream that broke midway.
+    """
+    stream = await retry(_open_stream, completion, timeout,
+                         acquire=_queue("chat", estimate_tokens("chat", **completion),
+                                        user_id, priority),
+                         deadline=deadline, breaker=breakers["openai"])
+    try:
+        async for chunk in stream:
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                # a chunk carries one token
+                openai_tokens.inc(1, "chat", "completion")
+                yield content
+    finally:
+        _limit("chat").release()
+
+
+def lowpass(data, cutoff, taps=129, block=1 << 16):
+    """
+    Filters out what is above `cutoff`, in cycles per sample, with a
+    windowed sinc applied block by block in the frequency domain, so a
+    long recording isn't transformed in one piece.
+    """
+    import numpy as np
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(taps)
+    kernel /= kernel.sum()
+    size = block + taps - 1
+    spectrum = np.fft.rfft(kernel, size)
+    out = np.zeros(len(data) + taps - 1, dtype=np.float32)
+    for start in range(0, len(data), block):
+        chunk = data[start:start + block]
+        end = start + len(chunk) + taps - 1
+        out[start:end] += np.fft.irfft(np.fft.rfft(chunk, size) * spectrum,
+                                       size)[:end - start]
+    # without the filter's delay
+    delay = (taps - 1) // 2
+    return out[delay:delay + len(data)]
+
+
+def resample(data, samplerate, target=WHISPER_SAMPLERATE):
+    import numpy as np
+    if samplerate == target:
+        return data
+    if target < samplerate:
+        # what the target rate can't represent would alias into the
+        # speech band, below 90% of its Nyquist frequency is kept
+        ratio = samplerate / target
+        data = lowpass(data, 0.45 / ratio, taps=int(32 * ratio) | 1)
+    n_out = int(round(len(data) * target / samplerate))
+    # float64, float32 can't tell sample positions apart past 2**23
+    positions = np.arange(n_out) * (samplerate / target)
+    return np.interp(positions, np.arange(len(data)), data).astype(np.float32)
+
+
+def decode_audio(audio, samplerate=WHISPER_SAMPLERATE):
+    import soundfile as sf
+    audio.seek(0)
+    data, source_rate = sf.read(audio, dtype='float32', always_2d=True)
+    return resample(data.mean(axis=1), source_rate, samplerate)
+
+
+def convert_to_wav(audio, samplerate=WHISPER_SAMPLERATE):
+    return encode_wav(decode_audio(audio, samplerate), samplerate)
+
+
+def encode_wav(data, samplerate=WHISPER_SAMPLERATE):
+    import soundfile as sf
     wav_buffer = io.BytesIO()
     with sf.SoundFile(wav_buffer, mode='w',
                       channels=1, format='WAV', 
@@ -53,40 +472,177 @@ def convert_to_wav(audio):
                       subtype='PCM_16') as wav_file:
         wav_file.write(data)
 
+    wav_buffer.seek(0)
+    wav_buffer.name = "audio.wav"
     return wav_buffer
 
 
-def save_to_wav(audio, fname):
-    data, samplerate = sf.read(audio)
-    sf.write(fname, data, samplerate)
+def encode_ogg(data, samplerate=WHISPER_SAMPLERATE):
+    import soundfile as sf
+    ogg_buffer = io.BytesIO()
+    sf.write(ogg_buffer, data, samplerate, format='OGG', subtype='OPUS')
+    ogg_buffer.seek(0)
+    ogg_buffer.name = "voice.ogg"
+    return ogg_buffer
 
 
-def clean_audio_cache(audio_path=AUDIO_CACHE):
-    # delete all files in directory
-    # `audio_path`
-    for file in os.listdir(audio_path):
-        try:
-            os.remove(os.path.join(audio_path, file))
-        except:
-            pass
+def encode_segment(data, upload_format=AUDIO_UPLOAD_FORMAT):
+    # Opus at 16 kHz is about a tenth of the size of the same audio as WAV
+    if upload_format == "wav":
+        return encode_wav(data)
+    return encode_ogg(data)
+
+
+def is_ogg(audio):
+    with audio.getbuffer() as view:
+        return bytes(view[:4]) == b"OggS"
+
+
+def prepare_upload(audio, upload_format=AUDIO_UPLOAD_FORMAT):
+    """
+    Returns a file object with the recording in the cheapest format
+    Whisper accepts. An OGG recording is passed through without copying,
+    anything else is converted to 16 kHz mono WAV in memory.
+    """
+    if upload_format in ("auto", "ogg") and is_ogg(audio):
+        audio.seek(0)
+        # the API client takes the upload format from the file name
+        audio.name = "voice.ogg"
+        return audio
+    return convert_to_wav(audio)
 
 
 def transcribe_audio(audio):
-    audio.seek(0)
-    fname = os.path.join(AUDIO_CACHE, f".{str(uuid.uuid4())}.wav")
-    save_to_wav(audio, fname)
-    
-    with open(fname, "rb") as f:
-        transcript = openai.Audio.transcribe("whisper-1", f)
-    
-    try:
-        os.remove(fname)
-    except:
-        pass
-    return transcript
+    return _api().Audio.transcribe("whisper-1", prepare_upload(audio))
+
+
+def embed_text(text, model=EMBEDDING_MODEL):
+    return _api().Embedding.create(input=text,
+                            model=model,
+                            )["data"][0]['embedding']
+
+
+async def _atranscribe_upload(upload, timeout, deadline, user_id, priority):
+    async def transcribe(**kwargs):
+        # a retry uploads the file again from the start
+        upload.seek(0)
+        with upload.getbuffer() as view:
+            openai_bytes.inc(view.nbytes, "audio")
+        return await _api().Audio.atranscribe("whisper-1", upload, **kwargs)
+
+    return await _limited_retry("audio", transcribe, timeout, deadline,
+                                user_id=user_id, priority=priority)
+
+
+async def atranscribe_audio(audio, timeout=TRANSCRIBE_TIMEOUT, deadline=TRANSCRIBE_DEADLINE,
+                            user_id=None, priority=INTERACTIVE):
+    # decoding is blocking when the audio has to be converted,
+    # keep it off the event loop
+    with stage("voice", "convert"):
+        upload = await asyncio.to_thread(prepare_upload, audio)
+    return await _atranscribe_upload(upload, timeout, deadline, user_id, priority)
+
+
+def silence_cuts(data, samplerate=WHISPER_SAMPLERATE,
+                 chunk_seconds=CHUNK_SECONDS,
+                 window_seconds=SILENCE_WINDOW,
+                 frame_seconds=0.02):
+    """
+    Sample positions to cut the recording at so that no piece is longer
+    than `chunk_seconds`: the quietest frame within the last
+    `window_seconds` of each piece.
+    """
+    import numpy as np
+    frame = int(frame_seconds * samplerate)
+    n_frames = len(data) // frame
+    energy = (data[:n_frames * frame].reshape(n_frames, frame) ** 2).mean(axis=1)
+    chunk_frames = int(chunk_seconds / frame_seconds)
+    window_frames = int(window_seconds / frame_seconds)
+
+    cuts = []
+    start = 0
+    while n_frames - start > chunk_frames:
+        end = start + chunk_frames
+        low = max(start + 1, end - window_frames)
+        start = low + int(np.argmin(energy[low:end]))
+        cuts.append(start * frame)
+    return cuts
+
+
+def split_audio(data, samplerate=WHISPER_SAMPLERATE, overlap=CHUNK_OVERLAP, **kwargs):
+    """
+    Cuts the recording at pauses into segments that overlap by `overlap`
+    seconds on each side, so a word cut at a boundary is heard whole in
+    one of them.
+    """
+    bounds = [0, *silence_cuts(data, samplerate, **kwargs), len(data)]
+    pad = int(overlap * samplerate)
+    return [data[max(0, start - pad):min(len(data), end + pad)]
+            for start, end in zip(bounds, bounds[1:])]
+
+
+def _word_key(word):
+    return word.strip(string.punctuation + "\u2026").lower()
+
+
+def stitch(texts, max_words=12):
+    """
+    Joins the transcripts of consecutive overlapping segments, dropping the
+    words at the start of each that repeat the end of the one before.
+    """
+    words = []
+    for text in texts:
+        new = text.split()
+        keys = [_word_key(word) for word in new]
+        tail = [_word_key(word) for word in words[-max_words:]]
+        repeated = 0
+        for n in range(min(len(tail), len(keys)), 0, -1):
+            if tail[-n:] == keys[:n]:
+                repeated = n
+                break
+        words += new[repeated:]
+    return " ".join(words)
+
+
+async def atranscribe_long(audio, timeout=TRANSCRIBE_TIMEOUT, deadline=TRANSCRIBE_DEADLINE,
+                           user_id=None, priority=INTERACTIVE,
+                           threshold=CHUNK_THRESHOLD):
+    """
+    Transcribes a recording longer than `threshold` seconds as segments
+    cut at pauses, sent concurrently within the audio rate limits, and
+    stitches their transcripts together. Shorter ones are sent whole.
+    """
+    def duration():
+        import soundfile as sf
+        audio.seek(0)
+        return sf.info(audio).duration
+
+    if await asyncio.to_thread(duration) <= threshold:
+        return await atranscribe_audio(audio, timeout, deadline, user_id, priority)
+
+    def prepare():
+        return [encode_segment(segment) for segment in split_audio(decode_audio(audio))]
+
+    with stage("voice", "split"):
+        uploads = await asyncio.to_thread(prepare)
+    results = await asyncio.gather(*[_atranscribe_upload(upload, timeout, deadline,
+                                                         user_id, priority)
+                                     for upload in uploads])
+    return {"text": stitch([result["text"] for result in results])}
+
+
+async def aembed_text(text, model=EMBEDDING_MODEL, timeout=REQUEST_TIMEOUT, deadline=DEADLINE,
+                      priority=INTERACTIVE):
+    resp = await _limited_retry("embedding", _api().Embedding.acreate, timeout, deadline,
+                                input=text, model=model, priority=priority)
+    return resp["data"][0]['embedding']
 
 
-def embed_text(text):
-    return openai.Embedding.create(input=text,
-                            model="text-embedding-ada-002",
-                            )["data"][0]['embedding']
\ No newline at end of file
+async def aembed_texts(texts, model=EMBEDDING_MODEL, timeout=REQUEST_TIMEOUT, deadline=DEADLINE,
+                       priority=INTERACTIVE):
+    # the endpoint takes a list of inputs and returns one vector per
+    # input, tagged with the input's position
+    resp = await _limited_retry("embedding", _api().Embedding.acreate, timeout, deadline,
+                                input=list(texts), model=model, priority=priority)
+    data = sorted(resp["data"], key=lambda item: item["index"])
+    return [item["embedding"] for item in data]
@@ -0,0 +1,223 @@
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+import asyncio
+import json
+import os
+import re
+
+from _openai import aembed_texts, BACKGROUND, EMBEDDING_MODEL
+from cache import PREFIX, VECTOR_FIELDS, VECTOR_TYPE, VECTOR_FIELD_SUFFIX, EMBEDDING_DIM
+from cache import MODEL_FIELD, vector_field_name, full_vector_key
+from cache import encode_vector, decode_vector, get_full_vector_store
+
+
+EXPORT_FIELDS = {"user_id": int, "message_id": int, "message": str, "timestamp": float}
+
+# sets a field only if the note wasn't edited since it was read, an
+# edit comes with a vector of its own
+_SET_IF_UNCHANGED = """
+if redis.call('HGET', KEYS[1], 'message') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+return 1
+"""
+
+
+class Checkpoint:
+    """
+    How far a pass over the notes got, kept in a JSON file that is
+    replaced atomically after every batch, so an interrupted run resumes
+    from the last batch it finished.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {"cursor": 0}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    @property
+    def resumed(self):
+        return self.state["cursor"] != 0
+
+    def save(self, **state):
+        self.state.update(state)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def notes_pattern(user_id=None, prefix=PREFIX):
+    if user_id is None:
+        return f"{prefix}:*"
+    return f"{prefix}:<{int(user_id)}>*"
+
+
+async def scan_notes(client,
+                     cursor: int = 0,
+                     pattern: str = notes_pattern(),
+                     count: int = 1000,
+                     fields: Optional[Iterable[str]] = None,
+                     ) -> AsyncIterator[Tuple[int, List[Tuple[str, dict]]]]:
+    """
+    Walks the note hashes with SCAN from `cursor`, yielding the cursor to
+    continue from along with each page of notes, read with one pipelined
+    HGETALL, or HMGET of `fields`, per page. Only one page is held in
+    memory. SCAN may return a note that moved during a rehash twice.
+    """
+    fields = list(fields) if fields is not None else None
+    while True:
+        cursor, keys = await client.scan(cursor, match=pattern, count=count)
+        notes = []
+        if keys:
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                if fields is None:
+                    pipe.hgetall(key)
+                else:
+                    pipe.hmget(key, *fields)
+            for key, row in zip(keys, await pipe.execute()):
+                if fields is not None:
+                    row = {field.encode(): value for field, value in zip(fields, row)
+                           if value is not None}
+                # deleted between SCAN and HGETALL
+                if row:
+                    notes.append((key.decode("utf-8"), row))
+        yield cursor, notes
+        if cursor == 0:
+            return
+
+
+def _export_record(key, row, vectors):
+    record = {"key": key}
+    for field, convert in EXPORT_FIELDS.items():
+        value = row.get(field.encode())
+        if value is not None:
+            record[field] = convert(value.decode("utf-8"))
+    if vectors:
+        for vector_type in VECTOR_FIELDS:
+            blob = row.get(vector_field_name(vector_type).encode())
+            if blob is not None:
+                record["embedding"] = decode_vector(blob, vector_type).tolist()
+                break
+    return record
+
+
+async def export_notes(client,
+                       out_path: str,
+                       checkpoint_path: str,
+                       user_id=None,
+                       count: int = 1000,
+                       vectors: bool = False) -> int:
+    """
+    Writes the notes, of one user or everybody's, to `out_path` as JSON
+    lines. Returns the number of notes written. A run interrupted
+    midway continues from its checkpoint, dropping anything written
+    after it.
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    written = checkpoint.state.get("written", 0)
+    with open(out_path, "ab" if checkpoint.resumed else "wb") as f:
+        if checkpoint.resumed:
+            f.truncate(checkpoint.state["offset"])
+        async for cursor, notes in scan_notes(client, checkpoint.state["cursor"],
+                                              notes_pattern(user_id), count):
+            for key, row in notes:
+                line = json.dumps(_export_record(key, row, vectors), ensure_ascii=False)
+                f.write(line.encode("utf-8") + b"\n")
+            written += len(notes)
+            f.flush()
+            os.fsync(f.fileno())
+            checkpoint.save(cursor=cursor, written=written, offset=f.tell())
+            print(f"Exported {written} notes")
+    checkpoint.clear()
+    return written
+
+
+async def _embed(texts, model, batch):
+    # the batches are sent concurrently, within the embedding rate limits
+    results = await asyncio.gather(*[aembed_texts(texts[i:i + batch], model=model,
+                                                  priority=BACKGROUND)
+                                     for i in range(0, len(texts), batch)])
+    return [vector for vectors in results for vector in vectors]
+
+
+def field_suffix(model: str) -> str:
+    return "_" + re.sub(r"\W", "_", model)
+
+
+async def _set_if_unchanged(client, script, notes, field):
+    # notes are (key, text read, value) triples
+    pipe = client.pipeline(transaction=False)
+    for key, text, value in notes:
+        await script(keys=[key], args=[text, field, value], client=pipe)
+    return await pipe.execute()
+
+
+async def reembed_notes(client,
+                        model: str,
+                        checkpoint_path: str,
+                        user_id=None,
+                        count: int = 1000,
+                        batch: int = 500,
+                        vector_type: str = VECTOR_TYPE,
+                        embedding_dim: int = int(EMBEDDING_DIM),
+                        suffix: str = None) -> Tuple[int, int]:
+    """
+    Writes vectors made by `model` to a field of their own, named with
+    `suffix`, next to the live ones, so they can be indexed without
+    touching what the bots search. Run again once the bots are configured
+    with the suffix, it catches up on the notes they saved before, in the
+    field they now search. Skips notes it has made the vectors of already.
+    Returns the
+    number of notes re-embedded and of notes skipped because they were
+    edited meanwhile. Progress is checkpointed after every page of notes.
+    """
+    suffix = field_suffix(model) if suffix is None else suffix
+    if suffix == VECTOR_FIELD_SUFFIX and model != EMBEDDING_MODEL:
+        raise ValueError(f"{vector_field_name(vector_type, suffix)} is searched with "
+                         f"{EMBEDDING_MODEL}, not {model}")
+    field = vector_field_name(vector_type, suffix)
+    checkpoint = Checkpoint(checkpoint_path)
+    done = checkpoint.state.get("done", 0)
+    edited = checkpoint.state.get("edited", 0)
+    store = get_full_vector_store() if vector_type != "FLOAT32" else None
+    script = client.register_script(_SET_IF_UNCHANGED)
+
+    async for cursor, notes in scan_notes(client, checkpoint.state["cursor"],
+                                          notes_pattern(user_id), count,
+                                          fields=("message", MODEL_FIELD)):
+        pending = [(key, row[b"message"].decode("utf-8")) for key, row in notes
+                   if b"message" in row and row.get(MODEL_FIELD.encode()) != model.encode()]
+        if pending:
+            vectors = await _embed([text for _, text in pending], model, batch)
+            if len(vectors[0]) != embedding_dim:
+                raise ValueError(f"{model} makes {len(vectors[0])} dimensional vectors, "
+                                 f"set EMBEDDING_DIM to that first")
+            written = await _set_if_unchanged(
+                client, script, [(key, text, encode_vector(vector, vector_type))
+                                 for (key, text), vector in zip(pending, vectors)], field)
+            unchanged = [(key, text, vector) for (key, text), vector, ok
+                         in zip(pending, vectors, written) if ok]
+            # only the vectors Redis took, and before the notes are marked
+            # done, so an interrupted run makes the missing ones again
+            if store is not None and unchanged:
+                await store.put_many([(full_vector_key(key, suffix), vector)
+                                      for key, _, vector in unchanged])
+            marked = await _set_if_unchanged(client, script,
+                                             [(key, text, model) for key, text, _ in unchanged],
+                                             MODEL_FIELD)
+            done += sum(marked)
+            edited += len(pending) - sum(marked)
+        checkpoint.save(cursor=cursor, done=done, edited=edited)
+        print(f"Re-embedded {done} notes")
+    checkpoint.clear()
+    return done, edited
@@ -0,0 +1,104 @@
+"""
+Compares the audio preparation paths for Whisper uploads: the original
+path (decode to float64, full-rate WAV through a temp file) against the
+in-memory OGG passthrough and 16 kHz WAV conversion.
+
+    python benchmarks/audio_upload.py --minutes 1,5,10
+
+Synthetic speech-like audio is encoded as 48 kHz OGG/Opus the way Telegram
+sends voice notes. Each path runs in a fresh process so peak RSS is
+measured for that path alone. Figures are per minute of audio.
+"""
+import argparse
+import io
+import multiprocessing as mp
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from _openai import prepare_upload
+
+
+SAMPLERATE = 48000
+
+
+def synthetic_voice(minutes, seed=0):
+    rng = np.random.default_rng(seed)
+    n = int(minutes * 60 * SAMPLERATE)
+    t = np.arange(n, dtype=np.float32) / SAMPLERATE
+    # a few harmonics with a syllable-rate envelope and some noise
+    pitch = 140 + 20 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLERATE
+    voice = sum(np.sin(k * phase) / k for k in range(1, 6))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    signal = 0.3 * voice * envelope + 0.01 * rng.standard_normal(n)
+
+    buff = io.BytesIO()
+    sf.write(buff, signal.astype(np.float32), SAMPLERATE, format='OGG', subtype='OPUS')
+    return buff.getvalue()
+
+
+def legacy_path(data):
+    audio = io.BytesIO(data)
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, "audio.wav")
+        samples, samplerate = sf.read(audio)
+        sf.write(fname, samples, samplerate)
+        with open(fname, "rb") as f:
+            return len(f.read())
+
+
+def ogg_path(data):
+    return prepare_upload(io.BytesIO(data), "ogg").getbuffer().nbytes
+
+
+def wav_path(data):
+    return prepare_upload(io.BytesIO(data), "wav").getbuffer().nbytes
+
+
+PATHS = {"legacy": legacy_path, "ogg": ogg_path, "wav16k": wav_path}
+
+
+def _measure(name, data, queue):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    uploaded = PATHS[name](data)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    queue.put((uploaded, elapsed, (peak - baseline) / 1024))
+
+
+def measure(name, data):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure, args=(name, data, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", default="1,5,10")
+    args = parser.parse_args()
+
+    print(f"{'minutes':>7} {'path':>7} {'KB/min':>9} {'peak RSS MB/min':>16} {'ms/min':>8}")
+    for minutes in [float(m) for m in args.minutes.split(",")]:
+        data = synthetic_voice(minutes)
+        for name in PATHS:
+            uploaded, elapsed, peak = measure(name, data)
+            print(f"{minutes:>7g} {name:>7} {uploaded / 1024 / minutes:>9.1f} "
+                  f"{peak / minutes:>16.2f} {elapsed * 1000 / minutes:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Compares wall-clock transcription latency against note length for a
+single Whisper request and for segments cut at pauses and sent
+concurrently, against the fake OpenAI server.
+
+    python benchmarks/chunked_transcription.py --minutes 1 2 5 10 --speed 20
+
+The fake server takes --latency seconds per request plus the audio length
+divided by --speed, a rough model of Whisper's processing time. Synthetic
+speech-like audio is encoded as OGG/Opus the way Telegram sends voice
+notes. The chunked figures include decoding and cutting the recording.
+"""
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+
+import openai
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import _openai
+from audio_upload import synthetic_voice
+from fakes import FakeOpenAI
+
+
+async def timed(fn, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn(io.BytesIO(data))
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+async def run(args):
+    fake = await FakeOpenAI(latency=args.latency, transcribe_speed=args.speed).start()
+    openai.api_base = fake.api_base
+    print(f"{'minutes':>8} {'single s':>9} {'chunked s':>10} {'segments':>9} {'speedup':>8}")
+    try:
+        for minutes in args.minutes:
+            data = synthetic_voice(minutes)
+            single = await timed(_openai.atranscribe_audio, data, args.repeat)
+
+            fake.calls.clear()
+            chunked = await timed(lambda audio: _openai.atranscribe_long(audio, threshold=0),
+                                  data, args.repeat)
+            segments = fake.calls["transcriptions"] // args.repeat
+            print(f"{minutes:>8} {single:>9.2f} {chunked:>10.2f} {segments:>9} "
+                  f"{single / chunked:>8.2f}")
+    finally:
+        await fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--minutes", type=float, nargs="+", default=[0.5, 1, 2, 5, 10])
+    parser.add_argument("--latency", type=float, default=0.5,
+                        help="seconds per request before any audio is processed")
+    parser.add_argument("--speed", type=float, default=20,
+                        help="seconds of audio the fake transcribes per second")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Local stand-ins for the OpenAI and Telegram Bot APIs, used by the load
+tests. Both are small asyncio HTTP servers with configurable latency and
+error rate that count the calls they receive.
+"""
+import asyncio
+import base64
+import io
+import json
+import random
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+import numpy as np
+import soundfile as sf
+
+from audio_upload import synthetic_voice
+
+
+class FakeServer:
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.rng = random.Random(seed)
+        self.port = None
+        self._server = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, content_type, payload = await self._dispatch(method, path, headers, body)
+                if hasattr(payload, "__aiter__"):
+                    await _write_chunked(writer, status, content_type, payload)
+                    continue
+                if isinstance(payload, (dict, list)):
+                    payload = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "Connection: keep-alive\r\n\r\n".encode() + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, headers, body):
+        delay = self.latency + self.rng.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.calls["errors"] += 1
+            return 500, "application/json", self.error_payload()
+        return await self.handle(method, path, headers, body)
+
+    def error_payload(self):
+        return {"error": {"message": "injected failure", "type": "server_error"}}
+
+    async def handle(self, method, path, headers, body):
+        raise NotImplementedError
+
+
+async def _write_chunked(writer, status, content_type, chunks):
+    writer.write(f"HTTP/1.1 {status} OK\r\n"
+                 f"Content-Type: {content_type}\r\n"
+                 "Transfer-Encoding: chunked\r\n"
+                 "Connection: keep-alive\r\n\r\n".encode())
+    async for chunk in chunks:
+        writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+        await writer.drain()
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+async def _read_request(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    method, path, _ = line.decode().split(" ", 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode().split(":", 1)
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            body += await reader.readexactly(size)
+            await reader.readline()
+        body = bytes(body)
+    else:
+        body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return method, path, headers, body
+
+
+class FakeOpenAI(FakeServer):
+    """
+    Serves /v1/chat/completions, /v1/embeddings and /v1/audio/transcriptions.
+    """
+
+    def __init__(self, embedding_dim=1536, transcript_words=40,
+                 reply_words=60, token_interval=0.02, transcribe_speed=0., **kwargs):
+        super().__init__(**kwargs)
+        self.embedding_dim = embedding_dim
+        # seconds of audio transcribed per second on top of `latency`,
+        # 0 makes transcription take the same time whatever the length
+        self.transcribe_speed = transcribe_speed
+        self.transcript_words = transcript_words
+        self.reply_words = reply_words
+        # delay between streamed tokens, the first one comes after `latency`
+        self.token_interval = token_interval
+
+    @property
+    def api_base(self):
+        return f"{self.url}/v1"
+
+    def _vector(self, text):
+        rng = np.random.default_rng(abs(hash(text)) % 2**32)
+        vector = rng.standard_normal(self.embedding_dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def _words(self, n):
+        return " ".join(self.rng.choice(["note", "remember", "buy", "call", "meeting",
+                                         "tomorrow", "idea", "project", "draft", "list"])
+                        for _ in range(n))
+
+    async def handle(self, method, path, headers, body):
+        if path.endswith("/chat/completions"):
+            self.calls["chat"] += 1
+            if json.loads(body).get("stream"):
+                return 200, "text/event-stream", self._stream(self._words(self.reply_words))
+            return 200, "application/json", {
+                "id": f"chatcmpl-{self.calls['chat']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "choices": [{"index": 0,
+                             "message": {"role": "assistant",
+                                         "content": self._words(self.reply_words)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+
+        if path.endswith("/embeddings"):
+            self.calls["embeddings"] += 1
+            request = json.loads(body)
+            inputs = request["input"]
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            self.calls["embedded_texts"] += len(inputs)
+            as_base64 = request.get("encoding_format") == "base64"
+            data = []
+            for i, text in enumerate(inputs):
+                vector = self._vector(text)
+                data.append({"object": "embedding", "index": i,
+                             "embedding": base64.b64encode(vector.tobytes()).decode()
+                             if as_base64 else vector.tolist()})
+            return 200, "application/json", {"object": "list", "data": data,
+                                             "model": request.get("model")}
+
+        if path.endswith("/audio/transcriptions"):
+            self.calls["transcriptions"] += 1
+            self.calls["audio_bytes"] += len(body)
+            if self.transcribe_speed:
+                await asyncio.sleep(_audio_duration(headers, body) / self.transcribe_speed)
+            return 200, "application/json", {"text": self._words(self.transcript_words)}
+
+        return 404, "application/json", {"error": {"message": f"unknown path {path}"}}
+
+    async def _stream(self, text):
+        for i, word in enumerate(text.split(" ")):
+            if i:
+                await asyncio.sleep(self.token_interval)
+            chunk = {"id": f"chatcmpl-{self.calls['chat']}",
+                     "object": "chat.completion.chunk",
+                     "created": int(time.time()),
+                     "choices": [{"index": 0,
+                                  "delta": {"content": word if i == 0 else f" {word}"},
+                                  "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n".encode()
+        yield b"data: [DONE]\n\n"
+
+
+def _audio_duration(headers, body):
+    boundary = headers["content-type"].split("boundary=", 1)[1].strip('"').encode()
+    for part in body.split(b"--" + boundary):
+        head, _, content = part.partition(b"\r\n\r\n")
+        if b'name="file"' in head:
+            return sf.info(io.BytesIO(content[:-2])).duration
+    return 0.
+
+
+class FakeTelegram(FakeServer):
+    """
+    Serves the Bot API methods the handlers use, plus file downloads of a
+    synthetic voice recording.
+    """
+
+    def __init__(self, token, voice_minutes=0.25, **kwargs):
+        super().__init__(**kwargs)
+        self.token = token
+        self.voice = synthetic_voice(voice_minutes)
+        self._message_id = 10_000_000
+
+    @property
+    def base_url(self):
+        return f"{self.url}/bot"
+
+    def error_payload(self):
+        return {"ok": False, "error_code": 500, "description": "injected failure"}
+
+    @property
+    def base_file_url(self):
+        return f"{self.url}/file/bot"
+
+    def _message(self, message_id, params):
+        return {"message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", "")}
+
+    def _next_message(self, params):
+        self._message_id += 1
+        return self._message(self._message_id, params)
+
+    @staticmethod
+    def _params(headers, body):
+        if headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+    async def handle(self, method, path, headers, body):
+        if path.startswith("/file/"):
+            self.calls["download"] += 1
+            return 200, "application/octet-stream", self.voice
+
+        api_method = path.rsplit("/", 1)[-1]
+        params = self._params(headers, body)
+        self.calls[api_method] += 1
+
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                      "can_join_groups": False, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif api_method == "getFile":
+            result = {"file_id": params["file_id"],
+                      "file_unique_id": params["file_id"],
+                      "file_size": len(self.voice),
+                      "file_path": f"voice/{params['file_id']}.oga"}
+        elif api_method == "sendMessage":
+            result = self._next_message(params)
+        elif api_method in ("editMessageText", "editMessageReplyMarkup"):
+            result = self._message(int(params.get("message_id", 0)), params)
+        else:
+            result = True
+        return 200, "application/json", {"ok": True, "result": result}
@@ -0,0 +1,150 @@
+"""
+Compares search latency and recall of the FLAT and HNSW vector index modes
+on synthetic corpora.
+
+    python benchmarks/index_modes.py --sizes 10000,100000,1000000 --dim 1536
+
+Loads random unit vectors under a separate key prefix, builds one index of
+each type over them and runs the same KNN queries against both. Recall is
+measured against exact numpy search. Everything it creates is removed at
+the end.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import redis
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cache import HOST, PORT, PASSWORD, DISTANCE_METRIC
+from cache import HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_RUNTIME, _vector_field
+
+
+PREFIX = "bench:vec:"
+
+
+def random_unit_vectors(n, dim, rng):
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def load(client, vectors, batch=1000):
+    for start in range(0, len(vectors), batch):
+        pipe = client.pipeline(transaction=False)
+        for i in range(start, min(start + batch, len(vectors))):
+            pipe.hset(f"{PREFIX}{i}", mapping={"message_embedding": vectors[i].tobytes()})
+        pipe.execute()
+
+
+def build(client, name, index_type, dim, args):
+    # the vectors are loaded as float32 whatever VECTOR_TYPE is configured
+    field = _vector_field(index_type, dim, DISTANCE_METRIC,
+                          m=args.m,
+                          ef_construction=args.ef_construction,
+                          ef_runtime=args.ef_runtime,
+                          vector_type="FLOAT32")
+    start = time.perf_counter()
+    client.ft(name).create_index(
+        fields=[field],
+        definition=IndexDefinition(prefix=[PREFIX], index_type=IndexType.HASH))
+    while int(client.ft(name).info()["indexing"]) != 0:
+        time.sleep(0.5)
+    return time.perf_counter() - start
+
+
+def exact_top_k(vectors, queries, k, chunk=100_000):
+    # cosine similarity on unit vectors, scanned in chunks to bound memory
+    scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    ids = np.zeros((len(queries), k), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        sims = queries @ vectors[start:start + chunk].T
+        merged_scores = np.concatenate([scores, sims], axis=1)
+        merged_ids = np.concatenate(
+            [ids, np.broadcast_to(np.arange(start, start + sims.shape[1]), sims.shape)],
+            axis=1)
+        order = np.argsort(-merged_scores, axis=1)[:, :k]
+        scores = np.take_along_axis(merged_scores, order, axis=1)
+        ids = np.take_along_axis(merged_ids, order, axis=1)
+    return [set(row) for row in ids.tolist()]
+
+
+def run_queries(client, name, queries, k):
+    latencies = []
+    found = []
+    base = Query(f"*=>[KNN {k} @message_embedding $vector AS vector_score]") \
+        .sort_by("vector_score").return_fields("vector_score").paging(0, k).dialect(2)
+    for q in queries:
+        start = time.perf_counter()
+        res = client.ft(name).search(base, {"vector": q.tobytes()})
+        latencies.append(time.perf_counter() - start)
+        found.append({int(doc.id[len(PREFIX):]) for doc in res.docs})
+    return np.array(latencies) * 1000, found
+
+
+def recall(found, truth, k):
+    return float(np.mean([len(f & t) / k for f, t in zip(found, truth)]))
+
+
+def cleanup(client, names):
+    for name in names:
+        try:
+            client.ft(name).dropindex(delete_documents=False)
+        except redis.ResponseError:
+            pass
+    for keys in _scan_batches(client):
+        client.delete(*keys)
+
+
+def _scan_batches(client, count=10_000):
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor, match=f"{PREFIX}*", count=count)
+        if keys:
+            yield keys
+        if cursor == 0:
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--m", type=int, default=HNSW_M)
+    parser.add_argument("--ef-construction", type=int, default=HNSW_EF_CONSTRUCTION)
+    parser.add_argument("--ef-runtime", type=int, default=HNSW_EF_RUNTIME)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    client = redis.Redis(host=HOST, port=PORT, password=PASSWORD)
+    rng = np.random.default_rng(args.seed)
+    names = {"FLAT": "bench-flat", "HNSW": "bench-hnsw"}
+
+    print(f"{'size':>9} {'mode':>5} {'build s':>8} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'recall':>7}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        cleanup(client, names.values())
+        vectors = random_unit_vectors(size, args.dim, rng)
+        queries = random_unit_vectors(args.queries, args.dim, rng)
+        load(client, vectors)
+        truth = exact_top_k(vectors, queries, args.k)
+
+        try:
+            for mode, name in names.items():
+                build_time = build(client, name, mode, args.dim, args)
+                latencies, found = run_queries(client, name, queries, args.k)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+                print(f"{size:>9} {mode:>5} {build_time:>8.1f} {p50:>7.2f} {p95:>7.2f} "
+                      f"{p99:>7.2f} {recall(found, truth, args.k):>7.3f}")
+        finally:
+            cleanup(client, names.values())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Compares the memory the notes take in Redis in the old key layout, a hash
+per note plus a message_id pointer string and :text and :time strings
+duplicating it, and in the current one, a hash per note plus an entry in
+the user's bucketed message_id index.
+
+    python benchmarks/key_schema.py --notes 1000000 --users 1000
+
+Memory is the growth of used_memory from INFO while a layout is loaded,
+so it includes the per-key overhead of the keyspace, which MEMORY USAGE
+of the keys alone leaves out. The vectors are left out by default, they
+are the same size in both layouts. Everything the benchmark creates is
+removed at the end.
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+from uuid import uuid4
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cache import HOST, PORT, PASSWORD, INDEX_BUCKET_SIZE
+
+
+LAYOUTS = ["legacy", "compact"]
+
+
+def notes(n, users, text_len, dim, seed):
+    rng = random.Random(seed)
+    per_user = {}
+    for i in range(n):
+        user_id = 10_000_000 + i % users
+        # the bot's reply takes every other message_id
+        message_id = per_user.get(user_id, 0) + 2
+        per_user[user_id] = message_id
+        text = "".join(rng.choices(string.ascii_lowercase + " ", k=text_len))
+        vector = rng.randbytes(4 * dim) if dim else None
+        yield user_id, message_id, uuid4().hex, text, vector, time.time()
+
+
+def load(client, layout, rows, batch=1000):
+    pipe = client.pipeline(transaction=False)
+    for i, (user_id, message_id, msg_hash, text, vector, timestamp) in enumerate(rows):
+        key = f"bench:{layout}:message:<{user_id}><{msg_hash}>"
+        mapping = {"user_id": user_id, "message_id": message_id,
+                   "message": text, "timestamp": timestamp}
+        if vector is not None:
+            mapping["vector"] = vector
+        pipe.hset(key, mapping=mapping)
+        if layout == "legacy":
+            pointer = f"bench:{layout}:user_id:<{user_id}>msg_id:<{message_id}>"
+            pipe.set(pointer, key)
+            pipe.set(f"{pointer}:text", text)
+            pipe.set(f"{pointer}:time", timestamp)
+        else:
+            pipe.hset(f"bench:{layout}:msgidx:<{user_id}>:{message_id // INDEX_BUCKET_SIZE}",
+                      message_id, msg_hash)
+        if (i + 1) % batch == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def used_memory(client):
+    return client.info("memory")["used_memory"]
+
+
+def cleanup(client, pattern="bench:*"):
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor, match=pattern, count=10_000)
+        if keys:
+            # not UNLINK, the memory has to be freed before the next layout is measured
+            client.delete(*keys)
+        if cursor == 0:
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--text-len", type=int, default=200,
+                        help="characters per transcript")
+    parser.add_argument("--dim", type=int, default=0,
+                        help="add float32 vectors of this many dims to the hashes")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    client = redis.Redis(host=HOST, port=PORT, password=PASSWORD)
+    cleanup(client)
+    try:
+        print(f"{args.notes} notes of {args.users} users, {args.text_len} characters, "
+              f"{args.dim or 'no'} dim vectors, index buckets of {INDEX_BUCKET_SIZE} ids\n")
+        print(f"{'layout':>8} {'MB':>9} {'bytes/note':>11} {'keys':>10} {'load s':>7}")
+        for layout in LAYOUTS:
+            keys_before, memory_before = client.dbsize(), used_memory(client)
+            start = time.perf_counter()
+            load(client, layout, notes(args.notes, args.users, args.text_len,
+                                       args.dim, args.seed))
+            elapsed = time.perf_counter() - start
+            used = used_memory(client) - memory_before
+            keys = client.dbsize() - keys_before
+            print(f"{layout:>8} {used / 2**20:>9.1f} {used / args.notes:>11.0f} "
+                  f"{keys:>10} {elapsed:>7.1f}")
+            cleanup(client, f"bench:{layout}:*")
+    finally:
+        cleanup(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""
+Replays synthetic voice, text and /search traffic through the bot's real
+handlers, with local fakes standing in for the OpenAI and Telegram APIs,
+and reports handler latency percentiles, throughput and OpenAI calls per
+update.
+
+    python benchmarks/loadtest.py --users 50 --updates 20 --openai-latency 0.3
+
+Redis is the instance configured in [CACHE]. Point it at a throwaway
+instance: the run stores voice notes for the synthetic users.
+
+Voice messages are transcribed and saved by background jobs. "voice" is
+the time the handler takes to queue one, "transcript" the time until
+its transcript is shown. The run ends once the job queues are drained,
+so the throughput and OpenAI calls include the jobs' work. Run the job
+workers in the bot process ([JOBS] RUN_IN_BOT) or alongside the test.
+
+With --save the results are written as JSON, and --baseline compares a run
+against such a file and exits with an error if any p95 latency got worse
+by more than --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import openai
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot
+import chatgpt
+import jobs
+from cache import EMBEDDING_DIM, get_redis_client
+from voice_notes import JOB_HANDLERS
+from fakes import FakeOpenAI, FakeTelegram
+
+
+TOKEN = "123456:bench"
+# keeps the synthetic users apart from real ones in a shared Redis
+USER_ID_BASE = 900_000_000
+WORDS = ["groceries", "meeting", "idea", "project", "call", "doctor",
+         "birthday", "book", "travel", "draft", "budget", "recipe"]
+OPENAI_CALLS = ("chat", "embeddings", "transcriptions")
+# delayed by APPROVE_TIMEOUT, not waited for
+UNTRACKED_JOBS = ("remove_buttons",)
+
+
+class TimedApplication(Application):
+    """
+    Calls `on_processed` once the handlers are done with an update.
+    """
+
+    async def process_update(self, update):
+        try:
+            await super().process_update(update)
+        finally:
+            self.on_processed(update)
+
+
+class Traffic:
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.update_id = 0
+        self.message_id = 0
+
+    def _update(self, user_id, **fields):
+        self.update_id += 1
+        self.message_id += 1
+        message = {"message_id": self.message_id,
+                   "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"},
+                   "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+                   **fields}
+        return {"update_id": self.update_id, "message": message}
+
+    def _words(self, n):
+        return " ".join(self.rng.choice(WORDS) for _ in range(n))
+
+    def command(self, user_id, command, args=""):
+        text = f"/{command} {args}".strip()
+        return self._update(user_id, text=text,
+                            entities=[{"type": "bot_command", "offset": 0,
+                                       "length": len(command) + 1}])
+
+    def text(self, user_id):
+        return self._update(user_id, text=self._words(self.rng.randint(3, 20)))
+
+    def voice(self, user_id):
+        file_id = f"voice-{user_id}-{self.update_id}"
+        return self._update(user_id, voice={"file_id": file_id,
+                                            "file_unique_id": file_id,
+                                            "duration": 15,
+                                            "mime_type": "audio/ogg"})
+
+    def search(self, user_id):
+        return self.command(user_id, "search", self._words(self.rng.randint(1, 4)))
+
+
+class LoadTest:
+
+    def __init__(self, application, traffic):
+        self.application = application
+        self.traffic = traffic
+        self.latencies = {}
+        self._pending = {}
+        # (chat id, voice message id) -> time the voice message was sent
+        self._voice = {}
+        application.on_processed = self._processed
+        self._track_transcripts()
+
+    def _track_transcripts(self):
+        transcribe = JOB_HANDLERS["transcribe"]
+
+        async def timed(bot, payload):
+            await transcribe(bot, payload)
+            start = self._voice.pop((payload["chat_id"], payload["voice_message_id"]), None)
+            if start is not None:
+                self.latencies.setdefault("transcript", []).append(time.perf_counter() - start)
+
+        # the job workers look their handlers up in this dict
+        JOB_HANDLERS["transcribe"] = timed
+
+    def _processed(self, update):
+        kind, start, done = self._pending.pop(update.update_id)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+        done.set()
+
+    async def send(self, kind, data):
+        done = asyncio.Event()
+        update = Update.de_json(data, self.application.bot)
+        self._pending[update.update_id] = (kind, time.perf_counter(), done)
+        if kind == "voice":
+            self._voice[(update.effective_chat.id, update.message.message_id)] = \
+                self._pending[update.update_id][1]
+        await self.application.update_queue.put(update)
+        await done.wait()
+
+    async def user(self, user_id, kinds, think_time):
+        for kind in kinds:
+            await self.send(kind, getattr(self.traffic, kind)(user_id))
+            if think_time:
+                await asyncio.sleep(self.traffic.rng.uniform(0, think_time))
+
+
+async def drain(timeout, poll_interval=0.1):
+    """
+    Waits until the jobs the updates caused are done: their streams are
+    empty, no retry is scheduled and the worker in this process is idle.
+    """
+    client = get_redis_client()
+    kinds = [kind for kind in JOB_HANDLERS if kind not in UNTRACKED_JOBS]
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        pipe = client.pipeline(transaction=False)
+        for kind in kinds:
+            pipe.xlen(jobs.stream_key(kind))
+        pipe.zrange(jobs.DELAYED_KEY, 0, -1)
+        *lengths, delayed = await pipe.execute()
+        retries = [job for job in map(json.loads, delayed) if job["kind"] in kinds]
+        busy = bot._jobs is not None and bot._jobs[0]._running > 0
+        if not any(lengths) and not retries and not busy:
+            return True
+        await asyncio.sleep(poll_interval)
+    return False
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        kind, weight = item.split("=")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+def summarize(latencies, wall, openai_calls, telegram_calls, errors, ttft):
+    total = sum(len(v) for v in latencies.values())
+    report = {"updates": total,
+              "wall_s": wall,
+              "updates_per_s": total / wall if wall else 0.,
+              "openai_calls_per_update": sum(openai_calls[k] for k in OPENAI_CALLS) / max(total, 1),
+              "openai_calls": {k: openai_calls[k] for k in OPENAI_CALLS},
+              "telegram_calls_per_update": sum(telegram_calls.values()) / max(total, 1),
+              "errors": errors,
+              "latency_ms": {}}
+    everything = [x for v in latencies.values() for x in v]
+    for kind, values in [*latencies.items(), ("all", everything)]:
+        p50, p95, p99 = np.percentile(np.array(values) * 1000, [50, 95, 99])
+        report["latency_ms"][kind] = {"count": len(values), "p50": p50, "p95": p95, "p99": p99}
+    if ttft:
+        p50, p95, p99 = np.percentile(np.array(ttft) * 1000, [50, 95, 99])
+        report["ttft_ms"] = {"count": len(ttft), "p50": p50, "p95": p95, "p99": p99}
+    return report
+
+
+def print_report(report):
+    print(f"{'kind':>8} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for kind, row in report["latency_ms"].items():
+        print(f"{kind:>8} {row['count']:>7} {row['p50']:>9.1f} {row['p95']:>9.1f} {row['p99']:>9.1f}")
+    if "ttft_ms" in report:
+        row = report["ttft_ms"]
+        print(f"{'ttft':>8} {row['count']:>7} {row['p50']:>9.1f} {row['p95']:>9.1f} {row['p99']:>9.1f}")
+    print(f"\n{report['updates']} updates in {report['wall_s']:.2f}s, "
+          f"{report['updates_per_s']:.1f} updates/s")
+    print(f"OpenAI calls per update: {report['openai_calls_per_update']:.2f} "
+          f"{report['openai_calls']}")
+    print(f"Telegram calls per update: {report['telegram_calls_per_update']:.2f}")
+    print(f"Handler errors: {report['errors']}")
+
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for kind, row in baseline["latency_ms"].items():
+        current = report["latency_ms"].get(kind)
+        if current is not None and current["p95"] > row["p95"] * (1 + tolerance):
+            regressions.append(f"{kind}: p95 {row['p95']:.1f}ms -> {current['p95']:.1f}ms")
+    return regressions
+
+
+async def run(args):
+    openai_fake = await FakeOpenAI(embedding_dim=int(EMBEDDING_DIM),
+                                   latency=args.openai_latency,
+                                   jitter=args.openai_jitter,
+                                   error_rate=args.openai_error_rate,
+                                   seed=args.seed).start()
+    telegram_fake = await FakeTelegram(TOKEN,
+                                       voice_minutes=args.voice_minutes,
+                                       latency=args.telegram_latency,
+                                       jitter=args.telegram_jitter,
+                                       error_rate=args.telegram_error_rate,
+                                       seed=args.seed).start()
+    openai.api_base = openai_fake.api_base
+
+    application = ApplicationBuilder() \
+        .application_class(TimedApplication) \
+        .token(TOKEN) \
+        .base_url(telegram_fake.base_url) \
+        .base_file_url(telegram_fake.base_file_url) \
+        .concurrent_updates(bot.ChatOrderedUpdateProcessor(args.concurrent_updates)) \
+        .updater(None) \
+        .build()
+    bot.add_handlers(application)
+
+    errors = []
+
+    async def on_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(on_error)
+
+    traffic = Traffic(args.seed)
+    load = LoadTest(application, traffic)
+    weights = parse_mix(args.mix)
+    users = [USER_ID_BASE + i for i in range(args.users)]
+    plans = {user_id: traffic.rng.choices(list(weights), list(weights.values()), k=args.updates)
+             for user_id in users}
+
+    await application.initialize()
+    await bot.startup(application)
+    await application.start()
+    try:
+        # users that chat have to be in a ChatGPT conversation first
+        await asyncio.gather(*[load.send("startgpt", traffic.command(user_id, "startgpt"))
+                               for user_id, kinds in plans.items() if "text" in kinds])
+        load.latencies.clear()
+        chatgpt.ttft_samples.clear()
+        errors.clear()
+        openai_fake.calls.clear()
+        telegram_fake.calls.clear()
+
+        start = time.perf_counter()
+        await asyncio.gather(*[load.user(user_id, kinds, args.think_time)
+                               for user_id, kinds in plans.items()])
+        if not await drain(args.drain_timeout):
+            print(f"Jobs still queued after {args.drain_timeout:g}s, "
+                  f"the results leave them out")
+        wall = time.perf_counter() - start
+    finally:
+        await application.stop()
+        await bot.shutdown(application)
+        await application.shutdown()
+        await openai_fake.stop()
+        await telegram_fake.stop()
+
+    telegram_calls = {k: v for k, v in telegram_fake.calls.items() if k != "errors"}
+    return summarize(load.latencies, wall, openai_fake.calls, telegram_calls, len(errors),
+                     list(chatgpt.ttft_samples))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--updates", type=int, default=10, help="updates per user")
+    parser.add_argument("--mix", default="voice=0.5,text=0.3,search=0.2")
+    parser.add_argument("--think-time", type=float, default=0.,
+                        help="max random pause between a user's updates, seconds")
+    parser.add_argument("--concurrent-updates", type=int, default=bot.CONCURRENT_UPDATES)
+    parser.add_argument("--voice-minutes", type=float, default=0.25)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--openai-jitter", type=float, default=0.1)
+    parser.add_argument("--openai-error-rate", type=float, default=0.)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--telegram-jitter", type=float, default=0.01)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.)
+    parser.add_argument("--drain-timeout", type=float, default=300,
+                        help="seconds to wait for the background jobs after the traffic")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p95 increase over the baseline, as a fraction")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:")
+            print("\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Measures what it costs to persist the data of the users that were active
+since the last flush, as the total number of users grows, for
+PicklePersistence and RedisPersistence.
+
+    python benchmarks/persistence.py --users 100 1000 10000 100000 --active 20
+
+Each round changes the user_data of --active users and then writes it the
+way the application does every update interval: update_user_data for each
+of them, then flush(). Redis is the instance configured in [CACHE], the
+benchmark's keys are removed at the end.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+from telegram.ext import PicklePersistence
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cache import init_redis_pool, close_redis_pool
+from persistence import RedisPersistence, PREFIX
+
+
+def user_data(rng, user_id):
+    return {"chat_gpt": rng.random() < 0.5,
+            "gpt_role": rng.choice([None, "You are a helpful assistant."]),
+            "notes": [f"note {user_id}-{i}" for i in range(rng.randint(0, 20))]}
+
+
+async def populate(persistence, users, rng):
+    for user_id in range(users):
+        await persistence.update_user_data(user_id, user_data(rng, user_id))
+    await persistence.flush()
+
+
+async def rounds(persistence, users, active, n, rng):
+    timings = []
+    for _ in range(n):
+        changed = {user_id: user_data(rng, user_id) for user_id in rng.sample(range(users), active)}
+        start = time.perf_counter()
+        for user_id, data in changed.items():
+            await persistence.update_user_data(user_id, data)
+        await persistence.flush()
+        timings.append(time.perf_counter() - start)
+    return np.array(timings) * 1000
+
+
+async def cleanup(client):
+    async for key in client.scan_iter(match=f"{PREFIX}:user:*", count=10_000):
+        await client.delete(key)
+
+
+async def run(args):
+    client = await init_redis_pool()
+    print(f"{'users':>8} {'persistence':>12} {'p50 ms':>8} {'p95 ms':>8}")
+    try:
+        for users in args.users:
+            with tempfile.TemporaryDirectory() as tmp:
+                candidates = {
+                    "pickle": PicklePersistence(os.path.join(tmp, "bench.pickle"), on_flush=True),
+                    "redis": RedisPersistence(client=client),
+                }
+                for name, persistence in candidates.items():
+                    rng = random.Random(args.seed)
+                    await cleanup(client)
+                    await populate(persistence, users, rng)
+                    latencies = await rounds(persistence, users, args.active, args.rounds, rng)
+                    p50, p95 = np.percentile(latencies, [50, 95])
+                    print(f"{users:>8} {name:>12} {p50:>8.2f} {p95:>8.2f}")
+    finally:
+        await cleanup(client)
+        await close_redis_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 10_000, 100_000])
+    parser.add_argument("--active", type=int, default=20, help="users changed per flush")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Compares the memory used by float32, float16 and int8 vectors in Redis and
+the recall@k of searches over them, with and without the exact re-rank of
+the top k * RERANK_FACTOR candidates from the full-precision vectors.
+
+    python benchmarks/quantization.py --notes 50000 --dim 1536
+
+The vectors are drawn around a number of cluster centres, so that near
+neighbours are close the way embeddings of related notes are. Recall is
+measured against an exact numpy search over the float32 vectors. Memory
+is the MEMORY USAGE of the hashes plus the index size from FT.INFO.
+Everything the benchmark creates is removed at the end.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import redis
+from redis.commands.search.field import TagField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cache import HOST, PORT, PASSWORD, INDEX_TYPE, DISTANCE_METRIC, RERANK_FACTOR
+from cache import VECTOR_FIELDS, _vector_field, _distances, encode_vector
+
+
+TYPES = ["FLOAT32", "FLOAT16", "INT8"]
+
+
+def clustered(n, dim, clusters, spread, rng):
+    centres = rng.standard_normal((clusters, dim), dtype=np.float32)
+    vectors = centres[rng.integers(0, clusters, n)] \
+        + spread * rng.standard_normal((n, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load(client, vector_type, vectors, batch=1000):
+    pipe = client.pipeline(transaction=False)
+    for i, vector in enumerate(vectors):
+        pipe.hset(f"bench:{vector_type.lower()}:{i}",
+                  mapping={"user_id": 0,
+                           VECTOR_FIELDS[vector_type]: encode_vector(vector, vector_type)})
+        if (i + 1) % batch == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def build(client, vector_type, dim):
+    name = f"bench-{vector_type.lower()}"
+    client.ft(name).create_index(
+        fields=[TagField("user_id"),
+                _vector_field(INDEX_TYPE, dim, DISTANCE_METRIC, vector_type=vector_type)],
+        definition=IndexDefinition(prefix=[f"bench:{vector_type.lower()}:"],
+                                   index_type=IndexType.HASH))
+    while int(client.ft(name).info()["indexing"]) != 0:
+        time.sleep(0.2)
+    return name
+
+
+def memory(client, vector_type, n, sample=1000):
+    keys = [f"bench:{vector_type.lower()}:{i}" for i in range(0, n, max(n // sample, 1))]
+    hashes = np.mean([client.memory_usage(key, samples=0) for key in keys]) * n
+    index = float(client.ft(f"bench-{vector_type.lower()}").info()["vector_index_sz_mb"]) * 2**20
+    return hashes, index
+
+
+def search(client, vector_type, query, n):
+    field = VECTOR_FIELDS[vector_type]
+    q = Query(f"(@user_id:{{0}})=>[KNN {n} @{field} $vector AS vector_score]") \
+        .return_fields("vector_score").sort_by("vector_score").paging(0, n).dialect(2)
+    start = time.perf_counter()
+    res = client.ft(f"bench-{vector_type.lower()}").search(
+        q, {"vector": encode_vector(query, vector_type)})
+    return time.perf_counter() - start, [int(doc.id.rsplit(":", 1)[1]) for doc in res.docs]
+
+
+def rerank(ids, query, vectors, k):
+    distances = _distances(query, vectors[ids])
+    return [ids[i] for i in np.argsort(distances)[:k]]
+
+
+def cleanup(client):
+    for vector_type in TYPES:
+        try:
+            client.ft(f"bench-{vector_type.lower()}").dropindex(delete_documents=False)
+        except redis.ResponseError:
+            pass
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor, match="bench:*", count=10_000)
+        if keys:
+            client.delete(*keys)
+        if cursor == 0:
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--notes", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--spread", type=float, default=0.3)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank-factor", type=int, default=RERANK_FACTOR)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    client = redis.Redis(host=HOST, port=PORT, password=PASSWORD)
+    rng = np.random.default_rng(args.seed)
+    vectors = clustered(args.notes, args.dim, args.clusters, args.spread, rng)
+    queries = clustered(args.queries, args.dim, args.clusters, args.spread, rng)
+    truth = [set(np.argsort(_distances(q, vectors))[:args.k]) for q in queries]
+
+    cleanup(client)
+    try:
+        print(f"{args.notes} vectors of {args.dim} dims, {INDEX_TYPE} index, k={args.k}\n")
+        print(f"{'type':>8} {'hashes MB':>10} {'index MB':>9} {'recall':>7} "
+              f"{'reranked':>9} {'p50 ms':>7}")
+        for vector_type in TYPES:
+            load(client, vector_type, vectors)
+            build(client, vector_type, args.dim)
+            hashes, index = memory(client, vector_type, args.notes)
+
+            plain, reranked, latencies = [], [], []
+            for query, expected in zip(queries, truth):
+                elapsed, ids = search(client, vector_type, query, args.k * args.rerank_factor)
+                latencies.append(elapsed * 1000)
+                plain.append(len(expected & set(ids[:args.k])) / args.k)
+                reranked.append(len(expected & set(rerank(ids, query, vectors, args.k))) / args.k)
+
+            rerank_recall = "-" if vector_type == "FLOAT32" else f"{np.mean(reranked):.3f}"
+            print(f"{vector_type:>8} {hashes / 2**20:>10.1f} {index / 2**20:>9.1f} "
+                  f"{np.mean(plain):>7.3f} {rerank_recall:>9} {np.median(latencies):>7.2f}")
+    finally:
+        cleanup(client)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Measures the cold start of the bot: how long importing a module takes in
+a fresh interpreter, which of the heavy dependencies it pulls in, and the
+modules that take longest to import.
+
+    python benchmarks/startup.py --module bot --repeat 10
+
+Every run is a new process, so nothing is cached in memory between them,
+though the operating system's file cache stays warm after the first one.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+HEAVY = ["openai", "numpy", "soundfile", "tiktoken", "pandas",
+         "redis.commands.search.query"]
+
+MEASURE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+def import_time(module):
+    out = subprocess.run([sys.executable, "-c", MEASURE.format(module=module, heavy=HEAVY)],
+                         cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    elapsed, loaded = out.splitlines()
+    return float(elapsed), [name for name in loaded.split(",") if name]
+
+
+def slowest_imports(module, n):
+    # -X importtime writes "self us | cumulative us | module" lines to stderr
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         cwd=ROOT, capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:n]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="bot")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15,
+                        help="how many of the slowest imports to list")
+    args = parser.parse_args()
+
+    timings = []
+    for _ in range(args.repeat):
+        elapsed, loaded = import_time(args.module)
+        timings.append(elapsed)
+    print(f"import {args.module}: median {statistics.median(timings) * 1000:.0f} ms, "
+          f"min {min(timings) * 1000:.0f} ms, max {max(timings) * 1000:.0f} ms "
+          f"over {args.repeat} runs")
+    print(f"heavy modules loaded: {', '.join(loaded) or 'none'}")
+
+    print(f"\n{'cumulative ms':>14}  module")
+    for cumulative, name in slowest_imports(args.module, args.top):
+        print(f"{cumulative / 1000:>14.1f}  {name}")
+
+
+if __name__ == '__main__':
+    main()
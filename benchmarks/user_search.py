@@ -0,0 +1,149 @@
+"""
+Measures how per-user search latency depends on the user's own note count
+and on the size of the whole corpus, for the three ways of scoping a search
+to one user:
+
+  numeric   global index, KNN over everybody then a user_id NumericFilter
+            (the original behaviour)
+  tag       global index, user_id TAG prefilter inside the KNN clause
+  user      one index per user
+
+    python benchmarks/user_search.py --users 2000 --notes 200000 --dim 256
+
+Note counts per user follow a Zipf distribution, so a few users own most of
+the corpus. Results are grouped by the user's note count. Everything the
+benchmark creates is removed at the end.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import redis
+from redis.commands.search.field import NumericField, TagField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query, NumericFilter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from cache import HOST, PORT, PASSWORD, INDEX_TYPE, DISTANCE_METRIC, _vector_field
+
+
+PREFIX = "bench:msg"
+BUCKETS = [1, 10, 100, 1000, 10_000, 100_000]
+
+
+def note_counts(users, notes, skew, rng):
+    weights = 1 / np.arange(1, users + 1) ** skew
+    counts = rng.multinomial(notes - users, weights / weights.sum()) + 1
+    return counts
+
+
+def load(client, counts, dim, rng, batch=1000):
+    pipe = client.pipeline(transaction=False)
+    n = 0
+    for user_id, count in enumerate(counts):
+        vectors = rng.standard_normal((count, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        for i, vector in enumerate(vectors):
+            pipe.hset(f"{PREFIX}:<{user_id}><{i}>",
+                      mapping={"user_id": user_id,
+                               "user_num": user_id,
+                               "message_embedding": vector.tobytes()})
+            n += 1
+            if n % batch == 0:
+                pipe.execute()
+    pipe.execute()
+
+
+def wait(client, name):
+    while int(client.ft(name).info()["indexing"]) != 0:
+        time.sleep(0.2)
+
+
+def build(client, name, prefix, dim):
+    client.ft(name).create_index(
+        fields=[TagField("user_id"),
+                NumericField("user_num"),
+                # the vectors are loaded as float32 whatever VECTOR_TYPE is
+                _vector_field(INDEX_TYPE, dim, DISTANCE_METRIC, vector_type="FLOAT32")],
+        definition=IndexDefinition(prefix=[prefix], index_type=IndexType.HASH))
+    wait(client, name)
+
+
+def search(client, mode, user_id, vector, k):
+    knn = f"=>[KNN {k} @message_embedding $vector AS vector_score]"
+    if mode == "numeric":
+        name = "bench-global"
+        query = Query(f"*{knn}").add_filter(NumericFilter("user_num", user_id, user_id))
+    elif mode == "tag":
+        name = "bench-global"
+        query = Query(f"(@user_id:{{{user_id}}}){knn}")
+    else:
+        name = f"bench-user:{user_id}"
+        query = Query(f"*{knn}")
+    query = query.sort_by("vector_score").return_fields("vector_score").paging(0, k).dialect(2)
+    start = time.perf_counter()
+    res = client.ft(name).search(query, {"vector": vector.tobytes()})
+    return time.perf_counter() - start, len(res.docs)
+
+
+def cleanup(client, users):
+    for name in ["bench-global"] + [f"bench-user:{u}" for u in range(users)]:
+        try:
+            client.ft(name).dropindex(delete_documents=False)
+        except redis.ResponseError:
+            pass
+    cursor = 0
+    while True:
+        cursor, keys = client.scan(cursor, match=f"{PREFIX}:*", count=10_000)
+        if keys:
+            client.delete(*keys)
+        if cursor == 0:
+            break
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--notes", type=int, default=200_000)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--queries-per-bucket", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    client = redis.Redis(host=HOST, port=PORT, password=PASSWORD)
+    rng = np.random.default_rng(args.seed)
+    counts = note_counts(args.users, args.notes, args.skew, rng)
+
+    cleanup(client, args.users)
+    try:
+        load(client, counts, args.dim, rng)
+        build(client, "bench-global", f"{PREFIX}:", args.dim)
+        for user_id in range(args.users):
+            build(client, f"bench-user:{user_id}", f"{PREFIX}:<{user_id}>", args.dim)
+
+        print(f"{args.notes} notes, {args.users} users, {INDEX_TYPE} index\n")
+        print(f"{'user notes':>12} {'mode':>8} {'p50 ms':>8} {'p95 ms':>8} {'hits/k':>7}")
+        for low, high in zip(BUCKETS, BUCKETS[1:]):
+            users = np.flatnonzero((counts >= low) & (counts < high))
+            if len(users) == 0:
+                continue
+            picked = rng.choice(users, size=args.queries_per_bucket)
+            queries = rng.standard_normal((len(picked), args.dim), dtype=np.float32)
+            for mode in ("numeric", "tag", "user"):
+                timings = [search(client, mode, int(u), q, args.k) for u, q in zip(picked, queries)]
+                latencies = np.array([t for t, _ in timings]) * 1000
+                hits = np.mean([min(n, args.k) / min(args.k, counts[u])
+                                for (_, n), u in zip(timings, picked)])
+                p50, p95 = np.percentile(latencies, [50, 95])
+                print(f"{f'{low}-{high - 1}':>12} {mode:>8} {p50:>8.2f} {p95:>8.2f} {hits:>7.2f}")
+    finally:
+        cleanup(client, args.users)
+
+
+if __name__ == '__main__':
+    main()
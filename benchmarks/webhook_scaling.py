@@ -0,0 +1,141 @@
+"""
+Measures how webhook throughput scales with the number of worker
+processes. Synthetic voice updates are posted to a WebhookReceiver the way
+Telegram would, and the run ends when every update has been handled, which
+the fake Telegram server sees as the final deleteMessage of each one.
+
+    python benchmarks/webhook_scaling.py --workers 1 2 4 8 --users 200 --updates 5
+
+Redis is the instance configured in [CACHE]. Point it at a throwaway
+instance: the run stores voice notes for the synthetic users.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import bot
+from cache import EMBEDDING_DIM, init_redis_pool, close_redis_pool
+from fakes import FakeOpenAI, FakeTelegram
+from loadtest import Traffic, TOKEN, USER_ID_BASE
+from webhook import WebhookReceiver, stream_key, PATH
+
+
+async def post(port, bodies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        for body in bodies:
+            writer.write(f"POST {PATH} HTTP/1.1\r\n"
+                         "Host: 127.0.0.1\r\n"
+                         "Content-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            status = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            if b" 200 " not in status:
+                raise RuntimeError(f"Receiver answered {status.decode().strip()}")
+    finally:
+        writer.close()
+
+
+async def wait_for(condition, timeout, interval=0.05):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError
+        await asyncio.sleep(interval)
+
+
+async def run_once(workers, args, openai_fake, telegram_fake):
+    client = await init_redis_pool()
+    await client.delete(*[stream_key(shard) for shard in range(max(args.workers))])
+
+    receiver = await WebhookReceiver(client, workers, secret_token="").start("127.0.0.1", 0)
+    port = receiver.port
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=bot.run_worker,
+                                 args=(shard, TOKEN, telegram_fake.base_url,
+                                       telegram_fake.base_file_url))
+                 for shard in range(workers)]
+    telegram_fake.calls.clear()
+    for process in processes:
+        process.start()
+    try:
+        # every worker calls getMe once it is up
+        await wait_for(lambda: telegram_fake.calls["getMe"] >= workers, timeout=60)
+        telegram_fake.calls.clear()
+        openai_fake.calls.clear()
+
+        traffic = Traffic(args.seed)
+        users = [USER_ID_BASE + i for i in range(args.users)]
+        bodies = [json.dumps(traffic.voice(user_id)).encode()
+                  for _ in range(args.updates) for user_id in users]
+        connections = [bodies[i::args.connections] for i in range(args.connections)]
+
+        start = time.perf_counter()
+        await asyncio.gather(*[post(port, chunk) for chunk in connections])
+        received = time.perf_counter() - start
+        await wait_for(lambda: telegram_fake.calls["deleteMessage"] >= len(bodies),
+                       timeout=args.timeout)
+        wall = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        await receiver.stop()
+        await close_redis_pool()
+    return len(bodies), received, wall
+
+
+async def run(args):
+    openai_fake = await FakeOpenAI(embedding_dim=int(EMBEDDING_DIM),
+                                   latency=args.openai_latency,
+                                   seed=args.seed).start()
+    telegram_fake = await FakeTelegram(TOKEN,
+                                       voice_minutes=args.voice_minutes,
+                                       latency=args.telegram_latency,
+                                       seed=args.seed).start()
+    # read by the openai package when the spawned workers import it
+    os.environ["OPENAI_API_BASE"] = openai_fake.api_base
+
+    print(f"{'workers':>8} {'updates':>8} {'enqueue s':>10} {'wall s':>8} "
+          f"{'updates/s':>10} {'speedup':>8}")
+    base = None
+    try:
+        for workers in args.workers:
+            n, received, wall = await run_once(workers, args, openai_fake, telegram_fake)
+            rate = n / wall
+            base = base or rate
+            print(f"{workers:>8} {n:>8} {received:>10.2f} {wall:>8.2f} "
+                  f"{rate:>10.1f} {rate / base:>8.2f}")
+    finally:
+        await openai_fake.stop()
+        await telegram_fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--updates", type=int, default=5, help="updates per user")
+    parser.add_argument("--connections", type=int, default=8,
+                        help="connections the fake sender posts updates over")
+    parser.add_argument("--voice-minutes", type=float, default=0.25)
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--telegram-latency", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
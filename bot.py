@@ -1,29 +1,46 @@
-import os
+import argparse
+import asyncio
+import contextlib
+import multiprocessing
 import re
+import signal
 
 
 import logging
 
-from telegram import Update
+from telegram import Update, Bot
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler
-from telegram.ext import filters, MessageHandler, PicklePersistence
+from telegram.ext import filters, MessageHandler
 from telegram.ext import CallbackQueryHandler
-
-from _openai import clean_audio_cache
+from telegram.ext import BaseUpdateProcessor
 
 from utils import get_config, _
 from voice_notes import inline_button, process_voice
-from cache import get_redis_client, create_index
-from search import search_query
+from voice_notes import JOB_HANDLERS, JOB_FAILURE_HANDLERS
+from jobs import JobWorker, RUN_IN_BOT
+from retry import CircuitOpen
+from cache import bootstrap_index
+from cache import init_redis_pool, close_redis_pool
+from search import show_results, search_page, CALLBACK_PREFIX
 from chatgpt import get_start_gpt_kb, start_gpt, chat_gpt, end_gpt
+from persistence import RedisPersistence
+import metrics
+import watchdog
+from webhook import WebhookReceiver, StreamWorker
+from webhook import LISTEN, PORT, URL, SECRET_TOKEN, WORKERS, WORKER_CONCURRENCY
 
 
 config = get_config()
 
-PERSIST_FILE = config["MAIN"]["PERSIST_FILE"]
-
 BOT_TOKEN = config["MAIN"]["BOT_TOKEN"]
 
+# how many updates the application handles at once, a chat's updates are
+# always handled one at a time; 1 handles all of them in arrival order
+CONCURRENT_UPDATES = config.getint("MAIN", "CONCURRENT_UPDATES", fallback=16)
+# user ids allowed to use the admin commands, comma separated
+ADMINS = {int(user_id) for user_id in
+          config.get("MAIN", "ADMINS", fallback="").replace(",", " ").split()}
+
 
 
 MIN_TEXT_LEN = 150
@@ -35,6 +52,54 @@ logging.basicConfig(
 )
 
 
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles up to `max_concurrent_updates` updates at once, but the
+    updates of each chat strictly one after another in the order they
+    arrived, so a slow transcription or reply only holds up its own chat.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # chat id -> [lock, number of updates holding or waiting for it]
+        self._chats = {}
+
+    @contextlib.asynccontextmanager
+    async def _chat_turn(self, update):
+        chat_id = None
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                chat_id = update.effective_chat.id
+            elif update.effective_user is not None:
+                chat_id = update.effective_user.id
+        chat = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            async with chat[0]:
+                yield
+        finally:
+            chat[1] -= 1
+            if chat[1] == 0:
+                del self._chats[chat_id]
+
+    async def process_update(self, update, coroutine):
+        # the chat's turn comes before a slot, so updates queued behind
+        # their chat's previous one don't take slots from other chats.
+        # The application starts a task per update in arrival order and
+        # the locks are fair, which keeps each chat's updates in order
+        async with self._chat_turn(update):
+            await super().process_update(update, coroutine)
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
 def reset_context(context):
     context.user_data["chat_gpt"] = False
     context.user_data["gpt_role"] = None
@@ -47,9 +112,6 @@ def reset_context(context):
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reset_context(context)
 
-    # just in case we have some leftover data in the temp cache
-    clean_audio_cache()
-
     reply_markup = get_start_gpt_kb()
     await context.bot.send_message(chat_id=update.effective_chat.id, 
                                    text=_("Hi! I am a personal assitant bot. I "
@@ -69,40 +131,127 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if m:
         query = m.group(1).strip()
         if len(query) > 0:
-            results = await search_query(update.effective_user.id, query)
-            print (results)
+            await show_results(update, context, query)
+            return
+    await context.bot.send_message(chat_id=update.effective_chat.id,
+                                   text=_("Send /search followed by what you "
+                                          "are looking for."))
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMINS:
+        return
+    seconds = watchdog.PROFILE_SECONDS
+    if context.args:
+        try:
+            seconds = min(float(context.args[0]), 300)
+        except ValueError:
+            pass
+    await context.bot.send_message(chat_id=update.effective_chat.id,
+                                   text=f"Profiling for {seconds:g}s...")
+    # in the background, the chat's next updates wait for this handler
+    context.application.create_task(_send_profile(context.bot, update.effective_chat.id,
+                                                  seconds),
+                                    update=update)
+
 
+async def _send_profile(bot, chat_id, seconds):
+    path, top = await watchdog.profile(seconds)
+    lines = [f"{share * 100:5.1f}% {frame}" for frame, share in top]
+    with open(path, "rb") as f:
+        await bot.send_document(chat_id=chat_id, document=f,
+                                caption="\n".join(lines)[:1024])
 
-async def setup_commands(app):
-    await app.bot.set_my_commands([
+
+async def setup_commands(bot):
+    await bot.set_my_commands([
         ('startgpt', 'Starts a conversation with ChatGPT'),
         ('endgpt', 'Ends a conversation with ChatGPT'),
+        ('search', 'Searches your voice notes'),
         ('start', '(Re)starts the bot'),
     ])
 
+_jobs = None
+
+
+def start_jobs(bot, kinds=None):
+    global _jobs
+    worker = JobWorker(JOB_HANDLERS, bot, kinds, failure_handlers=JOB_FAILURE_HANDLERS)
+    _jobs = worker, asyncio.create_task(worker.run())
+
+
+async def stop_jobs():
+    global _jobs
+    if _jobs is not None:
+        worker, task = _jobs
+        worker.stop()
+        await task
+        _jobs = None
+
+
+_metrics_server = None
+_watchdog = None
+
+
+async def start_monitoring(port=metrics.PORT):
+    global _metrics_server, _watchdog
+    _metrics_server = await metrics.start_server(port=port)
+    _watchdog = watchdog.start()
+
+
+async def stop_monitoring():
+    global _metrics_server, _watchdog
+    if _watchdog is not None:
+        await _watchdog.stop()
+        _watchdog = None
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
+
+
 async def startup(app):
-    await setup_commands(app)
-    
+    await start_monitoring()
+    client = await init_redis_pool()
+    # polling starts while the index is checked, searches wait for it
+    bootstrap_index(client)
+    app.create_task(setup_commands(app.bot))
+    if RUN_IN_BOT:
+        start_jobs(app.bot)
 
-if __name__ == '__main__':
 
-    try:
-        os.remove(PERSIST_FILE)
-    except FileNotFoundError:
-        pass
+async def shutdown(app):
+    await stop_jobs()
+    await close_redis_pool()
+    await stop_monitoring()
+
 
-    redis_client = get_redis_client()
-    create_index(redis_client)
+UNAVAILABLE = {
+    "openai": _("The AI service is not responding at the moment, "
+                "please try again in a minute."),
+    "redis": _("Your notes are unavailable at the moment, "
+               "please try again in a minute."),
+}
 
-    persistence = PicklePersistence(PERSIST_FILE)
-    application = ApplicationBuilder().persistence(persistence). \
-        token(BOT_TOKEN).post_init(startup).build()
 
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    if isinstance(context.error, CircuitOpen) and isinstance(update, Update) \
+            and update.effective_chat is not None and context.error.name in UNAVAILABLE:
+        await context.bot.send_message(chat_id=update.effective_chat.id,
+                                       text=UNAVAILABLE[context.error.name])
+        return
+    logging.getLogger(__name__).error("Error handling an update", exc_info=context.error)
+
+
+def add_handlers(application):
+    search_page_handler = CallbackQueryHandler(search_page,
+                                               pattern=f"^{CALLBACK_PREFIX}")
     inline_handler = CallbackQueryHandler(inline_button)
 
     start_handler = CommandHandler("start", start)
 
     search_handler = CommandHandler("search", search_command)
+    profile_handler = CommandHandler("profile", profile_command)
 
     endgpt_handler = CommandHandler("endgpt", end_gpt)
     startgpt_handler = CommandHandler("startgpt", start_gpt)
@@ -113,6 +262,7 @@ if __name__ == '__main__':
     application.add_handler(start_handler)
 
     application.add_handler(search_handler)
+    application.add_handler(profile_handler)
 
     application.add_handler(endgpt_handler)
     application.add_handler(stopgpt_handler)
@@ -122,6 +272,143 @@ if __name__ == '__main__':
 
     voice_handler = MessageHandler(filters.VOICE, process_voice)
     application.add_handler(voice_handler)
+    application.add_handler(search_page_handler)
     application.add_handler(inline_handler)
-    
-    application.run_polling()
+
+    application.add_error_handler(on_error)
+
+
+async def _run_worker(application, shard):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # the receiver serves on PORT, each worker on the ports after it
+    await start_monitoring(metrics.PORT + 1 + shard)
+    await application.initialize()
+    client = await init_redis_pool()
+    await application.start()
+    if RUN_IN_BOT:
+        start_jobs(application.bot)
+    try:
+        await StreamWorker(application, client, shard,
+                           concurrency=WORKER_CONCURRENCY).run(stop)
+    finally:
+        await stop_jobs()
+        await application.stop()
+        await application.shutdown()
+        await close_redis_pool()
+        await stop_monitoring()
+
+
+def run_worker(shard, token=BOT_TOKEN, base_url=None, base_file_url=None):
+    """
+    Runs one webhook worker, handling the updates of its shard.
+    """
+    builder = ApplicationBuilder().persistence(RedisPersistence()).token(token).updater(None)
+    if base_url is not None:
+        builder = builder.base_url(base_url).base_file_url(base_file_url)
+    application = builder.build()
+    add_handlers(application)
+    asyncio.run(_run_worker(application, shard))
+
+
+def _start_worker(shard):
+    process = multiprocessing.Process(target=run_worker, args=(shard,), daemon=True)
+    process.start()
+    return process
+
+
+async def _supervise(processes, interval=1.):
+    # a shard without a worker would keep receiving updates nobody handles
+    while True:
+        await asyncio.sleep(interval)
+        for shard, process in enumerate(processes):
+            if not process.is_alive():
+                logging.getLogger(__name__).error(
+                    "Worker of shard %d exited with %s, restarting it", shard, process.exitcode)
+                processes[shard] = _start_worker(shard)
+
+
+async def _run_receiver(processes, token=BOT_TOKEN, listen=LISTEN, port=PORT, url=URL):
+    workers = len(processes)
+    await start_monitoring()
+    client = await init_redis_pool()
+    bootstrap_index(client)
+    async with Bot(token) as bot:
+        # the webhook replaces polling, the workers never fetch updates
+        await bot.set_webhook(url, secret_token=SECRET_TOKEN or None)
+        await setup_commands(bot)
+    receiver = await WebhookReceiver(client, workers).start(listen, port)
+    print(f"Receiving updates on {listen}:{port} for {workers} workers")
+    supervisor = asyncio.create_task(_supervise(processes))
+    try:
+        await receiver.serve_forever()
+    finally:
+        supervisor.cancel()
+        await close_redis_pool()
+        await stop_monitoring()
+
+
+def run_webhook(workers=WORKERS):
+    """
+    Receives updates through the webhook and hands them to `workers`
+    worker processes, each of them handling the chats of one shard.
+    """
+    processes = [_start_worker(shard) for shard in range(workers)]
+    try:
+        asyncio.run(_run_receiver(processes))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+
+async def _run_jobs(kinds, token=BOT_TOKEN, metrics_port=metrics.PORT):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await start_monitoring(metrics_port)
+    await init_redis_pool()
+    async with Bot(token) as bot:
+        start_jobs(bot, kinds)
+        await stop.wait()
+        await stop_jobs()
+    await close_redis_pool()
+    await stop_monitoring()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--webhook", action="store_true",
+                        help="receive updates through a webhook instead of polling")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="worker processes in webhook mode")
+    parser.add_argument("--jobs", action="store_true",
+                        help="only run background jobs, for scaling them separately")
+    parser.add_argument("--kinds", nargs="+", choices=list(JOB_HANDLERS),
+                        help="the kinds of jobs to run with --jobs, all by default")
+    parser.add_argument("--metrics-port", type=int, default=metrics.PORT,
+                        help="port of the metrics endpoint with --jobs")
+    args = parser.parse_args()
+
+    if args.jobs:
+        asyncio.run(_run_jobs(args.kinds, metrics_port=args.metrics_port))
+    elif args.webhook:
+        run_webhook(args.workers)
+    else:
+        persistence = RedisPersistence()
+        application = ApplicationBuilder().persistence(persistence). \
+            token(BOT_TOKEN). \
+            concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES)). \
+            post_init(startup).post_shutdown(shutdown).build()
+
+        add_handlers(application)
+
+        application.run_polling()
@@ -1,23 +1,20 @@
 from typing import List, Union
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_URL
 from datetime import datetime
-
-import numpy as np
+import asyncio
+import logging
+import re
 
 import redis
-from redis.commands.search.indexDefinition import (
-    IndexDefinition,
-    IndexType
-)
-from redis.commands.search.query import Query, NumericFilter
-from redis.commands.search.field import (
-    TextField,
-    VectorField,
-    NumericField
-)
+import redis.asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
 
 from utils import get_config
-from _openai import embed_text
+
+# numpy, the vector store and redis' search modules are imported where
+# they are used, the bot starts without them and loads them on the
+# first voice note or search
 
 
 config = get_config()
@@ -28,171 +25,766 @@ PORT = config["CACHE"]["PORT"]
 DISTANCE_METRIC = config["CACHE"]["DISTANCE_METRIC"]
 EMBEDDING_DIM = config["CACHE"]["EMBEDDING_DIM"]
 INDEX_NAME = config["CACHE"]["INDEX_NAME"]
+# searches go through the alias, so the index behind it can be rebuilt
+# and swapped with `migrate_index` without downtime
+INDEX_ALIAS = config.get("CACHE", "INDEX_ALIAS", fallback=f"{INDEX_NAME}:live")
+# FLAT or HNSW
+INDEX_TYPE = config.get("CACHE", "INDEX_TYPE", fallback="FLAT").upper()
+HNSW_M = config.getint("CACHE", "HNSW_M", fallback=16)
+HNSW_EF_CONSTRUCTION = config.getint("CACHE", "HNSW_EF_CONSTRUCTION", fallback=200)
+HNSW_EF_RUNTIME = config.getint("CACHE", "HNSW_EF_RUNTIME", fallback=10)
+# global: one index for everybody, searches prefilter on the user_id tag;
+# user: every user gets their own index, created on their first search
+INDEX_PARTITIONING = config.get("CACHE", "INDEX_PARTITIONING", fallback="global").lower()
+# FLOAT32, or FLOAT16 / INT8 to keep scalar-quantized vectors in Redis,
+# with the full-precision ones in FULL_VECTOR_STORE for exact re-ranking.
+# FLOAT16 needs RediSearch 2.10 (Redis Stack 7.4) or later, INT8 needs
+# Redis 8 and only works with the COSINE distance metric
+VECTOR_TYPE = config.get("CACHE", "VECTOR_TYPE", fallback="FLOAT32").upper()
+# SQLite file for the full-precision vectors, leave empty to drop them
+FULL_VECTOR_STORE = config.get("CACHE", "FULL_VECTOR_STORE", fallback="vectors.sqlite")
+# searches of a quantized index fetch this many times k candidates
+# and re-rank them with the full-precision vectors
+RERANK_FACTOR = config.getint("CACHE", "RERANK_FACTOR", fallback=4)
+# each vector type is kept in its own hash field, so an index over
+# another type can be built next to the live one
+VECTOR_FIELDS = {
+    "FLOAT32": "message_embedding",
+    "FLOAT16": "message_embedding_f16",
+    "INT8": "message_embedding_i8",
+}
+# `manage.py reembed` writes another model's vectors to fields with this
+# suffix and indexes them behind an alias with it, next to the live
+# index. Bots search the alias of the suffix they are configured with,
+# so each of them embeds queries and notes like the index it searches
+VECTOR_FIELD_SUFFIX = config.get("CACHE", "VECTOR_FIELD_SUFFIX", fallback="")
+LIVE_ALIAS = INDEX_ALIAS + VECTOR_FIELD_SUFFIX
+# the model a note's suffixed vector was made with, removed when the note
+# is edited so the next re-embedding run makes it again
+MODEL_FIELD = "embedding_model"
 PREFIX = "message"
-
-
-def create_index(
-        client: redis.Redis,
-        index_name=INDEX_NAME, 
-        embedding_dim=EMBEDDING_DIM, 
-        distance_metric=DISTANCE_METRIC,
-        prefix=PREFIX):
-    try:
-        client.ft(INDEX_NAME).info()
+# message_ids per bucket of a user's message_id index. Every note has a
+# bot reply's id and at most every other id is one, so a bucket holds
+# fewer entries than hash-max-listpack-entries (128 by default) and
+# Redis keeps it in its compact encoding
+INDEX_BUCKET_SIZE = config.getint("CACHE", "INDEX_BUCKET_SIZE", fallback=256)
+# seconds a user's ranked search results are kept for paging
+SEARCH_RESULTS_TTL = config.getint("CACHE", "SEARCH_RESULTS_TTL", fallback=600)
+
+# connection pool settings
+POOL_SIZE = config.getint("CACHE", "POOL_SIZE", fallback=32)
+# seconds to wait for a free connection when the pool is exhausted
+POOL_TIMEOUT = config.getfloat("CACHE", "POOL_TIMEOUT", fallback=5)
+SOCKET_TIMEOUT = config.getfloat("CACHE", "SOCKET_TIMEOUT", fallback=5)
+HEALTH_CHECK_INTERVAL = config.getint("CACHE", "HEALTH_CHECK_INTERVAL", fallback=30)
+RECONNECT_RETRIES = config.getint("CACHE", "RECONNECT_RETRIES", fallback=5)
+RECONNECT_BACKOFF_BASE = config.getfloat("CACHE", "RECONNECT_BACKOFF_BASE", fallback=0.1)
+RECONNECT_BACKOFF_CAP = config.getfloat("CACHE", "RECONNECT_BACKOFF_CAP", fallback=5)
+
+logger = logging.getLogger(__name__)
+
+_client = None
+_full_vectors = None
+_index_task = None
+# per-user indexes known to exist
+_user_indexes = set()
+
+
+def check_vector_type(vector_type=VECTOR_TYPE, distance_metric=DISTANCE_METRIC):
+    if vector_type not in VECTOR_FIELDS:
+        raise ValueError(f"Unknown vector type: {vector_type}")
+    # int8 vectors are scaled each by its own largest component, which
+    # keeps angles but not lengths, so only cosine distances survive it
+    if vector_type == "INT8" and distance_metric.upper() != "COSINE":
+        raise ValueError(f"INT8 vectors need the COSINE distance metric, "
+                         f"not {distance_metric}")
+
+
+def vector_field_name(vector_type=VECTOR_TYPE, suffix=VECTOR_FIELD_SUFFIX):
+    return VECTOR_FIELDS[vector_type] + suffix
+
+
+def full_vector_key(key, suffix=VECTOR_FIELD_SUFFIX):
+    # another model's vectors are kept next to the live ones until the swap
+    return key + suffix
+
+
+def encode_vector(vector, vector_type=VECTOR_TYPE) -> bytes:
+    import numpy as np
+    vector = np.asarray(vector, dtype=np.float32)
+    if vector_type == "FLOAT32":
+        return vector.tobytes()
+    if vector_type == "FLOAT16":
+        return vector.astype(np.float16).tobytes()
+    if vector_type == "INT8":
+        # scaled per vector, which keeps its direction and so the cosine
+        # distances, but not its length
+        scale = np.abs(vector).max()
+        if scale > 0:
+            vector = vector / scale
+        return np.round(vector * 127).astype(np.int8).tobytes()
+    raise ValueError(f"Unknown vector type: {vector_type}")
+
+
+def decode_vector(blob: bytes, vector_type=VECTOR_TYPE):
+    import numpy as np
+    dtype = {"FLOAT32": np.float32, "FLOAT16": np.float16, "INT8": np.int8}[vector_type]
+    return np.frombuffer(blob, dtype=dtype).astype(np.float32)
+
+
+def get_full_vector_store():
+    global _full_vectors
+    if _full_vectors is None and FULL_VECTOR_STORE:
+        from vector_store import VectorStore
+        _full_vectors = VectorStore(FULL_VECTOR_STORE)
+    return _full_vectors
+
+
+async def _keep_full_vector(key, embedding, vector_type=VECTOR_TYPE):
+    # only needed when Redis doesn't have the full-precision vector
+    if vector_type == "FLOAT32":
         return
-    except:
-        pass
-    
-    user_id = NumericField(name="user_id")
+    store = get_full_vector_store()
+    if store is not None:
+        if isinstance(key, bytes):
+            key = key.decode("utf-8")
+        await store.put(full_vector_key(key), embedding)
+
+
+def _vector_field(index_type=INDEX_TYPE,
+                  embedding_dim=EMBEDDING_DIM,
+                  distance_metric=DISTANCE_METRIC,
+                  m=HNSW_M,
+                  ef_construction=HNSW_EF_CONSTRUCTION,
+                  ef_runtime=HNSW_EF_RUNTIME,
+                  vector_type=VECTOR_TYPE,
+                  suffix=VECTOR_FIELD_SUFFIX):
+    from redis.commands.search.field import VectorField
+    check_vector_type(vector_type, distance_metric)
+    attributes = {
+        "TYPE": vector_type,
+        "DIM":  embedding_dim,
+        "DISTANCE_METRIC": distance_metric,
+    }
+    if index_type == "HNSW":
+        attributes.update({
+            "M": m,
+            "EF_CONSTRUCTION": ef_construction,
+            "EF_RUNTIME": ef_runtime,
+        })
+    elif index_type == "FLAT":
+        attributes["INITIAL_CAP"] = 1000
+    else:
+        raise ValueError(f"Unknown index type: {index_type}")
+    return VectorField(vector_field_name(vector_type, suffix), index_type, attributes)
+
+
+def _index_fields(**vector_options):
+    from redis.commands.search.field import TextField, NumericField, TagField
+    # a tag, so searches can prefilter on it inside the KNN clause
+    user_id = TagField(name="user_id")
     message_id = NumericField(name="message_id")
     message = TextField(name="message")
-    message_embedding = VectorField("message_embedding",
-                                    "FLAT", {
-                                        "TYPE": "FLOAT32",
-                                        "DIM":  embedding_dim,
-                                        "DISTANCE_METRIC": distance_metric,
-                                        "INITIAL_CAP": 1000,
-                                    }
-    )
+    message_embedding = _vector_field(**vector_options)
     timestamp = NumericField(name="timestamp")
 
-    fields = [user_id, message_id, message, message_embedding, timestamp]
+    return [user_id, message_id, message, message_embedding, timestamp]
+
 
-    client.ft(index_name).create_index(
-                        fields = fields,
+async def _build_index(client, index_name, prefix=PREFIX, **vector_options):
+    from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+    await client.ft(index_name).create_index(
+                        fields = _index_fields(**vector_options),
                         definition = IndexDefinition(
                                             prefix=[prefix], 
                                             index_type=IndexType.HASH)
     )
 
 
-def search_redis(
-    client: redis.Redis,
+async def _wait_for_indexing(client, index_name, poll_interval=1., verbose=True):
+    while True:
+        info = await client.ft(index_name).info()
+        if int(info["indexing"]) == 0:
+            return
+        if verbose:
+            print(f"Indexing {index_name}: {float(info['percent_indexed']) * 100:.1f}%")
+        await asyncio.sleep(poll_interval)
+
+
+async def create_index(
+        client: aioredis.Redis,
+        index_name=INDEX_NAME + VECTOR_FIELD_SUFFIX,
+        alias=LIVE_ALIAS,
+        prefix=PREFIX,
+        partitioning=INDEX_PARTITIONING,
+        wait=False,
+        **vector_options):
+    # per-user indexes are created as they are needed
+    if partitioning == "user":
+        return
+
+    # the alias resolves, nothing to do
+    try:
+        await client.ft(alias).info()
+        return
+    except:
+        pass
+
+    # an index created before aliases were used is kept as is and
+    # put behind the alias
+    try:
+        await client.ft(index_name).info()
+    except:
+        await _build_index(client, index_name, prefix, **vector_options)
+    if wait:
+        await _wait_for_indexing(client, index_name)
+    await client.ft(index_name).aliasadd(alias)
+
+
+def bootstrap_index(client: aioredis.Redis, **kwargs) -> asyncio.Task:
+    """
+    Creates the index in the background, so startup doesn't wait on
+    Redis. Searches wait for it to be done.
+    """
+    global _index_task
+
+    def done(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Failed to create the index", exc_info=task.exception())
+
+    _index_task = asyncio.create_task(create_index(client, **kwargs))
+    _index_task.add_done_callback(done)
+    return _index_task
+
+
+async def wait_for_index():
+    # a failed bootstrap was logged, the search fails on its own
+    if _index_task is not None and not _index_task.done():
+        await asyncio.wait([_index_task])
+
+
+async def migrate_index(
+        client: aioredis.Redis,
+        index_type=INDEX_TYPE,
+        alias=LIVE_ALIAS,
+        prefix=PREFIX,
+        drop_old=True,
+        poll_interval=1.,
+        **vector_options):
+    """
+    Builds a new index of `index_type` over the same documents next to the
+    live one, waits for it to finish indexing and points the alias at it.
+    Searches keep being served by the old index until the alias is swapped.
+    Returns the name of the new index.
+    """
+    info = await client.ft(alias).info()
+    old_index = info["index_name"]
+    new_index = f"{INDEX_NAME}:{index_type.lower()}:{int(datetime.now().timestamp())}"
+
+    await _build_index(client, new_index, prefix,
+                       index_type=index_type, **vector_options)
+
+    await _wait_for_indexing(client, new_index, poll_interval)
+
+    await client.ft(new_index).aliasupdate(alias)
+    print(f"{alias} now points to {new_index}")
+
+    if drop_old:
+        # keep the documents, they are shared with the new index
+        await client.ft(old_index).dropindex(delete_documents=False)
+    return new_index
+
+
+def user_index_name(user_id, suffix=VECTOR_FIELD_SUFFIX):
+    # a re-embedding run's suffix gives the users new indexes over its field
+    return f"{INDEX_NAME}:user:{int(user_id)}{suffix}"
+
+
+async def ensure_user_index(client: aioredis.Redis, user_id, **vector_options):
+    """
+    Creates the user's own index over their notes if it doesn't exist yet
+    and waits for it to pick up the notes already stored. Only the user's
+    keys match its prefix, so searching it never touches other users' notes.
+    """
+    index_name = user_index_name(user_id)
+    if index_name in _user_indexes:
+        return index_name
+    try:
+        await client.ft(index_name).info()
+    except redis.ResponseError:
+        try:
+            await _build_index(client, index_name,
+                               f"{PREFIX}:<{int(user_id)}>", **vector_options)
+        except redis.ResponseError as e:
+            # another process got there first
+            if "already exists" not in str(e).lower():
+                raise
+        await _wait_for_indexing(client, index_name, poll_interval=0.05, verbose=False)
+    _user_indexes.add(index_name)
+    return index_name
+
+
+async def drop_user_indexes(client: aioredis.Redis):
+    """
+    Drops every per-user index, keeping the documents. They are created
+    again, with the current settings, by the next search of each user.
+    """
+    prefix = f"{INDEX_NAME}:user:"
+    for name in await client.execute_command("FT._LIST"):
+        name = name.decode("utf-8") if isinstance(name, bytes) else name
+        if name.startswith(prefix):
+            await client.ft(name).dropindex(delete_documents=False)
+    _user_indexes.clear()
+
+
+def _distances(query, vectors, distance_metric=DISTANCE_METRIC):
+    import numpy as np
+    if distance_metric == "COSINE":
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        return 1 - vectors @ query / np.maximum(norms, 1e-12)
+    if distance_metric == "IP":
+        return 1 - vectors @ query
+    return ((vectors - query) ** 2).sum(axis=1)
+
+
+async def _rerank(docs, embedded_query, k):
+    """
+    Replaces the approximate scores of quantized vectors with exact ones
+    computed from the full-precision vectors, where those are kept.
+    """
+    import numpy as np
+    store = get_full_vector_store()
+    if store is None or not docs:
+        return docs[:k]
+    vectors = await store.get_many([full_vector_key(doc.id) for doc in docs])
+    exact = [doc for doc in docs if full_vector_key(doc.id) in vectors]
+    if exact:
+        query = np.asarray(embedded_query, dtype=np.float32)
+        distances = _distances(query, np.stack([vectors[full_vector_key(doc.id)]
+                                                for doc in exact]))
+        for doc, distance in zip(exact, distances):
+            doc.vector_score = float(distance)
+    return sorted(docs, key=lambda doc: float(doc.vector_score))[:k]
+
+
+def _knn_query(query_string, return_fields, k, user_filter=None):
+    from redis.commands.search.query import Query
+    query = Query(query_string)
+    if user_filter is not None:
+        query = query.add_filter(user_filter)
+    return (
+        query
+         .return_fields(*return_fields)
+         .sort_by("vector_score")
+         .paging(0, k)
+         .dialect(2)
+    )
+
+
+async def search_redis(
+    client: aioredis.Redis,
     user_id: Union[int, str],
     embedded_query: List,
-    index_name: str = INDEX_NAME,
-    vector_field: str = "message_embedding",
+    index_name: str = LIVE_ALIAS,
+    vector_field: str = None,
     return_fields: list = ["message", "message_id", "user_id", "vector_score", "timestamp"],
     hybrid_fields = "*",
     k: int = 20,
+    partitioning: str = INDEX_PARTITIONING,
+    vector_type: str = VECTOR_TYPE,
     ) -> List[dict]:
+    from redis.commands.search.query import NumericFilter
 
-    # Creates embedding vector from user query
-    #embedded_query = embed_text(user_query)
-
+    await wait_for_index()
     user_id = int(user_id)
-    # Prepare the Query
-    base_query = f'{hybrid_fields}=>[KNN {k} @{vector_field} $vector AS vector_score]'
-    query = (
-        Query(base_query)
-         .add_filter(NumericFilter("user_id", user_id, user_id))
-         .return_fields(*return_fields)
-         .sort_by("vector_score")
-         .paging(0, k)
-         .dialect(2)
-    )
-    params_dict = {"vector": np.array(embedded_query).astype(dtype=np.float32).tobytes()}
+    vector_field = vector_field or vector_field_name(vector_type)
+    quantized = vector_type != "FLOAT32"
+    candidates = k * RERANK_FACTOR if quantized else k
+
+    if partitioning == "user":
+        index_name = await ensure_user_index(client, user_id)
+        prefilter = hybrid_fields
+    else:
+        # filtering inside the KNN clause scores only the user's own
+        # vectors, rather than finding the k nearest among everybody's
+        # and dropping other users' afterwards
+        user_filter = f"@user_id:{{{user_id}}}"
+        prefilter = f"({user_filter})" if hybrid_fields == "*" \
+            else f"({hybrid_fields} {user_filter})"
+
+    def knn(field, n):
+        return f'=>[KNN {n} @{field} $vector AS vector_score]'
+
+    attempts = [(_knn_query(f"{prefilter}{knn(vector_field, candidates)}", return_fields, candidates),
+                 encode_vector(embedded_query, vector_type))]
+    float32_vector = encode_vector(embedded_query, "FLOAT32")
+    if quantized:
+        # the live index hasn't been switched to the quantized field yet
+        attempts.append((_knn_query(f"{prefilter}{knn(vector_field_name('FLOAT32'), k)}", return_fields, k),
+                         float32_vector))
+    if partitioning != "user":
+        # an index built before user_id became a tag, until it is
+        # rebuilt with `manage.py migrate-index`
+        attempts.append((_knn_query(f"{hybrid_fields}{knn(VECTOR_FIELDS['FLOAT32'], k)}", return_fields, k,
+                                    NumericFilter("user_id", user_id, user_id)),
+                         float32_vector))
 
     # perform vector search
-    results = client.ft(index_name).search(query, params_dict)
-    return results.docs
+    for i, (query, vector) in enumerate(attempts):
+        try:
+            results = await client.ft(index_name).search(query, {"vector": vector})
+        except redis.ResponseError:
+            if i == len(attempts) - 1:
+                raise
+            continue
+        if quantized and i == 0:
+            return await _rerank(results.docs, embedded_query, k)
+        return results.docs
 
 
 def get_redis_client(host=HOST, port=PORT, password=PASSWORD):
-    # Connect to the local Redis instance
-    redis_client = redis.StrictRedis(host=host, 
-                                     port=port, 
-                                     db=0,
-                                     password=password)
-
+    """
+    Returns the process-wide Redis client. Connections come from a single
+    pool that is shared by every caller, so this is cheap to call per update.
+    """
+    global _client
+    if _client is None:
+        retry = Retry(ExponentialBackoff(cap=RECONNECT_BACKOFF_CAP,
+                                         base=RECONNECT_BACKOFF_BASE),
+                      RECONNECT_RETRIES)
+        pool = aioredis.BlockingConnectionPool(
+            host=host,
+            port=port,
+            db=0,
+            password=password,
+            max_connections=POOL_SIZE,
+            timeout=POOL_TIMEOUT,
+            socket_timeout=SOCKET_TIMEOUT,
+            socket_connect_timeout=SOCKET_TIMEOUT,
+            health_check_interval=HEALTH_CHECK_INTERVAL,
+            retry=retry,
+            retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+        )
+        _client = aioredis.Redis(connection_pool=pool)
+    return _client
+
+
+async def init_redis_pool():
+    client = get_redis_client()
     # Test the connection
     try:
-        redis_client.ping()
+        await client.ping()
         print("Connected to Redis!")
     except redis.ConnectionError:
         print("Failed to connect to Redis.")
-    return redis_client
+    return client
 
 
-def _record_embedding(client: redis.Redis, 
-                      user_id, 
-                      message, 
-                      message_embedding,
-                      prefix=PREFIX):
-    message_embedding = np.array(message_embedding, dtype=np.float32).tobytes()
-    timestamp = datetime.now().timestamp()
-    msg_hash = uuid4().hex
-    key = f"{prefix}:<{user_id}><{msg_hash}>"
-    timestamp = datetime.now().timestamp()
-    mapping = {"user_id": int(user_id),
-               #"message_id": int(msg_id),
-               "message": message, 
-               "message_embedding": message_embedding,
-               "timestamp": float(timestamp),}
-    client.hset(key, mapping = mapping)
-    return key, msg_hash
+async def close_redis_pool():
+    global _client
+    if _client is not None:
+        await _client.close()
+        await _client.connection_pool.disconnect()
+        _client = None
+
+
+def _message_key(user_id, msg_hash, prefix=PREFIX):
+    return f"{prefix}:<{user_id}><{msg_hash}>"
 
 
+def _index_key(user_id, message_id):
+    # the user's message_id -> note index is split into buckets small
+    # enough for Redis to keep each of them as a compact listpack
+    return f"msgidx:<{int(user_id)}>:{int(message_id) // INDEX_BUCKET_SIZE}"
 
-def _update_message_id(client, 
-                       key,
-                       user_id,
-                       message_id,  
-                       ):
-    # save the user_id and message_id so we can easily find
-    # the message key later
-    client.set(f"user_id:<{user_id}>msg_id:<{message_id}>", key)
-    client.hset(key, mapping={"message_id": int(message_id)})
 
+def _legacy_pointer_key(user_id, message_id):
+    # one string per note pointing at its hash, before the index
+    return f"user_id:<{user_id}>msg_id:<{message_id}>"
 
-def _record(client, user_id, msg_id, _type, value):
-    client.set(f"user_id:<{user_id}>msg_id:<{msg_id}>:{_type}", value)
 
+def _search_keys(user_id):
+    # the ranked message keys and the query they were found for
+    return f"search:<{user_id}>", f"search:<{user_id}>:query"
 
-def save_embedding(client, user_id, message_text, embedding):
-    return _record_embedding(client, user_id, message_text, embedding)
 
+def _note_hash(user_id, message_id):
+    # the same for every attempt to save a note, so a job that is run
+    # again finds the note it saved before instead of adding another
+    if message_id is None:
+        return uuid4().hex
+    return uuid5(NAMESPACE_URL, f"note:{int(user_id)}:{int(message_id)}").hex
 
-def update_embedding(client, user_id, message_id, message_text, embedding):
+
+# writes the note and its index entry unless the note exists already, a
+# save that is repeated mustn't overwrite an edit made since
+_SAVE_VOICE_NOTE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+if KEYS[4] then
+    redis.call('HSET', KEYS[4], ARGV[2], ARGV[1])
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+return 1
+"""
+
+
+async def save_voice_note(client: aioredis.Redis,
+                          user_id,
+                          chat_id,
+                          message_id,
+                          message_text,
+                          embedding,
+                          prefix=PREFIX):
     """
-    Update the embedding record for the message after it was edited by the user
-    or automatic rewriting.
+    Stores a transcribed voice note atomically: the searchable message
+    hash and its entry in the user's message_id index. `message_id` is
+    None when the transcript couldn't be sent to the user, then only the
+    message hash is written. Saving the same message_id again leaves the
+    note as it is.
     """
-    key = client.get(f"user_id:<{user_id}>msg_id:<{message_id}>")
-    mapping = {"message": message_text,
-               "message_embedding": np.array(embedding, dtype=np.float32).tobytes()}
-    # delete the record connecting the key to user_id and msg_id
-    client.delete(f"user_id:<{user_id}>msg_id:<{message_id}>")
-    client.hset(key, mapping=mapping)
-
+    msg_hash = _note_hash(user_id, message_id)
+    key = _message_key(user_id, msg_hash, prefix)
+    timestamp = datetime.now().timestamp()
+    mapping = {"user_id": int(user_id),
+               "message": message_text,
+               vector_field_name(): encode_vector(embedding),
+               "timestamp": float(timestamp),}
+    if int(chat_id) != int(user_id):
+        # voice notes come from private chats, where the two are the same
+        mapping["chat_id"] = int(chat_id)
+    keys = [key, *_search_keys(user_id)]
+    if message_id is not None:
+        mapping["message_id"] = int(message_id)
+        keys.append(_index_key(user_id, message_id))
+    # before the note, so a saved note always has its full vector
+    if VECTOR_TYPE != "FLOAT32" and not await client.exists(key):
+        await _keep_full_vector(key, embedding)
+
+    script = client.register_script(_SAVE_VOICE_NOTE)
+    await script(keys=keys,
+                 args=[msg_hash, "" if message_id is None else int(message_id),
+                       *[item for field_value in mapping.items() for item in field_value]])
+    return key, msg_hash
 
-def update_message_id(client, key, user_id, message_id):
-    _update_message_id(client, key, user_id, message_id)
 
+async def _find_note_key(client, user_id, message_id):
+    # from the hash in the index, falling back to the pointer of a note
+    # that hasn't been migrated yet
+    pipe = client.pipeline(transaction=False)
+    pipe.hget(_index_key(user_id, message_id), int(message_id))
+    pipe.get(_legacy_pointer_key(user_id, message_id))
+    msg_hash, key = await pipe.execute()
+    if msg_hash is not None:
+        return _message_key(user_id, msg_hash.decode("utf-8"))
+    return key.decode("utf-8") if key is not None else None
+
+
+# a note's key never changes once it is saved, only the note may have
+# been deleted since it was looked up
+_UPDATE_VOICE_NOTE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'message', ARGV[1], ARGV[3], ARGV[2])
+redis.call('HDEL', KEYS[1], ARGV[4])
+redis.call('DEL', KEYS[2], KEYS[3])
+return 1
+"""
+
+
+async def update_voice_note(client: aioredis.Redis,
+                            user_id,
+                            chat_id,
+                            message_id,
+                            message_text,
+                            embedding):
+    """
+    Atomically applies an edit to a stored voice note. Returns the
+    message key, or None if the note isn't found.
+    """
+    key = await _find_note_key(client, user_id, message_id)
+    if key is None:
+        return None
+    script = client.register_script(_UPDATE_VOICE_NOTE)
+    if not await script(keys=[key, *_search_keys(user_id)],
+                        args=[message_text,
+                              encode_vector(embedding),
+                              vector_field_name(),
+                              MODEL_FIELD]):
+        return None
+    await _keep_full_vector(key, embedding)
+    return key
+
+
+_LEGACY_KEY = re.compile(rb"^user_id:<(-?\d+)>msg_id:<(\d+)>(:text|:time)?$")
+
+# moves a pointer into the index, unless the note's key can't be parsed
+_MIGRATE_POINTER = """
+local key = redis.call('GET', KEYS[1])
+if not key then
+    return 0
+end
+local msg_hash = string.match(key, '<([^<>]+)>$')
+if not msg_hash then
+    return 0
+end
+redis.call('HSETNX', KEYS[2], ARGV[1], msg_hash)
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
+
+async def _migrate_batch(client, keys):
+    script = client.register_script(_MIGRATE_POINTER)
+    pipe = client.pipeline(transaction=False)
+    records = []
+    for key in keys:
+        m = _LEGACY_KEY.match(key)
+        if m is None:
+            continue
+        if m.group(3) is not None:
+            records.append(key)
+        else:
+            message_id = int(m.group(2))
+            await script(keys=[key, _index_key(int(m.group(1)), message_id)],
+                         args=[message_id], client=pipe)
+    if records:
+        pipe.unlink(*records)
+    results = await pipe.execute()
+    deleted = results.pop() if records else 0
+    return sum(results), deleted
+
+
+async def migrate_key_schema(client: aioredis.Redis, batch=1000):
+    """
+    Moves the notes from the old layout to the current one while the bot
+    keeps running: every message_id pointer string becomes an entry of
+    the user's message_id index, and the :text and :time strings, which
+    duplicated the note hashes, are deleted. Lookups fall back to the
+    pointers until they are moved, and running it again is harmless.
+    Returns the number of pointers moved and of records deleted.
+    """
+    moved = deleted = 0
+    keys = []
+    async for key in client.scan_iter(match="user_id:<*>msg_id:<*", count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            counts = await _migrate_batch(client, keys)
+            keys = []
+            moved, deleted = moved + counts[0], deleted + counts[1]
+            print(f"Moved {moved} pointers, deleted {deleted} records")
+    if keys:
+        counts = await _migrate_batch(client, keys)
+        moved, deleted = moved + counts[0], deleted + counts[1]
+    return moved, deleted
+
+
+async def _quantize_batch(client, keys, vector_type, store, drop_float32):
+    import numpy as np
+    float32_field = vector_field_name("FLOAT32")
+    quantized_field = vector_field_name(vector_type)
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, float32_field, quantized_field)
+    rows = await pipe.execute()
+
+    full = [(key.decode("utf-8"), np.frombuffer(vector, dtype=np.float32))
+            for key, (vector, quantized) in zip(keys, rows)
+            if vector is not None and quantized is None]
+    # the full-precision vectors are saved before anything is removed
+    # from Redis, so an interrupted run loses nothing
+    if store is not None and full:
+        await store.put_many([(full_vector_key(key), vector) for key, vector in full])
+
+    pipe = client.pipeline(transaction=False)
+    for key, vector in full:
+        pipe.hset(key, quantized_field, encode_vector(vector, vector_type))
+    if drop_float32:
+        for key, (vector, _) in zip(keys, rows):
+            if vector is not None:
+                pipe.hdel(key, float32_field)
+    await pipe.execute()
+    return len(full)
+
+
+async def quantize_vectors(client: aioredis.Redis,
+                           vector_type,
+                           store=None,
+                           drop_float32=False,
+                           batch=500,
+                           prefix=PREFIX):
+    """
+    Adds a `vector_type` copy of the embedding to every message hash that
+    only has the float32 one, saving the float32 vector to `store` if one is
+    given. With `drop_float32` the float32 field is then removed from the
+    hashes, which frees its memory once the index uses the quantized field.
+    Returns the number of hashes converted.
+    """
+    # before anything is written, the index over them would refuse them
+    check_vector_type(vector_type)
+    converted = 0
+    keys = []
+    async for key in client.scan_iter(match=f"{prefix}:*", count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            converted += await _quantize_batch(client, keys, vector_type, store, drop_float32)
+            keys = []
+    if keys:
+        converted += await _quantize_batch(client, keys, vector_type, store, drop_float32)
+    return converted
+
+
+async def save_search_results(client, user_id, query, keys,
+                              ttl=SEARCH_RESULTS_TTL):
+    results_key, query_key = _search_keys(user_id)
+    pipe = client.pipeline(transaction=True)
+    pipe.delete(results_key)
+    if keys:
+        pipe.rpush(results_key, *keys)
+        pipe.expire(results_key, ttl)
+    pipe.set(query_key, query, ex=ttl)
+    await pipe.execute()
+
+
+async def get_search_results(client, user_id, start=0, end=-1):
+    """
+    Returns the query of the user's cached search, a slice of its ranked
+    message keys and the total number of results, or None if there are
+    no cached results.
+    """
+    results_key, query_key = _search_keys(user_id)
+    pipe = client.pipeline(transaction=False)
+    pipe.get(query_key)
+    pipe.lrange(results_key, start, end)
+    pipe.llen(results_key)
+    query, keys, total = await pipe.execute()
+    if query is None:
+        return None
+    return query.decode("utf-8"), keys, total
 
-def save_message(client, user_id, message_id, message_text, embedding):
-    # Add the message to the cache
-    _record(client, user_id, message_id, "text", message_text)
-    _record(client, user_id, message_id, "time", datetime.now().timestamp())
-    
 
-def update_message(client, user_id, message_id, message_text):
-    # Update the message in the cache
-    _record(client, user_id, message_id, "text", message_text)
+async def get_messages(client, keys, fields=("message", "timestamp")):
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, *fields)
+    return await pipe.execute()
 
 
-def wait_for_approval(client, chat_id, message_id):
-    client.set(f"appr:<{chat_id}>:<{message_id}>", datetime.now().timestamp())
+async def wait_for_approval(client, chat_id, message_id):
+    await client.set(f"appr:<{chat_id}>:<{message_id}>", datetime.now().timestamp())
 
 
-def remove_approval(client, chat_id, message_id):
-    client.delete(f"appr:<{chat_id}>:<{message_id}>")
+async def remove_approval(client, chat_id, message_id):
+    await client.delete(f"appr:<{chat_id}>:<{message_id}>")
 
 
-def save_user_var(client, user_id, var_name, value):
-    client.set(f"user_id:<{user_id}>var:<{var_name}>", value)
+async def save_user_var(client, user_id, var_name, value):
+    await client.set(f"user_id:<{user_id}>var:<{var_name}>", value)
 
 
-def get_user_var(client, user_id, var_name):
-    return client.get(f"user_id:<{user_id}>var:<{var_name}>")
+async def get_user_var(client, user_id, var_name):
+    return await client.get(f"user_id:<{user_id}>var:<{var_name}>")
     
\ No newline at end of file
@@ -1,13 +1,36 @@
+from collections import deque
+import asyncio
+import time
+
 from telegram import KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import ContextTypes
 from telegram import Update
 from telegram.ext import ConversationHandler
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
+
+from _openai import make_completion, aget_response, astream_response
+from memory import get_context, add_turn, compact, forget
+from metrics import stage, stage_seconds
+from retry import retry, breakers
+from utils import get_config, _
 
-from _openai import make_completion, chatgpt_get_response
-from utils import _
+config = get_config()
 
 WAITING, END = 1, 2
 
+# stream replies into the chat as they are generated instead of
+# waiting for the whole completion
+STREAM_REPLIES = config.getboolean("CHATGPT", "STREAM_REPLIES", fallback=True)
+# seconds between edits of a streamed reply, Telegram starts rejecting
+# edits of the same chat at about one per second
+EDIT_INTERVAL = config.getfloat("CHATGPT", "EDIT_INTERVAL", fallback=1.0)
+MAX_MESSAGE_LEN = MessageLimit.MAX_TEXT_LENGTH
+PLACEHOLDER = "\u2026"
+
+# seconds from the user's message to the first token of the reply,
+# for the most recent streamed replies
+ttft_samples = deque(maxlen=1000)
 
 
 def refresh_ui(context):
@@ -55,6 +78,7 @@ async def start_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return WAITING
 
     context.user_data["chat_gpt"] = True
+    await forget(update.effective_user.id)
 
     reply_markup = get_stop_gpt_kb()
     await context.bot.send_message(chat_id=update.effective_chat.id,
@@ -64,18 +88,133 @@ async def start_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return WAITING
 
 
+def utf16_len(text):
+    # Telegram measures message length in UTF-16 code units, characters
+    # outside the Basic Multilingual Plane, like most emoji, count twice
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _fitting_chars(text, limit):
+    # how many characters of `text` fit in `limit` UTF-16 code units
+    units = 0
+    for i, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit:
+            return i
+    return len(text)
+
+
+def split_text(text, limit=MAX_MESSAGE_LEN):
+    # cut at a line break or a space if there is one reasonably close
+    # to the limit, so words aren't split between messages
+    end = _fitting_chars(text, limit)
+    if end == len(text):
+        return text, ""
+    cut = text.rfind("\n", 0, end)
+    if cut < end // 2:
+        cut = text.rfind(" ", 0, end)
+    if cut < end // 2:
+        cut = end
+    return text[:cut], text[cut:].lstrip()
+
+
+async def _edit(message, text, wait=False):
+    """
+    Edits the message to show `text`. When Telegram asks to slow down, an
+    edit that a later one supersedes is skipped and False returned, while
+    one with `wait` is made again once Telegram allows it.
+    """
+    try:
+        if wait:
+            await retry(message.edit_text, text, breaker=breakers["telegram"])
+        else:
+            await message.edit_text(text)
+    except RetryAfter as e:
+        if wait:
+            raise
+        await asyncio.sleep(e.retry_after)
+        return False
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    return True
+
+
+async def stream_reply(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                       completion, reply_markup=None):
+    """
+    Sends a placeholder message and edits it as the reply is generated,
+    at most once every EDIT_INTERVAL seconds. Text past Telegram's message
+    length limit continues in a new message. Returns the whole reply.
+    """
+    chat_id = update.effective_chat.id
+    start = time.perf_counter()
+    message = await context.bot.send_message(chat_id=chat_id,
+                                             text=PLACEHOLDER,
+                                             reply_markup=reply_markup)
+    text, shown = "", ""
+    reply = ""
+    last_edit = 0.
+    first_token = True
+
+    async for content in astream_response(completion, user_id=update.effective_user.id):
+        if first_token:
+            ttft_samples.append(time.perf_counter() - start)
+            stage_seconds.observe(ttft_samples[-1], "chat", "first_token")
+            first_token = False
+        text += content
+        reply += content
+
+        while utf16_len(text) > MAX_MESSAGE_LEN:
+            head, text = split_text(text)
+            # no later edit of this message carries the head
+            await _edit(message, head, wait=True)
+            message = await retry(context.bot.send_message,
+                                  chat_id=chat_id,
+                                  text=text or PLACEHOLDER,
+                                  reply_markup=reply_markup,
+                                  breaker=breakers["telegram"])
+            shown = text
+            last_edit = time.perf_counter()
+
+        if text != shown and time.perf_counter() - last_edit >= EDIT_INTERVAL:
+            if await _edit(message, text):
+                shown = text
+            last_edit = time.perf_counter()
+
+    if not text:
+        text = _("(empty response)")
+    if text != shown:
+        await _edit(message, text, wait=True)
+    return reply
+
+
 async def chat_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.user_data.get("chat_gpt", False):
         return ConversationHandler.END
     
+    user_id = update.effective_user.id
     reply_markup = get_stop_gpt_kb()
+    with stage("chat", "redis"):
+        history = await get_context(user_id)
     msg = make_completion(update.message.text, 
                           context.user_data.get("gpt_role", None), 
-                          context.user_data.get("gpt_context", None))
-    response_txt = chatgpt_get_response(msg)
-    await context.bot.send_message(chat_id=update.effective_chat.id, 
-                                   text=response_txt,
-                                   reply_markup=reply_markup)
+                          history)
+    if STREAM_REPLIES:
+        with stage("chat", "reply"):
+            response_txt = await stream_reply(update, context, msg, reply_markup)
+    else:
+        with stage("chat", "reply"):
+            response_txt = await aget_response(msg, user_id=user_id)
+        with stage("chat", "send_message"):
+            await context.bot.send_message(chat_id=update.effective_chat.id, 
+                                           text=response_txt,
+                                           reply_markup=reply_markup)
+
+    with stage("chat", "redis"):
+        await add_turn(user_id, update.message.text, response_txt)
+    # summarizing older turns doesn't hold up the next message
+    context.application.create_task(compact(user_id))
     return WAITING
 
 async def end_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -86,6 +225,7 @@ async def end_gpt(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                        reply_markup=refresh_ui(context),
                                        )
         return
+    await forget(update.effective_user.id)
     reply_markup = get_start_gpt_kb()
     await context.bot.send_message(chat_id=update.effective_chat.id,
                                    text=_("Conversation with ChatGPT ended."),
@@ -0,0 +1,270 @@
+from array import array
+from collections import OrderedDict
+from hashlib import sha256
+from time import time
+import asyncio
+import logging
+import unicodedata
+
+from _openai import aembed_text, aembed_texts, EMBEDDING_MODEL, INTERACTIVE
+from cache import get_redis_client
+from metrics import add_collector
+from retry import is_retryable, CircuitOpen
+from utils import get_config
+
+
+config = get_config()
+
+LRU_SIZE = config.getint("CACHE", "EMBEDDING_LRU_SIZE", fallback=1024)
+# seconds an entry lives in Redis since it was last used
+TTL = config.getint("CACHE", "EMBEDDING_TTL", fallback=30 * 24 * 3600)
+# upper bound on the number of embeddings kept in Redis
+MAX_ENTRIES = config.getint("CACHE", "EMBEDDING_MAX_ENTRIES", fallback=100_000)
+PREFIX = "emb"
+
+# how long the batcher waits for more requests to join a batch
+BATCH_WINDOW = config.getfloat("OPENAI", "EMBEDDING_BATCH_WINDOW", fallback=0.05)
+BATCH_SIZE = config.getint("OPENAI", "EMBEDDING_BATCH_SIZE", fallback=64)
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    # whitespace and unicode composition differences don't change
+    # the meaning of the text, so they shouldn't change the key either
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(text: str, model: str = EMBEDDING_MODEL) -> str:
+    digest = sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{PREFIX}:<{model}>:<{digest}>"
+
+
+class EmbeddingCache:
+    """
+    Two tier cache in front of the embeddings endpoint: an in-process LRU
+    and a Redis tier shared between processes. Redis entries expire after
+    `ttl` seconds without use, and the least recently used ones are evicted
+    once there are more than `max_entries` of them.
+    """
+
+    def __init__(self,
+                 client=None,
+                 model: str = EMBEDDING_MODEL,
+                 lru_size: int = LRU_SIZE,
+                 ttl: int = TTL,
+                 max_entries: int = MAX_ENTRIES,
+                 embed_fn=aembed_text):
+        self._client = client
+        self.model = model
+        self.lru_size = lru_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.embed_fn = embed_fn
+        self._lru = OrderedDict()
+        self.stats = {"lru_hits": 0, "redis_hits": 0, "misses": 0}
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = get_redis_client()
+        return self._client
+
+    @property
+    def lru_key(self):
+        return f"{PREFIX}:<{self.model}>:lru"
+
+    def _lru_get(self, key):
+        vector = self._lru.get(key)
+        if vector is not None:
+            self._lru.move_to_end(key)
+        return vector
+
+    def _lru_put(self, key, vector):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    async def _redis_get(self, key):
+        pipe = self.client.pipeline()
+        pipe.get(key)
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.lru_key, {key: time()})
+        value, _, _ = await pipe.execute()
+        return value
+
+    async def _redis_put(self, key, vector):
+        pipe = self.client.pipeline()
+        # float32, the same bytes numpy writes
+        pipe.set(key, array("f", vector).tobytes(), ex=self.ttl)
+        pipe.zadd(self.lru_key, {key: time()})
+        pipe.zcard(self.lru_key)
+        _, _, size = await pipe.execute()
+        if size > self.max_entries:
+            await self._evict(size - self.max_entries)
+
+    async def _evict(self, count):
+        # the oldest entries are the least recently used ones, or
+        # ones whose keys have expired already
+        expired = await self.client.zpopmin(self.lru_key, count)
+        if expired:
+            await self.client.delete(*[key for key, _ in expired])
+
+    async def get(self, text: str, priority: int = INTERACTIVE):
+        key = cache_key(text, self.model)
+
+        vector = self._lru_get(key)
+        if vector is not None:
+            self.stats["lru_hits"] += 1
+            return vector
+
+        try:
+            value = await self._redis_get(key)
+        except Exception as e:
+            logger.warning("Embedding cache lookup failed: %s", e)
+            value = None
+
+        if value is not None:
+            self.stats["redis_hits"] += 1
+            vector = array("f", value).tolist()
+            self._lru_put(key, vector)
+            return vector
+
+        self.stats["misses"] += 1
+        vector = await self.embed_fn(text, model=self.model, priority=priority)
+        self._lru_put(key, vector)
+        try:
+            await self._redis_put(key, vector)
+        except Exception as e:
+            logger.warning("Embedding cache store failed: %s", e)
+        return vector
+
+    def hit_rate(self) -> float:
+        total = sum(self.stats.values())
+        if total == 0:
+            return 0.
+        return (self.stats["lru_hits"] + self.stats["redis_hits"]) / total
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces concurrent embedding requests into batched calls to the
+    embeddings endpoint. A batch is sent `window` seconds after its first
+    request arrives, or as soon as it holds `max_batch` texts.
+    """
+
+    def __init__(self,
+                 window: float = BATCH_WINDOW,
+                 max_batch: int = BATCH_SIZE,
+                 embed_many_fn=aembed_texts,
+                 embed_one_fn=aembed_text):
+        self.window = window
+        self.max_batch = max_batch
+        self.embed_many_fn = embed_many_fn
+        self.embed_one_fn = embed_one_fn
+        # (model, priority) -> list of (text, future) waiting to be sent,
+        # requests of different priorities are never batched together
+        self._pending = {}
+        self._timers = {}
+        # batches being sent, the event loop only keeps weak references
+        # to tasks
+        self._tasks = set()
+        self.stats = {"requests": 0, "batches": 0, "fallbacks": 0}
+
+    async def embed(self, text: str, model: str = EMBEDDING_MODEL,
+                    priority: int = INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = (model, priority)
+        batch = self._pending.setdefault(key, [])
+        batch.append((text, future))
+        self.stats["requests"] += 1
+
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        return await future
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        if batch:
+            task = asyncio.create_task(self._send(*key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, model, priority, batch):
+        self.stats["batches"] += 1
+        try:
+            vectors = await self.embed_many_fn([text for text, _ in batch],
+                                               model=model, priority=priority)
+        except Exception as e:
+            # a single bad input fails the whole request, so retry the
+            # items one by one to keep the failure to the callers it
+            # belongs to. An outage would fail each of them as well.
+            if len(batch) == 1 or is_retryable(e) or isinstance(e, CircuitOpen):
+                for _, future in batch:
+                    self._resolve(future, exception=e)
+                return
+            self.stats["fallbacks"] += 1
+            await asyncio.gather(*[self._send_one(model, priority, text, future)
+                                   for text, future in batch])
+            return
+
+        for (_, future), vector in zip(batch, vectors):
+            self._resolve(future, vector)
+
+    async def _send_one(self, model, priority, text, future):
+        try:
+            vector = await self.embed_one_fn(text, model=model, priority=priority)
+        except Exception as e:
+            self._resolve(future, exception=e)
+            return
+        self._resolve(future, vector)
+
+    @staticmethod
+    def _resolve(future, vector=None, exception=None):
+        # the caller may have been cancelled in the meantime
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(vector)
+
+
+_cache = None
+_batcher = None
+
+
+def get_batcher() -> EmbeddingBatcher:
+    global _batcher
+    if _batcher is None:
+        _batcher = EmbeddingBatcher()
+    return _batcher
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(embed_fn=get_batcher().embed)
+    return _cache
+
+
+def _stats():
+    for name, tier in (("cache", _cache), ("batcher", _batcher)):
+        if tier is not None:
+            for event, n in tier.stats.items():
+                yield {"component": name, "event": event}, n
+
+
+add_collector("bot_embedding_events_total", "counter",
+              "Embedding cache lookups and batcher requests", _stats)
+
+
+async def get_embedding(text: str, priority: int = INTERACTIVE):
+    return await get_embedding_cache().get(text, priority)
@@ -0,0 +1,255 @@
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+from time import time
+from uuid import uuid4
+import asyncio
+import json
+import logging
+import os
+import socket
+
+import redis
+
+from cache import get_redis_client
+from retry import retry, breakers, backoff, is_retryable, CircuitOpen
+from utils import get_config
+
+
+config = get_config()
+
+# jobs a worker runs at once
+CONCURRENCY = config.getint("JOBS", "CONCURRENCY", fallback=4)
+# a job that failed this many times goes to the dead letter stream
+MAX_ATTEMPTS = config.getint("JOBS", "MAX_ATTEMPTS", fallback=5)
+# seconds before the first retry, doubling with every attempt up to the cap
+RETRY_BASE = config.getfloat("JOBS", "RETRY_BASE", fallback=2)
+RETRY_CAP = config.getfloat("JOBS", "RETRY_CAP", fallback=300)
+# enqueueing fails with QueueFull once this many jobs of a kind are waiting
+MAX_QUEUED = config.getint("JOBS", "MAX_QUEUED", fallback=1000)
+# seconds after which a job taken by a worker that went away is taken over
+CLAIM_IDLE = config.getint("JOBS", "CLAIM_IDLE", fallback=300)
+# whether the bot process runs a worker itself, set to no when the
+# workers are run separately with `python bot.py --jobs`
+RUN_IN_BOT = config.getboolean("JOBS", "RUN_IN_BOT", fallback=True)
+
+PREFIX = "jobs"
+GROUP = "job-workers"
+DELAYED_KEY = f"{PREFIX}:delayed"
+DEAD_KEY = f"{PREFIX}:dead"
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+# moves a delayed job to its stream in one step, so a job is never out
+# of both, and ZREM makes sure only one worker moves it
+_PROMOTE = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('XADD', KEYS[2], '*', 'job', ARGV[1])
+return 1
+"""
+
+
+class RetryLater(Exception):
+    """
+    Raised by a job that can't run yet and should be tried again.
+    """
+
+
+def stream_key(kind):
+    return f"{PREFIX}:<{kind}>"
+
+
+async def enqueue(kind: str,
+                  payload: dict,
+                  delay: float = 0,
+                  attempts: int = 0,
+                  max_queued: int = MAX_QUEUED,
+                  client=None):
+    """
+    Adds a job for the workers of `kind`, to run after `delay` seconds if
+    one is given. Raises QueueFull if too many jobs of the kind are waiting.
+    """
+    client = client or get_redis_client()
+    job = json.dumps({"id": uuid4().hex, "kind": kind,
+                      "payload": payload, "attempts": attempts})
+    if delay > 0:
+        await retry(client.zadd, DELAYED_KEY, {job: time() + delay},
+                    breaker=breakers["redis"])
+        return
+    # done jobs are deleted from the stream, so its length is the backlog
+    if max_queued and await retry(client.xlen, stream_key(kind),
+                                  breaker=breakers["redis"]) >= max_queued:
+        raise QueueFull(kind)
+    await retry(client.xadd, stream_key(kind), {"job": job}, breaker=breakers["redis"])
+
+
+class JobWorker:
+    """
+    Runs the jobs of the given kinds from their Redis streams, up to
+    `concurrency` at once. Each read takes no more jobs of a kind than it
+    has free slots for, the rest stay in the streams for other workers.
+    A job that fails with a retryable error is retried with exponential
+    backoff and jitter. After `max_attempts` attempts, or any other error,
+    it is moved to the dead letter stream and its failure handler, if any,
+    is called. Jobs are acknowledged only once they are done or
+    rescheduled, and those left behind by a worker that stopped are taken
+    over after CLAIM_IDLE seconds.
+    """
+
+    def __init__(self,
+                 handlers: Dict[str, Callable[..., Awaitable]],
+                 bot,
+                 kinds: Optional[Iterable[str]] = None,
+                 failure_handlers: Optional[Dict[str, Callable[..., Awaitable]]] = None,
+                 concurrency: int = CONCURRENCY,
+                 max_attempts: int = MAX_ATTEMPTS,
+                 client=None):
+        self.handlers = handlers
+        self.failure_handlers = failure_handlers or {}
+        self.bot = bot
+        self.kinds = list(kinds or handlers)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._client = client
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+        self._slots = asyncio.Semaphore(concurrency)
+        # jobs holding a slot
+        self._running = 0
+        self._tasks = set()
+        self._stop = asyncio.Event()
+
+    @property
+    def client(self):
+        return self._client or get_redis_client()
+
+    async def _ensure_groups(self):
+        for kind in self.kinds:
+            try:
+                await self.client.xgroup_create(stream_key(kind), GROUP, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def _retry_delay(self, attempts, error):
+        delay = backoff(attempts, RETRY_BASE, RETRY_CAP)
+        if isinstance(error, CircuitOpen):
+            # no point in trying before the upstream may be back
+            delay = max(delay, error.retry_in)
+        return delay
+
+    async def _failed(self, job, error):
+        attempts = job["attempts"] + 1
+        retryable = isinstance(error, RetryLater) or is_retryable(error)
+        if isinstance(error, CircuitOpen):
+            # a user waiting for the result is told right away instead of
+            # after minutes of retries, background jobs wait for the upstream
+            retryable = job["kind"] not in self.failure_handlers
+        if retryable and attempts < self.max_attempts:
+            logger.warning("Job %s failed (%r), retrying", job["kind"], error)
+            await enqueue(job["kind"], job["payload"],
+                          delay=self._retry_delay(attempts, error),
+                          attempts=attempts,
+                          client=self.client)
+            return
+
+        logger.error("Job %s failed on attempt %d, giving up: %r", job["kind"], attempts, error)
+        await self.client.xadd(DEAD_KEY, {"job": json.dumps(job), "error": repr(error)})
+        on_failure = self.failure_handlers.get(job["kind"])
+        if on_failure is not None:
+            try:
+                await on_failure(self.bot, job["payload"], error)
+            except Exception:
+                logger.exception("Failure handler of %s failed", job["kind"])
+
+    async def _run(self, key, entry_id, job):
+        try:
+            try:
+                await self.handlers[job["kind"]](self.bot, job["payload"])
+            except Exception as e:
+                await self._failed(job, e)
+            pipe = self.client.pipeline(transaction=True)
+            pipe.xack(key, GROUP, entry_id)
+            pipe.xdel(key, entry_id)
+            await pipe.execute()
+        except Exception:
+            # left pending, another worker takes it over later
+            logger.exception("Failed to finish job %s", entry_id)
+        finally:
+            self._running -= 1
+            self._slots.release()
+
+    async def _dispatch(self, key, entries):
+        for entry_id, fields in entries:
+            if not fields:
+                continue
+            await self._slots.acquire()
+            self._running += 1
+            task = asyncio.create_task(self._run(key, entry_id, json.loads(fields[b"job"])))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _read(self):
+        streams = {stream_key(kind): ">" for kind in self.kinds}
+        while not self._stop.is_set():
+            # wait for a free slot before reading, so jobs stay in the
+            # stream for other workers while this one is busy. COUNT
+            # applies to each stream, with several kinds a read can take
+            # more jobs than there are free slots, those wait for one
+            await self._slots.acquire()
+            self._slots.release()
+            try:
+                response = await self.client.xreadgroup(GROUP, self.consumer, streams,
+                                                        count=self.concurrency - self._running,
+                                                        block=1000)
+            except redis.RedisError:
+                logger.exception("Failed to read jobs")
+                await asyncio.sleep(1)
+                continue
+            for key, entries in response:
+                await self._dispatch(key.decode("utf-8"), entries)
+
+    async def _promote(self, interval=1.):
+        # moves delayed jobs that are due to their streams
+        script = self.client.register_script(_PROMOTE)
+        while not self._stop.is_set():
+            try:
+                due = await self.client.zrangebyscore(DELAYED_KEY, 0, time(), start=0, num=100)
+                for member in due:
+                    job = json.loads(member)
+                    await script(keys=[DELAYED_KEY, stream_key(job["kind"])], args=[member])
+            except redis.RedisError:
+                logger.exception("Failed to move delayed jobs")
+            await self._sleep(interval)
+
+    async def _claim(self):
+        while not self._stop.is_set():
+            for kind in self.kinds:
+                try:
+                    result = await self.client.xautoclaim(stream_key(kind), GROUP, self.consumer,
+                                                          min_idle_time=CLAIM_IDLE * 1000,
+                                                          start_id="0-0",
+                                                          count=self.concurrency)
+                    await self._dispatch(stream_key(kind), result[1])
+                except redis.RedisError:
+                    logger.exception("Failed to claim abandoned jobs")
+            await self._sleep(CLAIM_IDLE / 2)
+
+    async def _sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._stop.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        await self._ensure_groups()
+        await asyncio.gather(self._read(), self._promote(), self._claim())
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+
+    def stop(self):
+        self._stop.set()
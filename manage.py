@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+
+from cache import init_redis_pool, close_redis_pool, migrate_index, migrate_key_schema
+from cache import quantize_vectors, drop_user_indexes, get_full_vector_store
+from cache import INDEX_TYPE, HNSW_M, HNSW_EF_CONSTRUCTION, HNSW_EF_RUNTIME
+from cache import INDEX_PARTITIONING, VECTOR_TYPE, VECTOR_FIELD_SUFFIX, INDEX_NAME, INDEX_ALIAS
+from cache import create_index
+from archive import export_notes, reembed_notes, field_suffix
+from _openai import EMBEDDING_MODEL
+
+
+async def _migrate_index(args):
+    client = await init_redis_pool()
+    try:
+        await migrate_index(client,
+                            index_type=args.type,
+                            drop_old=not args.keep_old,
+                            m=args.m,
+                            ef_construction=args.ef_construction,
+                            ef_runtime=args.ef_runtime)
+    finally:
+        await close_redis_pool()
+
+
+async def _quantize(args):
+    client = await init_redis_pool()
+    store = None if args.no_full_vectors else get_full_vector_store()
+    try:
+        converted = await quantize_vectors(client, args.type, store, batch=args.batch)
+        print(f"Added {args.type} vectors to {converted} notes")
+
+        if INDEX_PARTITIONING == "user":
+            await drop_user_indexes(client)
+        else:
+            await migrate_index(client, vector_type=args.type)
+
+        if not args.keep_float32:
+            # also converts the notes saved since the first pass
+            converted = await quantize_vectors(client, args.type, store,
+                                               drop_float32=True, batch=args.batch)
+            print(f"Removed the float32 vectors, {converted} more notes converted")
+    finally:
+        await close_redis_pool()
+
+
+async def _migrate_keys(args):
+    client = await init_redis_pool()
+    try:
+        moved, deleted = await migrate_key_schema(client, batch=args.batch)
+        print(f"Moved {moved} pointers to the message_id index, deleted {deleted} records")
+    finally:
+        await close_redis_pool()
+
+
+async def _export(args):
+    client = await init_redis_pool()
+    try:
+        written = await export_notes(client, args.out, args.checkpoint or f"{args.out}.checkpoint",
+                                     user_id=args.user, count=args.batch,
+                                     vectors=args.vectors)
+        print(f"Wrote {written} notes to {args.out}")
+    finally:
+        await close_redis_pool()
+
+
+async def _reembed(args):
+    client = await init_redis_pool()
+    suffix = field_suffix(args.model)
+    try:
+        done, edited = await reembed_notes(client, args.model, args.checkpoint,
+                                           user_id=args.user, count=args.batch,
+                                           batch=args.embed_batch, suffix=suffix)
+        print(f"Re-embedded {done} notes with {args.model}, "
+              f"{edited} were edited meanwhile")
+        # the notes saved or edited during the first pass
+        done, edited = await reembed_notes(client, args.model, args.checkpoint,
+                                           user_id=args.user, count=args.batch,
+                                           batch=args.embed_batch, suffix=suffix)
+        print(f"Re-embedded {done} more notes")
+        if suffix == VECTOR_FIELD_SUFFIX:
+            print("The bots search these vectors already, nothing left to switch")
+            return
+        if args.user is not None:
+            print("Re-embed everybody's notes before switching to the new vectors")
+            return
+
+        # behind an alias of its own, the bots keep searching theirs until
+        # they are configured with the new suffix. Per-user indexes over
+        # the new field are created by the users' next searches
+        if INDEX_PARTITIONING != "user":
+            await create_index(client, index_name=INDEX_NAME + suffix,
+                               alias=INDEX_ALIAS + suffix, wait=True,
+                               vector_type=VECTOR_TYPE, suffix=suffix)
+        print(f"Set EMBEDDING_MODEL to {args.model} and VECTOR_FIELD_SUFFIX to {suffix} "
+              f"and restart the bots. Once all of them run with the new settings, "
+              f"run this again to embed the notes saved in the meantime")
+    finally:
+        await close_redis_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the bot's data")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrate = commands.add_parser("migrate-index",
+                                  help="rebuild the vector index and swap it in without downtime")
+    migrate.add_argument("--type", default=INDEX_TYPE, type=str.upper,
+                         choices=["FLAT", "HNSW"])
+    migrate.add_argument("--m", default=HNSW_M, type=int)
+    migrate.add_argument("--ef-construction", default=HNSW_EF_CONSTRUCTION, type=int)
+    migrate.add_argument("--ef-runtime", default=HNSW_EF_RUNTIME, type=int)
+    migrate.add_argument("--keep-old", action="store_true",
+                         help="don't drop the previous index after the swap")
+    migrate.set_defaults(func=_migrate_index)
+
+    quantize = commands.add_parser("quantize",
+                                   help="store the vectors as float16 or int8 and reindex them")
+    # defaults to the VECTOR_TYPE the bot is configured with
+    quantize.add_argument("--type", type=str.upper, choices=["FLOAT16", "INT8"],
+                          required=VECTOR_TYPE == "FLOAT32",
+                          default=None if VECTOR_TYPE == "FLOAT32" else VECTOR_TYPE)
+    quantize.add_argument("--batch", default=500, type=int)
+    quantize.add_argument("--keep-float32", action="store_true",
+                          help="leave the float32 vectors in Redis")
+    quantize.add_argument("--no-full-vectors", action="store_true",
+                          help="don't copy the float32 vectors to FULL_VECTOR_STORE")
+    quantize.set_defaults(func=_quantize)
+
+    migrate_keys = commands.add_parser("migrate-keys",
+                                       help="move the notes to the compact key layout "
+                                            "while the bot runs")
+    migrate_keys.add_argument("--batch", default=1000, type=int, help="keys per round trip")
+    migrate_keys.set_defaults(func=_migrate_keys)
+
+    export = commands.add_parser("export",
+                                 help="write the notes to a JSON lines file, resumably")
+    export.add_argument("out")
+    export.add_argument("--user", type=int, help="only this user's notes")
+    export.add_argument("--vectors", action="store_true", help="include the embeddings")
+    export.add_argument("--batch", default=1000, type=int, help="notes read per round trip")
+    export.add_argument("--checkpoint",
+                        help="progress file, OUT.checkpoint by default")
+    export.set_defaults(func=_export)
+
+    reembed = commands.add_parser("reembed",
+                                  help="embed the notes with another model into a new "
+                                       "index next to the live one, resumably")
+    reembed.add_argument("--model", default=EMBEDDING_MODEL)
+    reembed.add_argument("--user", type=int, help="only this user's notes")
+    reembed.add_argument("--batch", default=1000, type=int, help="notes read per round trip")
+    reembed.add_argument("--embed-batch", default=500, type=int,
+                         help="texts per embeddings request")
+    reembed.add_argument("--checkpoint", default="reembed.checkpoint",
+                         help="progress file, an interrupted run resumes from it")
+    reembed.set_defaults(func=_reembed)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
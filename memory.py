@@ -0,0 +1,198 @@
+from typing import List, Union
+from uuid import uuid4
+import json
+
+from _openai import aget_response, count_tokens, CHAT_MODEL, BACKGROUND
+from cache import get_redis_client
+from utils import get_config
+
+
+config = get_config()
+
+# tokens of past conversation sent along with each message, the summary
+# of older turns included
+CONTEXT_TOKENS = config.getint("CHATGPT", "CONTEXT_TOKENS", fallback=2000)
+# upper bound on the length of the summary of older turns
+SUMMARY_TOKENS = config.getint("CHATGPT", "SUMMARY_TOKENS", fallback=300)
+SUMMARY_MODEL = config.get("CHATGPT", "SUMMARY_MODEL", fallback=CHAT_MODEL)
+# seconds a conversation is remembered since its last message
+MEMORY_TTL = config.getint("CHATGPT", "MEMORY_TTL", fallback=7 * 24 * 3600)
+# seconds a compaction may hold a conversation's lock
+LOCK_TTL = 120
+PREFIX = "gpt"
+
+# per message overhead of the chat format
+MESSAGE_TOKENS = 4
+
+SUMMARY_PROMPT = ("Summarize the conversation between the user and the assistant "
+                  "below for the assistant's future reference. Keep names, facts, "
+                  "decisions and open questions, drop pleasantries. Answer with "
+                  "the summary only, in at most {} words.")
+
+
+def _turns_key(user_id):
+    return f"{PREFIX}:<{int(user_id)}>:turns"
+
+
+def _summary_key(user_id):
+    return f"{PREFIX}:<{int(user_id)}>:summary"
+
+
+def _lock_key(user_id):
+    return f"{PREFIX}:<{int(user_id)}>:compacting"
+
+
+def _generation_key(user_id):
+    # bumped whenever the turns are rewritten other than at the tail
+    return f"{PREFIX}:<{int(user_id)}>:generation"
+
+
+def _message(turn):
+    return {"role": turn["role"], "content": turn["content"]}
+
+
+def _summary_message(summary):
+    return {"role": "system",
+            "content": f"Summary of the earlier conversation: {summary}"}
+
+
+async def get_context(user_id: Union[int, str],
+                      budget: int = CONTEXT_TOKENS) -> List[dict]:
+    """
+    Returns the messages to send before the user's new one: the summary of
+    older turns, if there is one, and as many of the most recent turns as
+    fit in `budget` tokens along with it.
+    """
+    client = get_redis_client()
+    pipe = client.pipeline(transaction=False)
+    pipe.hmget(_summary_key(user_id), "text", "tokens")
+    pipe.lrange(_turns_key(user_id), 0, -1)
+    (summary, summary_tokens), turns = await pipe.execute()
+
+    context = []
+    if summary is not None:
+        context.append(_summary_message(summary.decode("utf-8")))
+        budget -= int(summary_tokens) + MESSAGE_TOKENS
+
+    recent = []
+    for turn in map(json.loads, reversed(turns)):
+        budget -= turn["tokens"] + MESSAGE_TOKENS
+        if budget < 0:
+            break
+        recent.append(_message(turn))
+    return context + recent[::-1]
+
+
+async def add_turn(user_id: Union[int, str], prompt: str, reply: str):
+    client = get_redis_client()
+    turns = [{"role": "user", "content": prompt, "tokens": count_tokens(prompt)},
+             {"role": "assistant", "content": reply, "tokens": count_tokens(reply)}]
+    pipe = client.pipeline(transaction=True)
+    pipe.rpush(_turns_key(user_id), *[json.dumps(turn) for turn in turns])
+    pipe.expire(_turns_key(user_id), MEMORY_TTL)
+    pipe.expire(_summary_key(user_id), MEMORY_TTL)
+    await pipe.execute()
+
+
+async def forget(user_id: Union[int, str]):
+    client = get_redis_client()
+    pipe = client.pipeline(transaction=True)
+    pipe.delete(_turns_key(user_id), _summary_key(user_id))
+    # a summary being made of the forgotten turns is dropped
+    pipe.incr(_generation_key(user_id))
+    pipe.expire(_generation_key(user_id), MEMORY_TTL)
+    await pipe.execute()
+
+
+async def summarize(summary: str, turns: List[dict], max_tokens: int = SUMMARY_TOKENS,
+                    user_id=None):
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    if summary:
+        transcript = f"Earlier summary: {summary}\n\n{transcript}"
+    completion = dict(model=SUMMARY_MODEL,
+                      messages=[{"role": "system",
+                                 "content": SUMMARY_PROMPT.format(max_tokens * 3 // 4)},
+                                {"role": "user", "content": transcript}],
+                      max_tokens=max_tokens)
+    return await aget_response(completion, user_id=user_id, priority=BACKGROUND)
+
+
+# stores the summary and drops the turns it covers, unless the turns
+# were forgotten or compacted by someone else since they were read
+_STORE_SUMMARY = """
+if (redis.call('GET', KEYS[3]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[2], 'text', ARGV[3], 'tokens', ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('LTRIM', KEYS[1], ARGV[2], -1)
+redis.call('INCR', KEYS[3])
+redis.call('EXPIRE', KEYS[3], ARGV[5])
+return 1
+"""
+
+# deletes the lock only if this compaction still holds it
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _evicted(turns, budget, summary_budget):
+    # the recent turns are kept verbatim in what is left after the summary
+    available = budget - summary_budget - MESSAGE_TOKENS
+    kept = 0
+    for turn in reversed(turns):
+        if available - turn["tokens"] - MESSAGE_TOKENS < 0:
+            break
+        available -= turn["tokens"] + MESSAGE_TOKENS
+        kept += 1
+    return len(turns) - kept
+
+
+async def compact(user_id: Union[int, str],
+                  budget: int = CONTEXT_TOKENS,
+                  summary_budget: int = SUMMARY_TOKENS) -> bool:
+    """
+    Folds the oldest turns into the summary once the turns alone no longer
+    fit in what is left of `budget` after the summary. Only the turns that
+    don't fit are summarized, together with the previous summary, so each
+    turn goes through the summarizer once. Returns whether it did.
+    """
+    client = get_redis_client()
+    turns_key = _turns_key(user_id)
+    if _evicted([json.loads(turn) for turn in await client.lrange(turns_key, 0, -1)],
+                budget, summary_budget) == 0:
+        return False
+
+    # only one process summarizes a conversation at a time
+    token = uuid4().hex
+    if not await client.set(_lock_key(user_id), token, nx=True, ex=LOCK_TTL):
+        return False
+    try:
+        # read again under the lock, another compaction may have finished
+        # since, and note the generation to tell whether the turns are
+        # forgotten or compacted while the summary is being made
+        pipe = client.pipeline(transaction=True)
+        pipe.get(_generation_key(user_id))
+        pipe.hget(_summary_key(user_id), "text")
+        pipe.lrange(turns_key, 0, -1)
+        generation, summary, turns = await pipe.execute()
+        turns = [json.loads(turn) for turn in turns]
+        evicted = _evicted(turns, budget, summary_budget)
+        if evicted == 0:
+            return False
+
+        summary = summary.decode("utf-8") if summary is not None else ""
+        summary = await summarize(summary, turns[:evicted], summary_budget, user_id)
+
+        # turns added meanwhile are at the tail and stay
+        script = client.register_script(_STORE_SUMMARY)
+        return bool(await script(keys=[turns_key, _summary_key(user_id),
+                                       _generation_key(user_id)],
+                                 args=[generation or b"0", evicted, summary,
+                                       count_tokens(summary), MEMORY_TTL]))
+    finally:
+        await client.register_script(_RELEASE)(keys=[_lock_key(user_id)], args=[token])
@@ -0,0 +1,207 @@
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, Tuple
+import asyncio
+import contextlib
+import logging
+import time
+
+from utils import get_config
+
+
+config = get_config()
+
+# with metrics disabled, recording them costs a function call and a check
+ENABLED = config.getboolean("METRICS", "ENABLED", fallback=False)
+LISTEN = config.get("METRICS", "LISTEN", fallback="127.0.0.1")
+PORT = config.getint("METRICS", "PORT", fallback=9108)
+
+# seconds, from a Redis round trip to a long transcription
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+logger = logging.getLogger(__name__)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+
+    type = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._values = {}
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, *labels):
+        if not ENABLED:
+            return
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+
+    type = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket, sum, count]
+        self._values = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        if not ENABLED:
+            return
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0., 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        names = self.labels + ("le",)
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                yield f"{self.name}_bucket{_format_labels(names, labels + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {count}"
+
+
+def add_collector(name: str, type: str, doc: str,
+                  collect: Callable[[], Iterable[Tuple[Dict[str, str], float]]]):
+    """
+    Exposes values kept elsewhere, such as cache statistics, read when
+    the endpoint is scraped. `collect` returns (labels, value) pairs.
+    """
+    _collectors.append((name, type, doc, collect))
+
+
+stage_seconds = Histogram("bot_stage_seconds",
+                          "Time spent in each stage of a pipeline",
+                          ("pipeline", "stage"))
+stage_errors = Counter("bot_stage_errors_total",
+                       "Stages that ended with an exception",
+                       ("pipeline", "stage"))
+openai_seconds = Histogram("openai_request_seconds",
+                           "Duration of OpenAI requests, retries not included",
+                           ("kind",))
+openai_tokens = Counter("openai_tokens_total",
+                        "Tokens used by OpenAI requests",
+                        ("kind", "type"))
+openai_bytes = Counter("openai_bytes_total",
+                       "Bytes of input sent with OpenAI requests",
+                       ("kind",))
+openai_queue_seconds = Histogram("openai_queue_seconds",
+                                 "Time requests waited for the rate limiter",
+                                 ("kind",))
+
+
+class _Stage:
+
+    __slots__ = ("labels", "start")
+
+    def __init__(self, labels):
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        stage_seconds.observe(time.perf_counter() - self.start, *self.labels)
+        if exc_type is not None:
+            stage_errors.inc(1, *self.labels)
+
+
+_DISABLED = contextlib.nullcontext()
+
+
+def stage(pipeline: str, name: str):
+    """
+    Times the block it wraps as stage `name` of `pipeline`:
+
+        with stage("voice", "download"):
+            ...
+    """
+    if not ENABLED:
+        return _DISABLED
+    return _Stage((pipeline, name))
+
+
+def render() -> str:
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.doc}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.render())
+    for name, type, doc, collect in _collectors:
+        lines.append(f"# HELP {name} {doc}")
+        lines.append(f"# TYPE {name} {type}")
+        try:
+            for labels, value in collect():
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} "
+                             f"{value}")
+        except Exception:
+            logger.exception("Failed to collect %s", name)
+    return "\n".join(lines) + "\n"
+
+
+async def _serve(reader, writer):
+    try:
+        request = await reader.readline()
+        while await reader.readline() not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode("latin-1").split(" ")
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b""
+        writer.write(f"HTTP/1.1 {status}\r\n"
+                     "Content-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     "Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(listen: str = LISTEN, port: int = PORT):
+    """
+    Serves the metrics in the Prometheus text format on /metrics, if they
+    are enabled. Returns the server, or None.
+    """
+    if not ENABLED:
+        return None
+    try:
+        server = await asyncio.start_server(_serve, listen, port)
+    except OSError as e:
+        logger.warning("Metrics endpoint not started on %s:%d: %s", listen, port, e)
+        return None
+    logger.info("Serving metrics on %s:%d/metrics", listen, port)
+    return server
@@ -0,0 +1,151 @@
+from copy import deepcopy
+from hashlib import sha1
+from typing import Dict, Optional
+import json
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from cache import get_redis_client
+from utils import get_config
+
+
+config = get_config()
+
+PREFIX = "persist"
+# seconds between writes of changed data to Redis
+UPDATE_INTERVAL = config.getfloat("MAIN", "PERSIST_INTERVAL", fallback=5)
+
+
+def _data_key(kind, key=None):
+    return f"{PREFIX}:{kind}" if key is None else f"{PREFIX}:{kind}:<{key}>"
+
+
+def _conversation_key(name):
+    return f"{PREFIX}:conversation:<{name}>"
+
+
+class RedisPersistence(BasePersistence):
+    """
+    Keeps user, chat and bot data in Redis, one hash per entry with the
+    pickled data and a version number. Only entries whose pickle changed
+    since they were last written are sent to Redis, so the cost of a flush
+    depends on how many users were active rather than on how many there are.
+
+    Nothing is loaded at startup: an entry is read the first time an update
+    for its user or chat comes in, and read again whenever another process
+    has written a newer version of it, so several bot processes can share
+    the same data. Concurrent writes of one entry are last-writer-wins.
+    """
+
+    def __init__(self,
+                 store_data: Optional[PersistenceInput] = None,
+                 update_interval: float = UPDATE_INTERVAL,
+                 client=None):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self._client = client
+        # (kind, key) -> version last read or written by this process
+        self._versions = {}
+        # (kind, key) -> digest of the pickle last read or written
+        self._digests = {}
+
+    @property
+    def client(self):
+        # not cached, the pool is recreated if the bot restarts it
+        return self._client or get_redis_client()
+
+    async def _load(self, kind, key, data):
+        """
+        Replaces the contents of `data` with the stored entry if Redis has
+        a version this process hasn't seen. Returns True if it did.
+        """
+        redis_key = _data_key(kind, key)
+        version = await self.client.hget(redis_key, "version")
+        if version is None or int(version) == self._versions.get((kind, key)):
+            return False
+        blob, version = await self.client.hmget(redis_key, "data", "version")
+        if blob is None:
+            return False
+        data.clear()
+        data.update(pickle.loads(blob))
+        self._versions[(kind, key)] = int(version)
+        self._digests[(kind, key)] = sha1(blob).digest()
+        return True
+
+    async def _store(self, kind, key, data):
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = sha1(blob).digest()
+        if self._digests.get((kind, key)) == digest:
+            return
+        redis_key = _data_key(kind, key)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(redis_key, "data", blob)
+        pipe.hincrby(redis_key, "version", 1)
+        _, version = await pipe.execute()
+        self._versions[(kind, key)] = version
+        self._digests[(kind, key)] = digest
+
+    async def _drop(self, kind, key):
+        await self.client.delete(_data_key(kind, key))
+        self._versions.pop((kind, key), None)
+        self._digests.pop((kind, key), None)
+
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, dict]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        data = {}
+        await self._load("bot", None, data)
+        return data
+
+    async def get_callback_data(self):
+        blob = await self.client.get(_data_key("callback"))
+        return None if blob is None else pickle.loads(blob)
+
+    async def get_conversations(self, name: str) -> dict:
+        states = await self.client.hgetall(_conversation_key(name))
+        return {tuple(json.loads(key)): json.loads(state)
+                for key, state in states.items()}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        field = json.dumps(list(key))
+        if new_state is None:
+            await self.client.hdel(_conversation_key(name), field)
+        else:
+            await self.client.hset(_conversation_key(name), field, json.dumps(new_state))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        await self._store("user", user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        await self._store("chat", chat_id, data)
+
+    async def update_bot_data(self, data: dict) -> None:
+        await self._store("bot", None, data)
+
+    async def update_callback_data(self, data) -> None:
+        await self.client.set(_data_key("callback"), pickle.dumps(deepcopy(data)))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop("user", user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop("chat", chat_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        await self._load("user", user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        await self._load("chat", chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        await self._load("bot", None, bot_data)
+
+    async def flush(self) -> None:
+        # nothing is buffered here: the application writes the data that
+        # changed every update_interval seconds, and once more on shutdown
+        # before calling this
+        pass
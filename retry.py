@@ -0,0 +1,185 @@
+from typing import Awaitable, Callable, Optional
+import asyncio
+import logging
+import random
+import sys
+import time
+
+import redis
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from utils import get_config
+
+
+config = get_config()
+
+ATTEMPTS = config.getint("RETRY", "ATTEMPTS", fallback=4)
+# seconds, the backoff before attempt n is drawn from [0, min(CAP, BASE * 2**n)]
+BACKOFF_BASE = config.getfloat("RETRY", "BACKOFF_BASE", fallback=0.5)
+BACKOFF_CAP = config.getfloat("RETRY", "BACKOFF_CAP", fallback=10)
+# consecutive failures after which calls to an upstream fail fast
+BREAKER_THRESHOLD = config.getint("RETRY", "BREAKER_THRESHOLD", fallback=5)
+# seconds a tripped breaker waits before letting a trial call through
+BREAKER_RESET = config.getfloat("RETRY", "BREAKER_RESET", fallback=30)
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling an upstream that is known to be down.
+    """
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"{name} is unavailable, retry in {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures of calls to one upstream. After
+    `threshold` of them it opens and fails every call at once for
+    `reset_timeout` seconds, then lets a single trial call through: the
+    breaker closes if it succeeds and stays open for another period if
+    it fails.
+    """
+
+    def __init__(self, name: str,
+                 threshold: int = BREAKER_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def check(self):
+        state = self.state
+        if state == "open" or (state == "half-open" and self._trial):
+            raise CircuitOpen(self.name,
+                              max(0., self.opened_at + self.reset_timeout - time.monotonic()))
+        if state == "half-open":
+            self._trial = True
+
+    def abandon(self):
+        # the trial call was cancelled, let the next one try
+        self._trial = False
+
+    def success(self):
+        if self.opened_at is not None:
+            logger.info("%s is back, closing the circuit", self.name)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.threshold:
+            if self.opened_at is None or self._trial:
+                logger.warning("%s failed %d times, opening the circuit",
+                               self.name, self.failures)
+            self.opened_at = time.monotonic()
+            self._trial = False
+
+
+breakers = {name: CircuitBreaker(name) for name in ("openai", "telegram", "redis")}
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether trying the call again could succeed: timeouts, dropped
+    connections, rate limits and server side errors. Invalid requests
+    and authentication failures would fail the same way again.
+    """
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # openai is imported lazily, until it is none of its errors can occur
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        if isinstance(error, (openai.error.Timeout,
+                              openai.error.APIConnectionError,
+                              openai.error.RateLimitError,
+                              openai.error.ServiceUnavailableError,
+                              openai.error.TryAgain)):
+            return True
+        if isinstance(error, openai.error.APIError):
+            return error.http_status is None or error.http_status >= 500
+    if isinstance(error, (BadRequest, Forbidden)):
+        return False
+    if isinstance(error, (RetryAfter, TimedOut, NetworkError)):
+        return True
+    if isinstance(error, (redis.ConnectionError, redis.TimeoutError, redis.BusyLoadingError)):
+        return True
+    return False
+
+
+def backoff(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP) -> float:
+    # full jitter, so clients that failed together don't retry together
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def retry(fn: Callable[..., Awaitable],
+                *args,
+                attempts: int = ATTEMPTS,
+                deadline: Optional[float] = None,
+                breaker: Optional[CircuitBreaker] = None,
+                retryable: Callable[[BaseException], bool] = is_retryable,
+                acquire: Optional[Callable[[], Awaitable]] = None,
+                **kwargs):
+    """
+    Awaits `fn(*args, **kwargs)`, calling it again after a jittered
+    exponential backoff when it fails with a retryable error, at most
+    `attempts` times in all. With a `deadline`, in seconds, the attempts
+    together never take longer than that. A `breaker` is told about every
+    outcome, and while it is open the call fails with CircuitOpen without
+    being made. `acquire` is awaited before every attempt, for a local
+    wait such as a rate limiter's queue: it counts against the deadline,
+    but running out of time in it isn't a failure of the upstream.
+    """
+    end = None if deadline is None else time.monotonic() + deadline
+    for attempt in range(attempts):
+        if acquire is not None:
+            if end is None:
+                await acquire()
+            else:
+                await asyncio.wait_for(acquire(), max(0., end - time.monotonic()))
+        if breaker is not None:
+            breaker.check()
+        try:
+            if end is None:
+                result = await fn(*args, **kwargs)
+            else:
+                result = await asyncio.wait_for(fn(*args, **kwargs),
+                                                max(0., end - time.monotonic()))
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.abandon()
+            raise
+        except Exception as e:
+            if not retryable(e):
+                # the upstream answered, it is the request that is wrong
+                if breaker is not None:
+                    breaker.success()
+                raise
+            if breaker is not None:
+                breaker.failure()
+            delay = e.retry_after if isinstance(e, RetryAfter) else backoff(attempt)
+            if attempt == attempts - 1 or (end is not None and time.monotonic() + delay >= end):
+                raise
+            logger.info("%s failed with %r, retrying in %.1fs",
+                        getattr(fn, "__qualname__", fn), e, delay)
+            await asyncio.sleep(delay)
+        else:
+            if breaker is not None:
+                breaker.success()
+            return result
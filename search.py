@@ -1,23 +1,128 @@
 from typing import Union
-import time
-from cache import get_redis_client, embed_text, search_redis
+from datetime import datetime
+
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.ext import ContextTypes
+from telegram.error import BadRequest
+
+from embeddings import get_embedding, normalize_text
+from cache import get_redis_client, search_redis
+from cache import save_search_results, get_search_results, get_messages
+from retry import retry, breakers
+from metrics import stage
+from utils import get_config, _
+
+
+config = get_config()
+
+PAGE_SIZE = config.getint("SEARCH", "PAGE_SIZE", fallback=5)
+# how many of the closest notes a search returns
+MAX_RESULTS = config.getint("SEARCH", "MAX_RESULTS", fallback=20)
+EXCERPT_LEN = 300
+CALLBACK_PREFIX = "search:"
 
 
 async def search_query(
         user_id: Union[int, str],
         user_query: str,
-        pause: int = 2,
+        k: int = MAX_RESULTS,
         ):
     redis_client = get_redis_client()
-    # embed the user query
-    while True:
-        try:
-            user_query_embedding = embed_text(user_query)
-            break
-        except:
-            print (f"Embedding failed, retrying in {pause} seconds...")
-            time.sleep(pause)
-    
-    return search_redis(redis_client,
-                        user_id,
-                        user_query_embedding,)
\ No newline at end of file
+    # retried and guarded by the circuit breaker inside
+    with stage("search", "embed"):
+        user_query_embedding = await get_embedding(user_query)
+
+    with stage("search", "redis"):
+        return await retry(search_redis, redis_client, user_id, user_query_embedding,
+                           k=k, breaker=breakers["redis"])
+
+
+async def ranked_results(user_id: Union[int, str], user_query: str):
+    """
+    Runs the search unless the user's cached results are for the same
+    query, and caches the ranked message keys for paging.
+    """
+    client = get_redis_client()
+    cached = await get_search_results(client, user_id, 0, 0)
+    if cached is not None and normalize_text(cached[0]) == normalize_text(user_query):
+        return
+
+    docs = await search_query(user_id, user_query)
+    await save_search_results(client, user_id, user_query, [doc.id for doc in docs])
+
+
+def _format_result(n, message, timestamp):
+    message = message.decode("utf-8") if message is not None else ""
+    if len(message) > EXCERPT_LEN:
+        message = message[:EXCERPT_LEN].rstrip() + "…"
+    when = ""
+    if timestamp is not None:
+        when = datetime.fromtimestamp(float(timestamp)).strftime("%Y-%m-%d %H:%M") + "\n"
+    return f"{n}. {when}{message}"
+
+
+def _page_keyboard(page, total):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(_("◀ Prev"),
+                                            callback_data=f"{CALLBACK_PREFIX}{page - 1}"))
+    if (page + 1) * PAGE_SIZE < total:
+        buttons.append(InlineKeyboardButton(_("Next ▶"),
+                                            callback_data=f"{CALLBACK_PREFIX}{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def render_page(user_id: Union[int, str], page: int):
+    """
+    Builds the text and keyboard of a page of the user's cached results
+    without running the search again. Returns None if they have expired.
+    """
+    client = get_redis_client()
+    start = page * PAGE_SIZE
+    cached = await get_search_results(client, user_id, start, start + PAGE_SIZE - 1)
+    if cached is None:
+        return None
+    query, keys, total = cached
+
+    if total == 0:
+        return _("Nothing found for \"{}\".").format(query), None
+
+    rows = await get_messages(client, keys)
+    lines = [_("Results for \"{}\" ({}-{} of {}):").format(
+                query, start + 1, start + len(keys), total)]
+    lines += [_format_result(start + i + 1, message, timestamp)
+              for i, (message, timestamp) in enumerate(rows)]
+    return "\n\n".join(lines), _page_keyboard(page, total)
+
+
+async def show_results(update: Update, context: ContextTypes.DEFAULT_TYPE, user_query: str):
+    user_id = update.effective_user.id
+    await ranked_results(user_id, user_query)
+    rendered = await render_page(user_id, 0)
+    if rendered is None:
+        return
+    text, reply_markup = rendered
+    with stage("search", "send_message"):
+        await retry(context.bot.send_message,
+                    chat_id=update.effective_chat.id,
+                    text=text,
+                    reply_markup=reply_markup,
+                    breaker=breakers["telegram"])
+
+
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    page = int(query.data[len(CALLBACK_PREFIX):])
+    rendered = await render_page(update.effective_user.id, page)
+    if rendered is None:
+        await query.answer(_("These results have expired, please search again."))
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    text, reply_markup = rendered
+    try:
+        await query.edit_message_text(text=text, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    await query.answer()
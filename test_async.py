@@ -1,31 +1,197 @@
 import asyncio
+import json
 import time
-from datetime import datetime
-
-
-waiting = False
-
-# Define a synchronous (blocking) function
-def blocking_function():
-    time.sleep(2)  # Simulate a blocking operation
-    return 'Blocking call result'
-
-async def async_function():
-    global waiting
-    print (datetime.now(), waiting)
-    loop = asyncio.get_event_loop()
-    # Run the synchronous function in a separate thread
-    waiting = True
-    future = loop.run_in_executor(None, blocking_function)
-    # Wait for the result of the synchronous function
-    result = await future
-    print(result)
-    waiting = False
-
-async def main():
-    await async_function()
-    
-
-# Run the main function
-asyncio.run(main())
-asyncio.run(main())
\ No newline at end of file
+
+import openai
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+
+import _openai
+import bot
+import chatgpt
+
+
+LATENCY = 0.5
+USERS = 8
+
+
+async def _chunks(text):
+    yield {"choices": [{"delta": {"content": text}}]}
+
+
+async def slow_completion(**kwargs):
+    # stands in for a slow OpenAI request without blocking the loop
+    await asyncio.sleep(LATENCY)
+    if kwargs.get("stream"):
+        return _chunks("ok")
+    return {"choices": [{"message": {"content": "ok"}}]}
+
+
+async def serve_users(n):
+    completion = _openai.make_completion("hello")
+    start = time.perf_counter()
+    results = await asyncio.gather(*[_openai.aget_response(completion)
+                                     for _ in range(n)])
+    return results, time.perf_counter() - start
+
+
+def test_concurrent_users_served_in_parallel(monkeypatch):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_completion)
+    monkeypatch.setitem(_openai.CONCURRENCY, "chat", USERS)
+    _openai._semaphores.clear()
+
+    results, elapsed = asyncio.run(serve_users(USERS))
+
+    assert results == ["ok"] * USERS
+    # serial handling would take USERS * LATENCY
+    assert elapsed < 2 * LATENCY, elapsed
+
+
+def test_concurrency_limit_is_respected(monkeypatch):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_completion)
+    monkeypatch.setitem(_openai.CONCURRENCY, "chat", 2)
+    _openai._semaphores.clear()
+
+    _, elapsed = asyncio.run(serve_users(4))
+
+    # 4 requests through 2 slots take two rounds
+    assert elapsed >= 2 * LATENCY, elapsed
+
+
+def test_timeout(monkeypatch):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_completion)
+    _openai._semaphores.clear()
+
+    completion = _openai.make_completion("hello")
+    try:
+        asyncio.run(_openai.aget_response(completion, timeout=LATENCY / 10))
+    except asyncio.TimeoutError:
+        return
+    assert False, "expected a timeout"
+
+
+class FakeTelegram(BaseRequest):
+    """
+    Answers the Bot API calls the handlers make without a network.
+    """
+
+    def __init__(self):
+        self.message_id = 0
+        self.sent = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "test", "username": "test_bot"}
+        elif api_method in ("sendMessage", "editMessageText"):
+            if api_method == "sendMessage":
+                self.message_id += 1
+            result = {"message_id": params.get("message_id", self.message_id),
+                      "date": int(time.time()),
+                      "chat": {"id": params["chat_id"], "type": "private"},
+                      "text": params.get("text", "")}
+            self.sent.append((params["chat_id"], params.get("text")))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def _text_update(update_id, user_id, text):
+    return {"update_id": update_id,
+            "message": {"message_id": update_id,
+                        "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"},
+                        "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+                        "text": text}}
+
+
+async def _nothing(*args, **kwargs):
+    return []
+
+
+async def handle_chat_messages(messages, concurrent_updates):
+    """
+    Feeds (user_id, text) messages of users in a ChatGPT conversation
+    through the bot's handlers, the way the application's update fetcher
+    does, and returns the time it took along with the prompts in the order
+    they were sent to OpenAI.
+    """
+    request = FakeTelegram()
+    application = ApplicationBuilder().token("123:test").request(request).updater(None) \
+        .concurrent_updates(bot.ChatOrderedUpdateProcessor(concurrent_updates)).build()
+    bot.add_handlers(application)
+    await application.initialize()
+
+    prompts = []
+    acreate = openai.ChatCompletion.acreate
+
+    async def recording_completion(**kwargs):
+        prompts.append(kwargs["messages"][-1]["content"])
+        return await acreate(**kwargs)
+
+    openai.ChatCompletion.acreate = recording_completion
+    try:
+        updates = []
+        for i, (user_id, text) in enumerate(messages):
+            application.user_data[user_id]["chat_gpt"] = True
+            updates.append(Update.de_json(_text_update(i + 1, user_id, text), application.bot))
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(application.update_processor.process_update(
+                     update, application.process_update(update)))
+                 for update in updates]
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    finally:
+        openai.ChatCompletion.acreate = acreate
+        await application.shutdown()
+    return elapsed, prompts
+
+
+def _stub_chat(monkeypatch):
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", slow_completion)
+    monkeypatch.setitem(_openai.CONCURRENCY, "chat", USERS)
+    _openai._semaphores.clear()
+    # the conversation memory is kept in Redis
+    monkeypatch.setattr(chatgpt, "get_context", _nothing)
+    monkeypatch.setattr(chatgpt, "add_turn", _nothing)
+    monkeypatch.setattr(chatgpt, "compact", _nothing)
+
+
+def test_updates_of_different_chats_handled_in_parallel(monkeypatch):
+    _stub_chat(monkeypatch)
+    messages = [(1000 + i, "hello") for i in range(USERS)]
+
+    elapsed, prompts = asyncio.run(handle_chat_messages(messages, USERS))
+
+    assert len(prompts) == USERS
+    # one slow reply doesn't hold up the other chats
+    assert elapsed < 2 * LATENCY, elapsed
+
+
+def test_updates_of_a_chat_handled_in_order(monkeypatch):
+    _stub_chat(monkeypatch)
+    messages = [(1000, f"message {i}") for i in range(3)] + [(2000, "other chat")]
+
+    elapsed, prompts = asyncio.run(handle_chat_messages(messages, USERS))
+
+    assert [p for p in prompts if p.startswith("message")] == \
+        ["message 0", "message 1", "message 2"]
+    # the other chat didn't wait for the first one
+    assert prompts.index("other chat") < prompts.index("message 1")
+    assert elapsed >= 3 * LATENCY, elapsed
+
+
+def test_default_handles_updates_concurrently():
+    assert bot.CONCURRENT_UPDATES > 1
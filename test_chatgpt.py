@@ -0,0 +1,54 @@
+import asyncio
+
+from telegram.error import RetryAfter
+
+import chatgpt
+from chatgpt import split_text, utf16_len
+
+
+def test_split_text_counts_utf16_code_units():
+    # each emoji is two code units, so only half of them fit
+    text = "\U0001F600" * 10
+    head, rest = split_text(text, limit=10)
+
+    assert head == "\U0001F600" * 5
+    assert rest == "\U0001F600" * 5
+    assert utf16_len(head) == 10
+
+
+def test_split_text_cuts_at_a_space():
+    head, rest = split_text("hello world again", limit=13)
+
+    assert head == "hello world"
+    assert rest == "again"
+
+
+def test_short_text_is_not_split():
+    assert split_text("hello", limit=10) == ("hello", "")
+
+
+class Message:
+
+    def __init__(self, throttled):
+        self.throttled = throttled
+        self.text = None
+
+    async def edit_text(self, text):
+        if self.throttled:
+            self.throttled -= 1
+            raise RetryAfter(0)
+        self.text = text
+
+
+def test_throttled_edit_is_skipped():
+    message = Message(throttled=1)
+
+    assert asyncio.run(chatgpt._edit(message, "partial")) is False
+    assert message.text is None
+
+
+def test_throttled_edit_with_wait_is_made_again():
+    message = Message(throttled=2)
+
+    assert asyncio.run(chatgpt._edit(message, "final", wait=True)) is True
+    assert message.text == "final"
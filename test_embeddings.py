@@ -0,0 +1,97 @@
+import asyncio
+
+from embeddings import EmbeddingBatcher
+
+
+class BadInput(Exception):
+    pass
+
+
+def _vector(text):
+    return [float(len(text))]
+
+
+async def embed_many(texts, model=None, priority=None):
+    # like the endpoint, one bad input fails the whole request
+    if any(text.startswith("bad") for text in texts):
+        raise BadInput(texts)
+    return [_vector(text) for text in texts]
+
+
+async def embed_one(text, model=None, priority=None):
+    if text.startswith("bad"):
+        raise BadInput(text)
+    return _vector(text)
+
+
+async def embed_all(batcher, texts):
+    return await asyncio.gather(*[batcher.embed(text) for text in texts],
+                                return_exceptions=True)
+
+
+def test_requests_are_coalesced_into_one_batch():
+    batcher = EmbeddingBatcher(window=0.01, embed_many_fn=embed_many, embed_one_fn=embed_one)
+
+    results = asyncio.run(embed_all(batcher, ["a", "bb", "ccc"]))
+
+    assert results == [[1.], [2.], [3.]]
+    assert batcher.stats["batches"] == 1
+    assert batcher.stats["fallbacks"] == 0
+
+
+def test_bad_input_fails_only_its_own_request():
+    batcher = EmbeddingBatcher(window=0.01, embed_many_fn=embed_many, embed_one_fn=embed_one)
+
+    results = asyncio.run(embed_all(batcher, ["a", "bad", "ccc"]))
+
+    assert results[0] == [1.]
+    assert isinstance(results[1], BadInput)
+    assert results[2] == [3.]
+    assert batcher.stats["fallbacks"] == 1
+
+
+def test_outage_fails_every_request_without_fallback():
+    calls = []
+
+    async def down(texts, model=None, priority=None):
+        raise asyncio.TimeoutError()
+
+    async def one(text, model=None, priority=None):
+        calls.append(text)
+        return _vector(text)
+
+    batcher = EmbeddingBatcher(window=0.01, embed_many_fn=down, embed_one_fn=one)
+
+    results = asyncio.run(embed_all(batcher, ["a", "bb"]))
+
+    assert all(isinstance(result, asyncio.TimeoutError) for result in results)
+    # retrying the items one by one would only add load to a failing upstream
+    assert calls == []
+
+
+def test_full_batch_is_sent_at_once():
+    batcher = EmbeddingBatcher(window=60, max_batch=2,
+                               embed_many_fn=embed_many, embed_one_fn=embed_one)
+
+    async def run():
+        return await asyncio.wait_for(embed_all(batcher, ["a", "bb"]), 1)
+
+    assert asyncio.run(run()) == [[1.], [2.]]
+
+
+def test_batches_in_flight_are_referenced():
+    async def slow(texts, model=None, priority=None):
+        await asyncio.sleep(0.05)
+        return await embed_many(texts)
+
+    batcher = EmbeddingBatcher(window=0.01, embed_many_fn=slow, embed_one_fn=embed_one)
+
+    async def run():
+        request = asyncio.ensure_future(batcher.embed("a"))
+        await asyncio.sleep(0.03)
+        in_flight = len(batcher._tasks)
+        await request
+        return in_flight
+
+    assert asyncio.run(run()) == 1
+    assert not batcher._tasks
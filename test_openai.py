@@ -0,0 +1,121 @@
+import asyncio
+
+import numpy as np
+
+from _openai import RateLimiter, INTERACTIVE, BACKGROUND
+from _openai import silence_cuts, split_audio, stitch, resample
+
+SAMPLERATE = 16000
+
+
+async def served_order(requests, rpm=6000):
+    """
+    Queues `requests`, (user, priority) pairs, all at once and returns them
+    in the order the limiter lets them through.
+    """
+    limiter = RateLimiter("chat", rpm=rpm)
+    order = []
+
+    async def request(user_id, priority):
+        await limiter.acquire(user_id=user_id, priority=priority)
+        order.append((user_id, priority))
+
+    await asyncio.gather(*[request(user_id, priority) for user_id, priority in requests])
+    limiter._dispatcher.cancel()
+    return order
+
+
+def test_interactive_requests_go_before_background_ones():
+    order = asyncio.run(served_order([("a", BACKGROUND), ("b", BACKGROUND),
+                                      ("c", INTERACTIVE), ("d", INTERACTIVE)]))
+
+    assert [priority for _, priority in order] == [INTERACTIVE, INTERACTIVE,
+                                                   BACKGROUND, BACKGROUND]
+
+
+def test_users_take_turns_within_a_priority():
+    order = asyncio.run(served_order([("a", INTERACTIVE)] * 3 + [("b", INTERACTIVE),
+                                                                 ("c", INTERACTIVE)]))
+
+    assert [user_id for user_id, _ in order] == ["a", "b", "c", "a", "a"]
+
+
+def test_requests_wait_for_the_bucket_to_refill():
+    async def run():
+        limiter = RateLimiter("chat", rpm=600)
+        # start with an empty bucket, refilled at one request per 0.1s
+        limiter.drain()
+        start = asyncio.get_running_loop().time()
+        await asyncio.gather(limiter.acquire(user_id="a"), limiter.acquire(user_id="b"))
+        limiter._dispatcher.cancel()
+        return asyncio.get_running_loop().time() - start
+
+    assert 0.15 < asyncio.run(run()) < 1
+
+
+def speech_with_pauses(seconds, pauses):
+    # a loud tone, silent for half a second at each of `pauses`
+    data = 0.5 * np.sin(np.arange(seconds * SAMPLERATE, dtype=np.float32) / 5)
+    for pause in pauses:
+        data[int(pause * SAMPLERATE):int((pause + .5) * SAMPLERATE)] = 0
+    return data
+
+
+def test_recording_is_cut_in_its_pauses():
+    data = speech_with_pauses(25, pauses=[8, 17])
+
+    cuts = silence_cuts(data, SAMPLERATE, chunk_seconds=10, window_seconds=5)
+
+    assert len(cuts) == 2
+    assert 8 <= cuts[0] / SAMPLERATE <= 8.5
+    assert 17 <= cuts[1] / SAMPLERATE <= 17.5
+
+
+def test_segments_overlap_and_cover_the_recording():
+    data = speech_with_pauses(25, pauses=[8, 17])
+
+    segments = split_audio(data, SAMPLERATE, overlap=1, chunk_seconds=10, window_seconds=5)
+
+    assert len(segments) == 3
+    assert all(len(segment) <= 12 * SAMPLERATE for segment in segments)
+    # each boundary is in both segments next to it
+    assert sum(map(len, segments)) == len(data) + 2 * 2 * SAMPLERATE
+    assert np.array_equal(segments[0][-2 * SAMPLERATE:], segments[1][:2 * SAMPLERATE])
+
+
+def test_stitch_drops_the_words_the_overlap_repeats():
+    text = stitch(["Buy milk and bread, then", "Then call the", "call the doctor."])
+
+    assert text == "Buy milk and bread, then call the doctor."
+
+
+def test_stitch_keeps_words_that_only_look_repeated_further_back():
+    text = stitch(["one two three", "two four"])
+
+    assert text == "one two three two four"
+
+
+def tone(frequency, seconds, samplerate):
+    t = np.arange(int(seconds * samplerate)) / samplerate
+    return (0.5 * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+def test_long_recording_is_resampled_accurately():
+    # past 2**23 samples at 48 kHz, where float32 positions collide
+    data = tone(440, 200, 48000)
+
+    resampled = resample(data, 48000, SAMPLERATE)
+
+    reference = tone(440, 200, SAMPLERATE)
+    assert len(resampled) == len(reference)
+    # away from the edges, where the filter sees padding
+    assert np.abs(resampled - reference)[100:-100].max() < 0.01
+
+
+def test_resampling_down_filters_out_what_would_alias():
+    # above the 8 kHz the target rate can hold
+    data = tone(10000, 5, 48000)
+
+    resampled = resample(data, 48000, SAMPLERATE)
+
+    assert np.sqrt(np.mean(resampled[100:-100] ** 2)) < 0.01
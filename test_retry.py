@@ -0,0 +1,205 @@
+import asyncio
+import time
+
+import pytest
+
+import jobs
+import retry
+from retry import CircuitBreaker, CircuitOpen
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(retry.time, "monotonic", clock)
+    return clock
+
+
+def test_breaker_opens_after_threshold_failures(clock):
+    breaker = CircuitBreaker("upstream", threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.check()
+        breaker.failure()
+    assert breaker.state == "closed"
+
+    breaker.check()
+    breaker.failure()
+
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpen) as e:
+        breaker.check()
+    assert e.value.retry_in == 30
+
+
+def test_breaker_lets_one_trial_call_through_when_half_open(clock):
+    breaker = CircuitBreaker("upstream", threshold=1, reset_timeout=30)
+    breaker.failure()
+    clock.now += 30
+
+    assert breaker.state == "half-open"
+    breaker.check()
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_breaker_closes_when_the_trial_call_succeeds(clock):
+    breaker = CircuitBreaker("upstream", threshold=1, reset_timeout=30)
+    breaker.failure()
+    clock.now += 30
+    breaker.check()
+
+    breaker.success()
+
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+    breaker.check()
+
+
+def test_breaker_reopens_when_the_trial_call_fails(clock):
+    breaker = CircuitBreaker("upstream", threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.failure()
+    clock.now += 30
+    breaker.check()
+
+    breaker.failure()
+
+    assert breaker.state == "open"
+    clock.now += 29
+    with pytest.raises(CircuitOpen):
+        breaker.check()
+
+
+def test_breaker_abandoned_trial_lets_the_next_call_try(clock):
+    breaker = CircuitBreaker("upstream", threshold=1, reset_timeout=30)
+    breaker.failure()
+    clock.now += 30
+    breaker.check()
+
+    breaker.abandon()
+
+    breaker.check()
+
+
+def test_retry_stops_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(retry, "backoff", lambda attempt: 0.05)
+    calls = []
+
+    async def down():
+        calls.append(time.monotonic())
+        raise ConnectionError()
+
+    async def run():
+        start = time.monotonic()
+        with pytest.raises(ConnectionError):
+            await retry.retry(down, attempts=100, deadline=0.2)
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) < 0.2
+    assert 1 < len(calls) < 100
+
+
+def test_retry_deadline_cuts_a_slow_call_short():
+    async def slow():
+        await asyncio.sleep(10)
+
+    async def run():
+        start = time.monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await retry.retry(slow, attempts=1, deadline=0.05)
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) < 1
+
+
+def test_retry_fails_fast_while_the_circuit_is_open():
+    breaker = CircuitBreaker("upstream", threshold=1, reset_timeout=30)
+    breaker.failure()
+    calls = []
+
+    async def call():
+        calls.append(1)
+
+    with pytest.raises(CircuitOpen):
+        asyncio.run(retry.retry(call, breaker=breaker))
+    assert calls == []
+
+
+def test_waiting_in_the_local_queue_is_not_an_upstream_failure():
+    breaker = CircuitBreaker("upstream", threshold=1, reset_timeout=30)
+    calls = []
+
+    async def queued():
+        await asyncio.sleep(10)
+
+    async def call():
+        calls.append(1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(retry.retry(call, deadline=0.05, breaker=breaker, acquire=queued))
+    assert calls == []
+    assert breaker.state == "closed"
+
+
+class DeadLetters:
+
+    def __init__(self):
+        self.entries = []
+
+    async def xadd(self, key, fields):
+        self.entries.append((key, fields))
+
+
+def _job(kind):
+    return {"id": "1", "kind": kind, "payload": {"chat_id": 1}, "attempts": 0}
+
+
+def _worker(notified):
+    async def failed(bot, payload, error):
+        notified.append(error)
+
+    return jobs.JobWorker({"transcribe": None, "embed": None}, bot=None,
+                          failure_handlers={"transcribe": failed}, client=DeadLetters())
+
+
+def test_job_waiting_user_is_told_when_the_circuit_is_open(monkeypatch):
+    retried = []
+
+    async def enqueue(*args, **kwargs):
+        retried.append(args)
+
+    monkeypatch.setattr(jobs, "enqueue", enqueue)
+    notified = []
+    worker = _worker(notified)
+
+    asyncio.run(worker._failed(_job("transcribe"), CircuitOpen("openai", 30)))
+
+    assert retried == []
+    assert len(notified) == 1
+    assert len(worker.client.entries) == 1
+
+
+def test_background_job_waits_for_the_circuit_to_close(monkeypatch):
+    retried = []
+
+    async def enqueue(kind, payload, delay=0, **kwargs):
+        retried.append((kind, delay))
+
+    monkeypatch.setattr(jobs, "enqueue", enqueue)
+    notified = []
+    worker = _worker(notified)
+
+    asyncio.run(worker._failed(_job("embed"), CircuitOpen("openai", 30)))
+
+    assert len(retried) == 1
+    assert retried[0][1] >= 30
+    assert notified == []
@@ -0,0 +1,131 @@
+from hashlib import sha256
+from io import BytesIO
+from uuid import uuid4
+import asyncio
+
+from _openai import atranscribe_long
+from cache import get_redis_client
+from jobs import RetryLater
+from metrics import stage, add_collector
+from utils import get_config
+
+
+config = get_config()
+
+# seconds a transcript is kept since it was last used
+TTL = config.getint("CACHE", "TRANSCRIPT_TTL", fallback=30 * 24 * 3600)
+# seconds to wait for another worker that is transcribing the same file
+# before trying again later
+LOCK_WAIT = config.getfloat("CACHE", "TRANSCRIPT_LOCK_WAIT", fallback=30)
+LOCK_TTL = 600
+PREFIX = "tx"
+
+# deletes the lock only if this worker still holds it
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# file_unique_id -> task transcribing it in this process
+_inflight = {}
+stats = {"file_hits": 0, "content_hits": 0, "misses": 0, "collapsed": 0}
+add_collector("bot_transcript_cache_total", "counter",
+              "Transcript cache lookups by result",
+              lambda: [({"result": result}, n) for result, n in stats.items()])
+
+
+def _file_key(file_unique_id):
+    return f"{PREFIX}:file:<{file_unique_id}>"
+
+
+def _content_key(digest):
+    return f"{PREFIX}:sha:<{digest}>"
+
+
+def _lock_key(file_unique_id):
+    return f"{PREFIX}:lock:<{file_unique_id}>"
+
+
+async def _get(key):
+    client = get_redis_client()
+    pipe = client.pipeline(transaction=False)
+    pipe.get(key)
+    pipe.expire(key, TTL)
+    text, _ = await pipe.execute()
+    return text.decode("utf-8") if text is not None else None
+
+
+async def _store(text, file_unique_id, digest):
+    client = get_redis_client()
+    pipe = client.pipeline(transaction=False)
+    pipe.set(_file_key(file_unique_id), text, ex=TTL)
+    pipe.set(_content_key(digest), text, ex=TTL)
+    await pipe.execute()
+
+
+async def _download_and_transcribe(bot, file_id, file_unique_id, user_id):
+    with stage("voice", "get_file"):
+        new_file = await bot.get_file(file_id)
+    with BytesIO() as obuff:
+        with stage("voice", "download"):
+            await new_file.download_to_memory(out=obuff)
+        # the same recording can come with a different file_unique_id,
+        # e.g. when it was downloaded and sent again
+        digest = sha256(obuff.getbuffer()).hexdigest()
+        text = await _get(_content_key(digest))
+        if text is not None:
+            stats["content_hits"] += 1
+        else:
+            stats["misses"] += 1
+            with stage("voice", "whisper"):
+                text = (await atranscribe_long(obuff, user_id=user_id))["text"]
+    with stage("voice", "redis"):
+        await _store(text, file_unique_id, digest)
+    return text
+
+
+async def _transcribe_once(bot, file_id, file_unique_id, user_id):
+    # other workers transcribing the same file wait for this one
+    client = get_redis_client()
+    token = uuid4().hex
+    if not await client.set(_lock_key(file_unique_id), token, nx=True, ex=LOCK_TTL):
+        waited = 0.
+        while waited < LOCK_WAIT:
+            await asyncio.sleep(0.5)
+            waited += 0.5
+            text = await _get(_file_key(file_unique_id))
+            if text is not None:
+                stats["collapsed"] += 1
+                return text
+        raise RetryLater(file_unique_id)
+    try:
+        return await _download_and_transcribe(bot, file_id, file_unique_id, user_id)
+    finally:
+        await client.register_script(_RELEASE)(keys=[_lock_key(file_unique_id)], args=[token])
+
+
+async def transcribe_voice(bot, file_id: str, file_unique_id: str, user_id=None) -> str:
+    """
+    Returns the transcript of a voice message. A recording transcribed
+    before, whether looked up by its file_unique_id or by the hash of its
+    content, isn't downloaded or sent to Whisper again, and concurrent
+    requests for the same file, in this process or others, share one
+    transcription.
+    """
+    with stage("voice", "redis"):
+        text = await _get(_file_key(file_unique_id))
+    if text is not None:
+        stats["file_hits"] += 1
+        return text
+
+    task = _inflight.get(file_unique_id)
+    if task is not None:
+        stats["collapsed"] += 1
+        return await asyncio.shield(task)
+
+    task = asyncio.ensure_future(_transcribe_once(bot, file_id, file_unique_id, user_id))
+    _inflight[file_unique_id] = task
+    task.add_done_callback(lambda _: _inflight.pop(file_unique_id, None))
+    return await asyncio.shield(task)
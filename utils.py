@@ -9,7 +9,13 @@ def _(txt):
     return txt
 
 
+_configs = {}
+
+
 def get_config(fpath: Optional[str] =CONFIG_PATH):
-    config = configparser.ConfigParser()
-    config.read(fpath)
-    return config
+    # parsed once per process, every module shares the same object
+    if fpath not in _configs:
+        config = configparser.ConfigParser()
+        config.read(fpath)
+        _configs[fpath] = config
+    return _configs[fpath]
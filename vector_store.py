@@ -0,0 +1,67 @@
+from typing import Dict, Iterable, List
+import asyncio
+import sqlite3
+import threading
+
+import numpy as np
+
+
+class VectorStore:
+    """
+    Full-precision copies of the message embeddings, kept on disk in
+    SQLite so that Redis only has to hold the quantized vectors. Used to
+    re-rank search candidates exactly.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS vectors "
+                         "(key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self._local.conn = conn
+        return conn
+
+    def _put_many(self, items):
+        conn = self._connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO vectors (key, vector) VALUES (?, ?)",
+                             [(key, np.asarray(vector, dtype=np.float32).tobytes())
+                              for key, vector in items])
+
+    def _get_many(self, keys):
+        conn = self._connection()
+        found = {}
+        keys = list(keys)
+        # stay below sqlite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT key, vector FROM vectors WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk)
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def _delete_many(self, keys):
+        conn = self._connection()
+        with conn:
+            conn.executemany("DELETE FROM vectors WHERE key = ?", [(key,) for key in keys])
+
+    async def put(self, key: str, vector: List[float]):
+        await asyncio.to_thread(self._put_many, [(key, vector)])
+
+    async def put_many(self, items: Iterable):
+        await asyncio.to_thread(self._put_many, list(items))
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, np.ndarray]:
+        return await asyncio.to_thread(self._get_many, keys)
+
+    async def delete_many(self, keys: Iterable[str]):
+        await asyncio.to_thread(self._delete_many, list(keys))
@@ -1,18 +1,19 @@
-from io import BytesIO
-import time
-
-from telegram import Update, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardMarkup, Bot
 from telegram import InlineKeyboardButton
-from telegram.ext import ContextTypes, CallbackContext
-from telegram.error import TimedOut, BadRequest
+from telegram.ext import ContextTypes
+from telegram.error import BadRequest
 
-from _openai import make_completion, transcribe_audio
-from _openai import chatgpt_get_response, embed_text
+from _openai import make_completion
+from _openai import aget_response, BACKGROUND
 
 from utils import get_config, _
-from cache import save_message, update_message, get_redis_client
-from cache import save_embedding, update_embedding, update_message_id
-from timer import add_timer
+from cache import get_redis_client
+from cache import save_voice_note, update_voice_note
+from embeddings import get_embedding
+from jobs import enqueue, QueueFull, RetryLater
+from retry import retry, breakers
+from metrics import stage
+from transcripts import transcribe_voice
 
 
 config = get_config()
@@ -42,25 +43,23 @@ async def inline_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         query_msg = int(update.callback_query.data)
     except ValueError:
         print ("Unknown query message: ", update.callback_query.data, type(update.callback_query.data))
+        await query.answer()
+        return
     
     if query_msg == GPT_VOICE_CORRECT:
-        text_msg = query.message.text
-        comp = gpt_correct_template(text_msg)
-        correction = chatgpt_get_response(comp)
-        
-        embedding = await embed_message(correction)
-
-        update_embedding(get_redis_client(),
-                         update.effective_user.id,
-                         query.message.message_id,
-                         correction,
-                         embedding)
-
-        update_message(get_redis_client(),
-            update.effective_chat.id, 
-            query.message.message_id, 
-            correction)
-        await query.edit_message_text(text=correction)
+        try:
+            with stage("button", "enqueue"):
+                await enqueue("correct", {"user_id": update.effective_user.id,
+                                          "chat_id": update.effective_chat.id,
+                                          "message_id": query.message.message_id,
+                                          "text": query.message.text})
+        except QueueFull:
+            await query.answer(_("Too busy right now, please try again in a few minutes."))
+            return
+        with stage("button", "send_message"):
+            await query.edit_message_reply_markup(reply_markup=None)
+            await query.answer(_("Correcting the text..."))
+        return
 
     elif query_msg == GPT_VOICE_ACCEPT:
         await query.edit_message_reply_markup(reply_markup=None)  
@@ -77,95 +76,146 @@ def make_correct_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
-async def remove_approve_buttons(context: CallbackContext):
-    data = context.job.data
-    chat_id = data["chat_id"]
-    message_id = data["message_id"]
+async def process_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    print ("Voice message", update.effective_user.id)
+    # edited with the transcript once it is ready
+    with stage("voice", "send_message"):
+        reply = await retry(context.bot.send_message,
+                            chat_id=update.effective_chat.id,
+                            text=_("Transcribing..."),
+                            breaker=breakers["telegram"])
+    try:
+        with stage("voice", "enqueue"):
+            await enqueue("transcribe", {"user_id": update.effective_user.id,
+                                         "chat_id": update.effective_chat.id,
+                                         "voice_message_id": update.message.message_id,
+                                         "message_id": reply.message_id,
+                                         "file_id": update.message.voice.file_id,
+                                         "file_unique_id": update.message.voice.file_unique_id})
+    except QueueFull:
+        await reply.edit_text(_("There are too many voice messages waiting to be "
+                                "transcribed, please try again in a few minutes."))
+
+
+class NoteNotSaved(RetryLater):
+    pass
+
+
+async def transcribe_job(bot: Bot, payload: dict):
+    # jobs enqueued before file_unique_id was added to the payload
+    file_unique_id = payload.get("file_unique_id", payload["file_id"])
+    with stage("voice", "transcribe"):
+        result = await transcribe_voice(bot, payload["file_id"], file_unique_id,
+                                        user_id=payload["user_id"])
+
+    reply_markup = None
+    if len(result) >= MIN_TEXT_LEN:
+        reply_markup = make_correct_keyboard()
+
     try:
-        await context.bot.edit_message_reply_markup(chat_id=chat_id,
-                                                message_id=message_id,
-                                                reply_markup=None)
+        with stage("voice", "send_message"):
+            await bot.edit_message_text(chat_id=payload["chat_id"],
+                                        message_id=payload["message_id"],
+                                        text=f'"{result}"',
+                                        reply_markup=reply_markup)
+    except BadRequest as e:
+        # a retry after the edit went through
+        if "not modified" not in str(e):
+            raise
+
+    try:
+        await bot.delete_message(chat_id=payload["chat_id"],
+                                 message_id=payload["voice_message_id"])
     except BadRequest:
+        # already deleted by an earlier attempt
         pass
 
+    # last, a failure before these retries the job and enqueues them
+    # again; saving the note is idempotent and removing the buttons twice
+    # is harmless, should the job be retried after them all the same
+    await enqueue("embed", {"user_id": payload["user_id"],
+                            "chat_id": payload["chat_id"],
+                            "message_id": payload["message_id"],
+                            "text": result},
+                  max_queued=0)
+    if reply_markup is not None:
+        await enqueue("remove_buttons", {"chat_id": payload["chat_id"],
+                                         "message_id": payload["message_id"]},
+                      delay=APPROVE_TIMEOUT)
 
-async def embed_message(message_text, pause=2):
-    while True:
-        try:
-            return embed_text(message_text)
-        except:
-            time.sleep(pause)
 
+async def transcribe_failed(bot: Bot, payload: dict, error: Exception):
+    await bot.edit_message_text(chat_id=payload["chat_id"],
+                                message_id=payload["message_id"],
+                                text=_("Sorry, the recording couldn't be transcribed. "
+                                       "Please try again later."))
 
-async def process_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+async def correct_job(bot: Bot, payload: dict):
+    comp = gpt_correct_template(payload["text"])
+    with stage("button", "correct"):
+        correction = await aget_response(comp, user_id=payload["user_id"])
+    try:
+        with stage("button", "send_message"):
+            await bot.edit_message_text(chat_id=payload["chat_id"],
+                                        message_id=payload["message_id"],
+                                        text=correction)
+    except BadRequest as e:
+        if "not modified" not in str(e):
+            raise
+    await enqueue("embed", {**payload, "text": correction, "update": True},
+                  max_queued=0)
+
+
+async def correct_failed(bot: Bot, payload: dict, error: Exception):
+    await bot.send_message(chat_id=payload["chat_id"],
+                           text=_("Sorry, the text couldn't be corrected. "
+                                  "Please try again later."))
+
+
+async def embed_job(bot: Bot, payload: dict):
     client = get_redis_client()
-    min_text_len = MIN_TEXT_LEN
-    file_id = update.message.voice.file_id
-    print ("Voice message", update.effective_user.id)
-    new_file = None
-    for _ in range(5):
-        try:
-            new_file = await context.bot.get_file(file_id)
-        except TimedOut:
-            continue
-
-    if new_file is None:
-        await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text=_("Sorry, there was a network error when "
-                                              "trying to retrieve the recording. "
-                                              "Please try again later."))
+    with stage("voice", "embed"):
+        embedding = await get_embedding(payload["text"], priority=BACKGROUND)
+    if not payload.get("update"):
+        with stage("voice", "redis"):
+            await save_voice_note(client,
+                                  payload["user_id"],
+                                  payload["chat_id"],
+                                  payload["message_id"],
+                                  payload["text"],
+                                  embedding)
         return
 
-    with BytesIO() as obuff:
-        await new_file.download_to_memory(out=obuff)
-        result = transcribe_audio (obuff)["text"]
+    with stage("voice", "redis"):
+        key = await update_voice_note(client,
+                                      payload["user_id"],
+                                      payload["chat_id"],
+                                      payload["message_id"],
+                                      payload["text"],
+                                      embedding)
+    if key is None:
+        # the original transcript hasn't been saved yet, try again later
+        raise NoteNotSaved(payload["message_id"])
 
-    reply_markup = None
-    if len(result) >= min_text_len:
-        reply_markup = make_correct_keyboard()
-    
-    embedding = await embed_message(result)
-    key, _ = save_embedding(client,
-                   update.effective_user.id,
-                   result,
-                   embedding)
-
-    msg = None
-    for _ in range(30):
-        try:
-            msg = await context.bot.send_message(chat_id=update.effective_chat.id,
-                                   text=f'"{result}"',
-                                   reply_markup=reply_markup,)
-            break
-        except TimedOut:
-            time.sleep(2)
-            continue
 
-    if not msg:
-        print(f"Failed to send to chat {update.effective_chat.id}, message: {result}")
+async def remove_buttons_job(bot: Bot, payload: dict):
+    try:
+        await bot.edit_message_reply_markup(chat_id=payload["chat_id"],
+                                            message_id=payload["message_id"],
+                                            reply_markup=None)
+    except BadRequest:
+        pass
+
 
-    if reply_markup is not None:
-        add_timer(update.effective_chat.id,
-                  update.effective_user.id,
-                  context,
-                  remove_approve_buttons,
-                  when=APPROVE_TIMEOUT,
-                  data={"message_id": msg.id,
-                        "chat_id": update.effective_chat.id,
-                        "user_id": update.effective_user.id,
-                        }
-                  )
-    
-    if msg is not None:
-        save_message(client, 
-                     update.effective_chat.id, 
-                     msg.message_id, 
-                     result,
-                     embedding)
-        update_message_id(client,
-                          key,
-                          update.effective_user.id,
-                          msg.message_id)
-    
-    await context.bot.delete_message(chat_id=update.effective_chat.id,
-                               message_id=update.message.message_id)
\ No newline at end of file
+JOB_HANDLERS = {
+    "transcribe": transcribe_job,
+    "correct": correct_job,
+    "embed": embed_job,
+    "remove_buttons": remove_buttons_job,
+}
+
+JOB_FAILURE_HANDLERS = {
+    "transcribe": transcribe_failed,
+    "correct": correct_failed,
+}
@@ -0,0 +1,194 @@
+from collections import Counter
+from typing import List, Optional, Tuple
+import asyncio
+import inspect
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+from utils import get_config
+
+
+config = get_config()
+
+# off by default, the watchdog thread wakes up every INTERVAL seconds
+ENABLED = config.getboolean("WATCHDOG", "ENABLED", fallback=False)
+INTERVAL = config.getfloat("WATCHDOG", "INTERVAL", fallback=0.1)
+# seconds the loop may go without running the heartbeat before the
+# stack of whatever is blocking it is logged
+THRESHOLD = config.getfloat("WATCHDOG", "THRESHOLD", fallback=0.5)
+PROFILE_SECONDS = config.getfloat("WATCHDOG", "PROFILE_SECONDS", fallback=10)
+PROFILE_INTERVAL = config.getfloat("WATCHDOG", "PROFILE_INTERVAL", fallback=0.005)
+PROFILE_DIR = config.get("WATCHDOG", "PROFILE_DIR", fallback=".")
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+loop_lag = metrics.Histogram("bot_loop_lag_seconds",
+                             "How late the event loop ran the watchdog heartbeat",
+                             buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+loop_stalls = metrics.Counter("bot_loop_stalls_total",
+                              "Times the event loop was blocked past the threshold",
+                              ("handler",))
+
+
+def _frames(thread_id):
+    frame = sys._current_frames().get(thread_id)
+    return traceback.extract_stack(frame) if frame is not None else []
+
+
+def _name(code):
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    return f"{module}.{code.co_name}"
+
+
+def _handler(frame, task=None):
+    # the innermost of our own coroutines on the stack, which is the
+    # handler or the job the loop is stuck in, rather than the module
+    # that started the loop at the bottom of it
+    while frame is not None:
+        code = frame.f_code
+        path = os.path.abspath(code.co_filename)
+        if os.path.dirname(path) == SOURCE_DIR and path != os.path.abspath(__file__) \
+                and code.co_flags & (inspect.CO_COROUTINE | inspect.CO_ASYNC_GENERATOR):
+            return _name(code)
+        frame = frame.f_back
+    coro = task.get_coro() if task is not None else None
+    if getattr(coro, "cr_code", None) is not None:
+        return _name(coro.cr_code)
+    return "unknown"
+
+
+class Watchdog:
+    """
+    Watches the event loop from a thread. The loop bumps a heartbeat every
+    `interval` seconds; when it hasn't for `threshold` seconds, something
+    is blocking it, and the stack of the loop's thread, the task it is
+    running and the handler that task belongs to are logged while the
+    blocking call is still on the stack. SIGUSR1 writes a sampling
+    profile of the loop's thread.
+    """
+
+    def __init__(self, threshold: float = THRESHOLD, interval: float = INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self._beat = time.monotonic()
+        self._stopped = threading.Event()
+        self._heartbeat_task = None
+        self._thread = None
+        self._loop = None
+        self._loop_thread = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="watchdog", daemon=True)
+        self._thread.start()
+        try:
+            self._loop.add_signal_handler(signal.SIGUSR1, self._on_signal)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            # no SIGUSR1 on Windows, and signals only work in the main thread
+            pass
+        return self
+
+    async def stop(self):
+        self._stopped.set()
+        self._heartbeat_task.cancel()
+        try:
+            self._loop.remove_signal_handler(signal.SIGUSR1)
+        except (NotImplementedError, AttributeError, RuntimeError):
+            pass
+        await asyncio.to_thread(self._thread.join)
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - expected
+            loop_lag.observe(max(0., lag))
+            if lag > self.threshold:
+                logger.warning("Event loop was blocked for %.2fs", lag)
+
+    def _watch(self):
+        reported = False
+        while not self._stopped.wait(self.interval):
+            lag = time.monotonic() - self._beat
+            if lag <= self.threshold:
+                reported = False
+            elif not reported:
+                # once per stall
+                reported = True
+                self._report(lag)
+
+    def _report(self, lag):
+        frame = sys._current_frames().get(self._loop_thread)
+        stack = traceback.extract_stack(frame) if frame is not None else []
+        task = asyncio.current_task(self._loop)
+        handler = _handler(frame, task)
+        loop_stalls.inc(1, handler)
+        logger.warning("Event loop blocked for %.2fs in %s (task %s):\n%s",
+                       lag, handler, task.get_name() if task is not None else None,
+                       "".join(traceback.format_list(stack)))
+
+    def _on_signal(self):
+        async def dump():
+            path, _ = await profile(PROFILE_SECONDS, thread_id=self._loop_thread)
+            logger.info("Wrote a %gs profile to %s", PROFILE_SECONDS, path)
+
+        self._loop.create_task(dump())
+
+
+def sample(thread_id: int, seconds: float, interval: float = PROFILE_INTERVAL) -> Counter:
+    """
+    Samples the stack of a thread every `interval` seconds, counting how
+    often each one was seen, as tuples of "file:function" frames.
+    """
+    stacks = Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        stack = _frames(thread_id)
+        stacks[tuple(f"{os.path.basename(entry.filename)}:{entry.name}"
+                     for entry in stack)] += 1
+        time.sleep(interval)
+    return stacks
+
+
+async def profile(seconds: float = PROFILE_SECONDS,
+                  interval: float = PROFILE_INTERVAL,
+                  thread_id: Optional[int] = None,
+                  directory: str = PROFILE_DIR) -> Tuple[str, List[Tuple[str, float]]]:
+    """
+    Profiles the event loop's thread for `seconds`, from another thread so
+    the loop keeps running. Writes the samples in the collapsed stack
+    format flamegraph tools read and returns the file's path along with
+    the functions the thread was most often caught running and their
+    share of the samples.
+    """
+    thread_id = thread_id or threading.get_ident()
+    stacks = await asyncio.to_thread(sample, thread_id, seconds, interval)
+    path = os.path.join(directory, f"profile-{os.getpid()}-{int(time.time())}.txt")
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{';'.join(stack)} {count}\n")
+
+    total = sum(stacks.values()) or 1
+    functions = Counter()
+    for stack, count in stacks.items():
+        if stack:
+            functions[stack[-1]] += count
+    return path, [(frame, count / total) for frame, count in functions.most_common(15)]
+
+
+def start() -> Optional[Watchdog]:
+    if not ENABLED:
+        return None
+    return Watchdog().start()
@@ -0,0 +1,242 @@
+from typing import Optional
+import asyncio
+import json
+import logging
+
+import redis
+from telegram import Update
+
+from utils import get_config
+
+
+config = get_config()
+
+LISTEN = config.get("WEBHOOK", "LISTEN", fallback="0.0.0.0")
+PORT = config.getint("WEBHOOK", "PORT", fallback=8443)
+# the public URL Telegram posts updates to, including the path
+URL = config.get("WEBHOOK", "URL", fallback="")
+PATH = config.get("WEBHOOK", "PATH", fallback="/telegram")
+SECRET_TOKEN = config.get("WEBHOOK", "SECRET_TOKEN", fallback="")
+WORKERS = config.getint("WEBHOOK", "WORKERS", fallback=2)
+# updates a worker handles at once, a chat's updates are always handled
+# one at a time
+WORKER_CONCURRENCY = config.getint("WEBHOOK", "WORKER_CONCURRENCY", fallback=16)
+# approximate number of updates kept in each shard's stream
+STREAM_MAXLEN = config.getint("WEBHOOK", "STREAM_MAXLEN", fallback=10_000)
+
+STREAM = "updates"
+GROUP = "workers"
+
+logger = logging.getLogger(__name__)
+
+
+def stream_key(shard):
+    return f"{STREAM}:<{shard}>"
+
+
+def update_chat_id(data: dict) -> int:
+    """
+    The chat an update belongs to, or the user for updates that have no
+    chat, such as inline queries.
+    """
+    for kind, body in data.items():
+        if not isinstance(body, dict):
+            continue
+        chat = body.get("chat") or (body.get("message") or {}).get("chat")
+        if chat is not None:
+            return int(chat["id"])
+        sender = body.get("from") or body.get("user")
+        if sender is not None:
+            return int(sender["id"])
+    return 0
+
+
+def update_shard(data: dict, shards: int) -> int:
+    return update_chat_id(data) % shards
+
+
+class WebhookReceiver:
+    """
+    Accepts the updates Telegram posts to the webhook and appends each to
+    the Redis stream of its shard, picked by chat id, so all updates of a
+    chat go to the same worker. Telegram only gets its 200 once the update
+    is in Redis, anything that fails before that is sent again.
+    """
+
+    def __init__(self, client, shards: int,
+                 path: str = PATH,
+                 secret_token: str = SECRET_TOKEN,
+                 maxlen: int = STREAM_MAXLEN):
+        self.client = client
+        self.shards = shards
+        self.path = path
+        self.secret_token = secret_token
+        self.maxlen = maxlen
+        self._server = None
+
+    @property
+    def port(self):
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self, listen: str = LISTEN, port: int = PORT):
+        self._server = await asyncio.start_server(self._serve, listen, port)
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def enqueue(self, data: dict):
+        shard = update_shard(data, self.shards)
+        await self.client.xadd(stream_key(shard), {"update": json.dumps(data)},
+                               maxlen=self.maxlen, approximate=True)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode("latin-1").split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status = await self._handle(method, path, headers, body)
+                writer.write(f"HTTP/1.1 {status}\r\n"
+                             "Content-Length: 0\r\n"
+                             "Connection: keep-alive\r\n\r\n".encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, method, path, headers, body):
+        if method != "POST" or path.split("?", 1)[0] != self.path:
+            return "404 Not Found"
+        if self.secret_token and \
+                headers.get("x-telegram-bot-api-secret-token") != self.secret_token:
+            return "403 Forbidden"
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return "400 Bad Request"
+        try:
+            await self.enqueue(data)
+        except redis.RedisError:
+            logger.exception("Failed to enqueue an update")
+            return "503 Service Unavailable"
+        return "200 OK"
+
+
+class StreamWorker:
+    """
+    Feeds the updates of one shard's stream to the application. Up to
+    `concurrency` updates are processed at once, but the updates of each
+    chat strictly one after another in the order they arrived. Entries are
+    acknowledged once processed, so the ones a crashed worker had taken
+    are processed when it starts again.
+    """
+
+    def __init__(self, application, client, shard: int,
+                 concurrency: int = 1,
+                 batch: int = 100,
+                 block: int = 5000):
+        self.application = application
+        self.client = client
+        self.shard = shard
+        self.key = stream_key(shard)
+        self.consumer = f"worker-{shard}"
+        self.concurrency = concurrency
+        self.batch = batch
+        self.block = block
+        self._slots = asyncio.Semaphore(concurrency)
+        # chat id -> [lock, number of updates holding or waiting for it]
+        self._chats = {}
+        self._tasks = set()
+
+    async def _ensure_group(self):
+        try:
+            await self.client.xgroup_create(self.key, GROUP, id="0", mkstream=True)
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def _process(self, entry_id, data):
+        chat_id = update_chat_id(data)
+        chat = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+        chat[1] += 1
+        try:
+            async with chat[0]:
+                update = Update.de_json(data, self.application.bot)
+                try:
+                    await self.application.process_update(update)
+                except Exception:
+                    # an update that keeps failing would otherwise be
+                    # retried forever
+                    logger.exception("Failed to process update %s", entry_id)
+                try:
+                    await self.client.xack(self.key, GROUP, entry_id)
+                except redis.RedisError:
+                    # left pending, it is handled again after a restart
+                    logger.exception("Failed to acknowledge update %s", entry_id)
+        finally:
+            chat[1] -= 1
+            if chat[1] == 0:
+                del self._chats[chat_id]
+            self._slots.release()
+
+    async def _dispatch(self, entries):
+        for entry_id, fields in entries:
+            if not fields:
+                # trimmed from the stream before it was processed
+                try:
+                    await self.client.xack(self.key, GROUP, entry_id)
+                except redis.RedisError:
+                    logger.exception("Failed to acknowledge update %s", entry_id)
+                continue
+            # stop reading while every slot is busy
+            await self._slots.acquire()
+            data = json.loads(fields[b"update"])
+            # tasks are started in order and the chat locks are fair,
+            # which keeps each chat's updates in order
+            task = asyncio.create_task(self._process(entry_id, data))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _read(self, last_id, **kwargs):
+        try:
+            return await self.client.xreadgroup(GROUP, self.consumer, {self.key: last_id},
+                                                **kwargs)
+        except redis.RedisError:
+            # the updates wait in the stream until Redis is back
+            logger.exception("Failed to read updates of shard %s", self.shard)
+            await asyncio.sleep(1)
+            return None
+
+    async def run(self, stop: Optional[asyncio.Event] = None):
+        stop = stop or asyncio.Event()
+        await self._ensure_group()
+
+        # entries taken before a restart and never acknowledged
+        pending = None
+        while pending is None and not stop.is_set():
+            pending = await self._read("0")
+        for _, entries in pending or []:
+            await self._dispatch(entries)
+
+        while not stop.is_set():
+            response = await self._read(">", count=self.batch, block=self.block)
+            for _, entries in response or []:
+                await self._dispatch(entries)
+
+        if self._tasks:
+            await asyncio.gather(*self._tasks)